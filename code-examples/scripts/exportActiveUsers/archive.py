@@ -0,0 +1,423 @@
+"""
+Raw-response archive for two-stage (extract/transform) ComPilot exports.
+
+Extract: with --archive FILE, every successful listing, details and IPs
+response of an export is also appended, unchanged, to FILE. FILE is an
+append-only NDJSON archive. Each line holds one response:
+
+    {"kind": "details", "key": "<customer id>", "run": 3, "at": "...", "body": {...raw response...}}
+
+Lines are grouped into independently compressed frames of about 1 MB:
+zstd frames with the zstandard package, gzip members otherwise. Frames are
+listed in an offset index, <archive>.index.sqlite, together with the kind,
+key and run of every record in them. A frame is only indexed once it is
+fully written and synced. A frame cut short by a crash is therefore not in
+the index, and it is truncated the next time the archive is opened. Frames
+are compressed and synced on a writer thread, so archiving does not stall
+the export engine (or the async engine's event loop).
+
+Transform: python archive.py transform ARCHIVE --output FILE re-runs the
+column mapping (CompiLotExporter.build_row, or a --column-spec) offline. It uses the
+customers listed in a run, with the latest details and IPs archived for each
+up to that run. A customer served by --incremental or the response cache
+without a fetch still has the records of an earlier run. A layout change
+therefore costs no API calls, and only the frames that hold needed records
+are read and decompressed. Rows come out in the order of the archived
+listing, as in the live export.
+
+    python csvExport.py --archive raw.ndjson.zst
+    python archive.py info raw.ndjson.zst
+    python archive.py transform raw.ndjson.zst --output customers.csv --columns customer_id,risk_score
+    python archive.py transform raw.ndjson.zst --output custom.ndjson --column-spec columns.json
+"""
+
+import argparse
+import gzip
+import json
+import os
+import queue
+import sqlite3
+import sys
+import threading
+from datetime import datetime, timezone
+
+from column_plan import FetchPlan, parse_columns
+from column_spec import load_column_spec
+from id_set import IdSet
+from schema import fast_loads
+from sinks import SINKS, format_for
+
+class RawArchive:
+    FRAME_BYTES = 1024 * 1024
+    # Full frames waiting for the writer thread; appending blocks beyond this
+    QUEUED_FRAMES = 4
+    # Decompressed frames kept while transforming
+    CACHED_FRAMES = 4
+
+    def __init__(self, path, codec=None):
+        self.path = path
+        self.index_path = self.index_path_for(path)
+        # Records are appended from the export engine's thread, frames
+        # flushed from the sink's writer and written by the archive writer
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.index_path, check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS frames (
+                offset INTEGER PRIMARY KEY,
+                length INTEGER NOT NULL,
+                records INTEGER NOT NULL,
+                raw_bytes INTEGER NOT NULL,
+                run INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS records (
+                seq INTEGER PRIMARY KEY,
+                run INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                frame_offset INTEGER NOT NULL,
+                position INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS records_key ON records (key, kind, run);
+            CREATE INDEX IF NOT EXISTS records_run ON records (run, kind);
+        """)
+
+        self.codec = self._meta('codec')
+        if self.codec is None:
+            self.codec = codec or ('zstd' if self._zstandard() else 'gzip')
+            self._set_meta('codec', self.codec)
+            self.conn.commit()
+        if self.codec == 'zstd':
+            zstandard = self._zstandard()
+            if zstandard is None:
+                raise ValueError(f"{path} is zstd-compressed, which needs the zstandard package "
+                                 f"(pip install zstandard)")
+            self.compressor = zstandard.ZstdCompressor(level=3)
+            self.decompressor = zstandard.ZstdDecompressor()
+
+        # Drop a frame a crash left unindexed
+        end = self.conn.execute("SELECT COALESCE(MAX(offset + length), 0) FROM frames").fetchone()[0]
+        if os.path.exists(path) and os.path.getsize(path) > end:
+            print(f"Truncating {os.path.getsize(path) - end} bytes of an incomplete frame from {path}")
+            with open(path, 'r+b') as f:
+                f.truncate(end)
+        self.file = None
+        self.run = int(self._meta('run', 0))
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.pending = []
+        self.frames = queue.Queue(self.QUEUED_FRAMES)
+        self.writer = None
+        self.writer_error = None
+
+    @staticmethod
+    def index_path_for(path):
+        return f"{path}.index.sqlite"
+
+    @staticmethod
+    def _zstandard():
+        try:
+            import zstandard
+        except ImportError:
+            return None
+        return zstandard
+
+    def _meta(self, key, default=None):
+        found = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return found[0] if found else default
+
+    def _set_meta(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    # Extract
+
+    def begin_run(self, resume=False):
+        """Start archiving a new run, or keep adding to the current one when resuming"""
+        with self.lock:
+            if not resume or not self.run:
+                self.run += 1
+                self._set_meta('run', self.run)
+                self.conn.commit()
+            self.file = open(self.path, 'ab')
+            if self.writer is None:
+                self.writer = threading.Thread(target=self._write_frames, daemon=True,
+                                               name=f"{threading.current_thread().name}/archive-writer")
+                self.writer.start()
+
+    def append(self, kind, key, body):
+        """Archive one raw response body (bytes of JSON) as a record of the current run"""
+        # A JSON document only has newlines as whitespace, so this keeps it one line
+        body = body.strip().replace(b'\r', b' ').replace(b'\n', b' ')
+        if not body:
+            return
+        header = json.dumps({'kind': kind, 'key': str(key), 'run': self.run,
+                             'at': datetime.now(timezone.utc).isoformat()})
+        line = header[:-1].encode('utf-8') + b', "body": ' + body + b'}\n'
+        with self.lock:
+            self.buffer.append(line)
+            self.pending.append((kind, str(key)))
+            self.buffered_bytes += len(line)
+            frame = self._take_frame() if self.buffered_bytes >= self.FRAME_BYTES else None
+        if frame:
+            self.frames.put(frame)
+
+    def _compress(self, data):
+        if self.codec == 'zstd':
+            return self.compressor.compress(data)
+        return gzip.compress(data, compresslevel=6, mtime=0)
+
+    def _take_frame(self):
+        # The buffered records as a frame for the writer; called with the lock held
+        if not self.buffer:
+            return None
+        frame = (self.buffer, self.pending, self.run)
+        self.buffer = []
+        self.pending = []
+        self.buffered_bytes = 0
+        return frame
+
+    def _write_frames(self):
+        # Writer thread: compress, write and sync queued frames in order
+        while True:
+            frame = self.frames.get()
+            try:
+                if frame is None:
+                    return
+                if self.writer_error is None:
+                    self._write_frame(*frame)
+            except Exception as e:
+                self.writer_error = e
+            finally:
+                self.frames.task_done()
+
+    def _write_frame(self, lines, pending, run):
+        raw = b''.join(lines)
+        frame = self._compress(raw)
+        offset = self.file.seek(0, os.SEEK_END)
+        self.file.write(frame)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        # Indexed only once the frame is on disk
+        with self.lock:
+            self.conn.execute("INSERT INTO frames (offset, length, records, raw_bytes, run) VALUES (?, ?, ?, ?, ?)",
+                              (offset, len(frame), len(lines), len(raw), run))
+            self.conn.executemany(
+                "INSERT INTO records (run, kind, key, frame_offset, position) VALUES (?, ?, ?, ?, ?)",
+                [(run, kind, key, offset, position) for position, (kind, key) in enumerate(pending)]
+            )
+            self.conn.commit()
+
+    def _drain(self):
+        # Queue what is buffered and wait until every queued frame is written
+        if self.writer is None:
+            return
+        with self.lock:
+            frame = self._take_frame()
+        if frame:
+            self.frames.put(frame)
+        self.frames.join()
+        if self.writer_error is not None:
+            raise Exception(f"Could not write to {self.path}: {self.writer_error}")
+
+    def flush(self):
+        """Write the buffered records as a frame, so a resumed export does not fetch them again"""
+        self._drain()
+
+    def finish_run(self):
+        self._drain()
+        with self.lock:
+            self._set_meta('finished_run', self.run)
+            self.conn.commit()
+
+    def close(self):
+        try:
+            self._drain()
+        finally:
+            if self.writer is not None:
+                self.frames.put(None)
+                self.writer.join()
+                self.writer = None
+            if self.file:
+                self.file.close()
+                self.file = None
+            self.conn.close()
+
+    # Transform
+
+    def read_frame(self, f, offset, length):
+        """The record lines of the frame at `offset`"""
+        f.seek(offset)
+        data = f.read(length)
+        if self.codec == 'zstd':
+            data = self.decompressor.decompress(data)
+        else:
+            data = gzip.decompress(data)
+        return data.split(b'\n')
+
+    def finished_run(self):
+        found = self._meta('finished_run')
+        return int(found) if found else None
+
+    def runs(self):
+        """(run, frames, records, compressed bytes, raw bytes) for every run"""
+        return self.conn.execute(
+            "SELECT run, COUNT(*), SUM(records), SUM(length), SUM(raw_bytes) FROM frames GROUP BY run ORDER BY run"
+        ).fetchall()
+
+    def iter_rows(self, build_row, run=None, plan=None):
+        """
+        Yield the rows of `run` (default: the last finished run), mapped by
+        build_row(details, ips) and limited to the columns of the FetchPlan
+        `plan` (default: all), in the order of the run's listing. Afterwards,
+        self.missing counts the listed customers without archived details
+        or IPs.
+        """
+        run = run or self.finished_run()
+        if not run:
+            raise ValueError(f"{self.path} has no finished run; pass --run to transform an unfinished one")
+        plan = plan or FetchPlan()
+        self.missing = 0
+
+        lengths = dict(self.conn.execute("SELECT offset, length FROM frames"))
+        frames = {}
+
+        def load(f, offset, position):
+            # One record, decompressing its frame unless it is among the last few read
+            lines = frames.get(offset)
+            if lines is None:
+                if len(frames) >= self.CACHED_FRAMES:
+                    del frames[next(iter(frames))]
+                lines = frames[offset] = self.read_frame(f, offset, lengths[offset])
+            return fast_loads(lines[position])
+
+        kinds = ['details', 'ips'] if plan.needs_ips else ['details']
+        # The latest details and IPs up to the run of each wanted customer
+        latest = " UNION ALL ".join(
+            "SELECT (SELECT MAX(seq) FROM records WHERE key = w.customer_id AND kind = ? AND run <= ?) AS seq "
+            "FROM wanted w"
+            for _ in kinds
+        )
+        latest_query = (f"SELECT r.key, r.kind, r.frame_offset, r.position FROM records r "
+                        f"JOIN ({latest}) latest ON r.seq = latest.seq ORDER BY r.frame_offset, r.position")
+        latest_params = [value for kind in kinds for value in (kind, run)]
+        self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS wanted (customer_id TEXT PRIMARY KEY)")
+        self.conn.execute("DELETE FROM wanted")
+
+        seen = IdSet()
+        # Pages are archived as they arrive, which with concurrent listing is
+        # not page order; a page listed twice (retried or resumed) is read in
+        # both versions, and each customer is taken from the first
+        listing = self.conn.execute(
+            "SELECT frame_offset, position FROM records WHERE run = ? AND kind = 'list' "
+            "ORDER BY CAST(key AS INTEGER), seq", (run,)
+        ).fetchall()
+        with open(self.path, 'rb') as f:
+            for list_offset, list_position in listing:
+                # The onboarded customers of one listing page, with their
+                # details when the listing entry is enough
+                customers = []
+                for customer in load(f, list_offset, list_position)['body']['data']:
+                    if customer['onboarding_level'] != 'Onboarded' or not seen.add(customer['id']):
+                        continue
+                    details = plan.listing_details(customer)
+                    if details is not None and not plan.needs_ips:
+                        customers.append((customer['id'], details))
+                    else:
+                        customers.append((customer['id'], None))
+                        self.conn.execute("INSERT INTO wanted (customer_id) VALUES (?)", (customer['id'],))
+
+                found = {}
+                for key, kind, offset, position in self.conn.execute(latest_query, latest_params).fetchall():
+                    found.setdefault(key, {})[kind] = load(f, offset, position)['body']
+                self.conn.execute("DELETE FROM wanted")
+
+                for customer_id, details in customers:
+                    if details is not None:
+                        yield self._select(build_row(details, []), plan)
+                        continue
+                    parts = found.get(customer_id, {})
+                    if len(parts) < len(kinds):
+                        self.missing += 1
+                        continue
+                    yield self._select(build_row(parts['details'], parts.get('ips', [])), plan)
+
+    @staticmethod
+    def _select(row, plan):
+        return row if plan.complete else {column: row.get(column) for column in plan.columns}
+
+def transform(archive_path, output, columns=None, run=None, output_format=None, spec=None):
+    """
+    Write the rows of an archived run to `output`, without calling the API,
+    with the standard `columns` or the columns of a ColumnSpec. Returns the
+    number of rows.
+    """
+    # Imported here so that extracting does not depend on the exporter's setup
+    from csvExport import CompiLotExporter
+
+    if not os.path.exists(RawArchive.index_path_for(archive_path)):
+        raise ValueError(f"{archive_path} is not an archive (no {RawArchive.index_path_for(archive_path)})")
+    output_format = output_format or format_for(output)
+    archive = RawArchive(archive_path)
+    rows = 0
+    try:
+        run = run or archive.finished_run()
+        if not run:
+            raise ValueError(f"{archive_path} has no finished run; pass --run to transform an unfinished one")
+        plan = FetchPlan(columns, spec=spec)
+        build_row = spec.extract if spec is not None else CompiLotExporter.build_row
+        sink = SINKS[output_format](output, plan.columns)
+        try:
+            for row in archive.iter_rows(build_row, run, plan):
+                sink.write(row)
+                rows += 1
+            sink.sync()
+        finally:
+            sink.close()
+        if archive.missing:
+            print(f"{archive.missing} listed customers have no archived details or IPs and were left out")
+    finally:
+        archive.close()
+    return rows
+
+def info(archive_path):
+    archive = RawArchive(archive_path)
+    try:
+        print(f"{archive_path}: {archive.codec} frames, last finished run {archive.finished_run() or 'none'}")
+        for run, frames, records, length, raw_bytes in archive.runs():
+            print(f"  run {run}: {records} records in {frames} frames, "
+                  f"{length / 1024 / 1024:.1f} MB ({raw_bytes / max(length, 1):.1f}x compression)")
+    finally:
+        archive.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or transform a raw ComPilot response archive")
+    commands = parser.add_subparsers(dest="command", required=True)
+    info_parser = commands.add_parser("info", help="list the runs in an archive")
+    info_parser.add_argument("archive")
+    transform_parser = commands.add_parser("transform", help="build an export from an archived run")
+    transform_parser.add_argument("archive")
+    transform_parser.add_argument("--output", required=True, metavar="FILE")
+    transform_parser.add_argument("--format", choices=sorted(SINKS),
+                                  help="output format (default: from the --output extension)")
+    transform_parser.add_argument("--columns", metavar="COLUMNS",
+                                  help="comma-separated columns to export (default: all)")
+    transform_parser.add_argument("--column-spec", metavar="SPEC_FILE",
+                                  help="JSON column spec to map the payloads with (see column_spec.py)")
+    transform_parser.add_argument("--run", type=int, help="run to transform (default: the last finished one)")
+    args = parser.parse_args()
+
+    try:
+        if args.command == "info":
+            info(args.archive)
+            return
+        if args.columns and args.column_spec:
+            raise ValueError("--column-spec cannot be combined with --columns; list the columns in the spec")
+        spec = load_column_spec(args.column_spec) if args.column_spec else None
+        rows = transform(args.archive, args.output, parse_columns(args.columns), args.run, args.format, spec)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    print(f"Wrote {rows} rows to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""
+Offline throughput benchmark for the ComPilot exporter.
+
+Starts mock_server.py in-process and runs CompiLotExporter against it once per
+export mode, each in its own subprocess so peak memory is measured per mode:
+
+- sync:        sequential engine
+- async:       asyncio engine (--concurrency customers in flight)
+- cache:       async engine with a warm response cache
+- incremental: async engine with a warm incremental state file
+
+The warm modes first run an unmeasured export to fill the cache/state file.
+For every mode it reports:
+
+- customers/sec:      exported rows per second of wall time
+- budget utilization: accepted API calls per second, as a share of the mock's
+                      sustained rate limit (its tightest tier)
+- peak RSS:           maximum resident memory of the exporter process
+- time to first row:  delay before the first CSV row was ready
+
+Usage:
+    python benchmark.py --customers 300 --modes sync,async --rate-limit 50/1,1500/60
+    python benchmark.py --json results.json
+
+All mock_server.py options (latency, error rate, ...) are accepted.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock_server import add_server_arguments, api_from_args, parse_rate_limits
+
+MODES = ('sync', 'async', 'cache', 'incremental')
+RESULT_PREFIX = 'BENCHMARK_RESULT '
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+def run_export(args):
+    """Child process: run one export against the mock and print its measurements"""
+    from csvExport import CompiLotExporter, DeltaState, RateLimiter, ResponseCache
+
+    tiers = parse_rate_limits(args.rate_limit) or [(1000000, 1)]
+    exporter = CompiLotExporter(api_token='benchmark', response_cache=(
+        ResponseCache(os.path.join(args.workdir, 'cache.sqlite')) if args.mode == 'cache' else None
+    ))
+    exporter.base_url = args.url
+    exporter.rate_limiter = RateLimiter(tiers=tiers)
+    delta = DeltaState(os.path.join(args.workdir, 'state.sqlite')) if args.mode == 'incremental' else None
+
+    first_row = []
+    record_row = exporter.record_row
+
+    def timed_record_row(record):
+        row = record_row(record)
+        if row and not first_row:
+            first_row.append(time.perf_counter())
+        return row
+
+    exporter.record_row = timed_record_row
+    concurrency = None if args.mode == 'sync' else args.concurrency
+
+    start = time.perf_counter()
+    rows = exporter.export_to_csv(os.path.join(args.workdir, f'{args.mode}.csv'),
+                                  concurrency=concurrency, delta=delta)
+    elapsed = time.perf_counter() - start
+
+    if delta:
+        delta.close()
+    exporter.close()
+    if exporter.response_cache:
+        exporter.response_cache.close()
+
+    print(RESULT_PREFIX + json.dumps({
+        'rows': rows,
+        'elapsed': elapsed,
+        'time_to_first_row': first_row[0] - start if first_row else None,
+        'peak_rss_mb': peak_rss_mb(),
+        'client_calls': exporter.rate_limiter.stats()['calls'],
+    }))
+
+def run_child(args, url, mode, workdir):
+    command = [
+        sys.executable, os.path.abspath(__file__), '--child', mode,
+        '--url', url, '--workdir', workdir,
+        '--concurrency', str(args.concurrency), '--rate-limit', args.rate_limit,
+    ]
+    completed = subprocess.run(command, capture_output=True, text=True)
+    for line in completed.stdout.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    raise Exception(f"Benchmark of mode '{mode}' failed:\n{completed.stdout}{completed.stderr}")
+
+def benchmark(args):
+    api = api_from_args(args)
+    url = api.start()
+    tiers = parse_rate_limits(args.rate_limit)
+    sustained = min(calls / period for calls, period in tiers) if tiers else None
+    print(f"Mock API on {url}: {args.customers} customers, {args.latency * 1000:.0f} ms "
+          f"{args.latency_distribution} latency, {args.error_rate:.1%} errors, rate limit {args.rate_limit}")
+
+    results = {}
+    try:
+        for mode in args.modes:
+            with tempfile.TemporaryDirectory() as workdir:
+                if mode in ('cache', 'incremental'):
+                    print(f"[{mode}] warming up...")
+                    run_child(args, url, mode, workdir)
+                    if args.cooldown:
+                        # Keep the warm-up's calls out of the measured run's rate limit windows
+                        time.sleep(max((period for _, period in tiers), default=0))
+
+                api.reset_stats()
+                print(f"[{mode}] running...")
+                result = run_child(args, url, mode, workdir)
+                server = dict(api.stats)
+
+            accepted = server['requests'] - server['throttled']
+            result.update({
+                'customers_per_sec': result['rows'] / result['elapsed'] if result['elapsed'] else 0.0,
+                'api_calls': accepted,
+                'throttled': server['throttled'],
+                'server_errors': server['errors'],
+                'budget_utilization': accepted / result['elapsed'] / sustained if sustained and result['elapsed'] else None,
+            })
+            results[mode] = result
+    finally:
+        api.stop()
+    return results
+
+def print_report(results):
+    print()
+    print(f"{'mode':<12} {'rows':>6} {'seconds':>8} {'cust/s':>8} {'calls':>6} {'429s':>5} "
+          f"{'budget':>7} {'peak RSS':>9} {'first row':>10}")
+    for mode, result in results.items():
+        budget = result['budget_utilization']
+        rss = result['peak_rss_mb']
+        first = result['time_to_first_row']
+        print(f"{mode:<12} {result['rows']:>6} {result['elapsed']:>8.2f} {result['customers_per_sec']:>8.1f} "
+              f"{result['api_calls']:>6} {result['throttled']:>5} "
+              f"{(f'{budget:.0%}' if budget is not None else 'n/a'):>7} "
+              f"{(f'{rss:.1f} MB' if rss is not None else 'n/a'):>9} "
+              f"{(f'{first:.3f} s' if first is not None else 'n/a'):>10}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the ComPilot exporter against a local mock API")
+    parser.add_argument("--modes", default="sync,async",
+                        help=f"comma-separated export modes to run, from {', '.join(MODES)} (default: sync,async)")
+    parser.add_argument("--concurrency", type=int, default=32,
+                        help="customers in flight for the async modes (default: 32)")
+    parser.add_argument("--cooldown", action="store_true",
+                        help="after a warm-up run, wait out the longest rate limit window before measuring")
+    parser.add_argument("--json", metavar="FILE",
+                        help="also write the results to FILE as JSON")
+    add_server_arguments(parser)
+    # Internal: a single measured export, run in a subprocess
+    parser.add_argument("--child", choices=MODES, dest="mode", help=argparse.SUPPRESS)
+    parser.add_argument("--url", help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    parser.set_defaults(customers=300, rate_limit="50/1,1500/60")
+
+    args = parser.parse_args()
+    args.modes = [mode.strip() for mode in args.modes.split(',') if mode.strip()]
+    for mode in args.modes:
+        if mode not in MODES:
+            parser.error(f"unknown mode '{mode}' (expected one of {', '.join(MODES)})")
+    return args
+
+def main():
+    args = parse_args()
+    if args.mode:
+        run_export(args)
+        return
+
+    results = benchmark(args)
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.json}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+Change data capture (CDC) between consecutive ComPilot exports.
+
+ChangeCapture keeps, in a SQLite state file, a 64-bit content hash and a
+compressed copy of every customer's exported row. While an export streams,
+each row is compared with the previous run's copy and changes are written
+as NDJSON events:
+
+    {"op": "insert", "customer_id": ..., "run": 3, "at": ..., "row": {...}}
+    {"op": "update", "customer_id": ..., "run": 3, "at": ...,
+     "changes": {"risk_score": {"old": 12, "new": 40}}}
+    {"op": "delete", "customer_id": ..., "run": 3, "at": ..., "row": {...}}
+
+Unchanged customers cost one primary-key lookup and a hash comparison.
+Deletes are customers of the previous run that were not listed again,
+emitted once the export is complete. Customers that could not be fetched
+are carried over unchanged. After a crash and --resume, events of the
+interrupted page can be emitted twice; "run" and "customer_id" identify
+duplicates.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import zlib
+from datetime import datetime, timezone
+
+from sinks import LIST_COLUMNS, as_list
+
+def normalize(row):
+    """The row as compared: list columns as lists, whatever form they were stored in"""
+    return {key: as_list(value) if key in LIST_COLUMNS else value for key, value in row.items()}
+
+def content_hash(row):
+    payload = json.dumps(row, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=8).digest()
+
+def diff_rows(old, new):
+    """Field-level changes between two rows, over the columns both have"""
+    return {
+        key: {'old': old[key], 'new': new[key]}
+        for key in new
+        if key in old and old[key] != new[key]
+    }
+
+class ChangeCapture:
+    def __init__(self, path, output_path):
+        self.path = path
+        self.output_path = output_path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS customers (
+                customer_id TEXT PRIMARY KEY,
+                hash BLOB NOT NULL,
+                row BLOB NOT NULL,
+                run INTEGER NOT NULL
+            );
+        """)
+        self.output = None
+        self.run = 0
+        self.at = None
+
+        # Counters
+        self.inserted = 0
+        self.updated = 0
+        self.deleted = 0
+        self.unchanged = 0
+
+    def begin_run(self, resume=False):
+        """Start a new run, or continue the current one when resuming"""
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'run'").fetchone()
+        self.run = int(row[0]) if row else 0
+        if not resume:
+            self.run += 1
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('run', ?)", (str(self.run),))
+            self.conn.commit()
+        self.at = datetime.now(timezone.utc).isoformat()
+        self.output = open(self.output_path, 'a' if resume else 'w', encoding='utf-8')
+
+    def _emit(self, op, customer_id, **fields):
+        event = {'op': op, 'customer_id': customer_id, 'run': self.run, 'at': self.at}
+        event.update(fields)
+        self.output.write(json.dumps(event, default=str) + '\n')
+
+    def _store(self, customer_id, digest, row):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO customers (customer_id, hash, row, run) VALUES (?, ?, ?, ?)",
+            (customer_id, digest, zlib.compress(json.dumps(row, default=str).encode('utf-8')), self.run)
+        )
+
+    def observe(self, row):
+        """Compare one exported row with the previous run and emit its change, if any"""
+        row = normalize(row)
+        customer_id = row['customer_id']
+        digest = content_hash(row)
+        found = self.conn.execute(
+            "SELECT hash, row FROM customers WHERE customer_id = ?", (customer_id,)
+        ).fetchone()
+
+        if found is None:
+            self._emit('insert', customer_id, row=row)
+            self.inserted += 1
+        elif found[0] == digest:
+            self.conn.execute("UPDATE customers SET run = ? WHERE customer_id = ?", (self.run, customer_id))
+            self.unchanged += 1
+            return
+        else:
+            changes = diff_rows(json.loads(zlib.decompress(found[1])), row)
+            if changes:
+                self._emit('update', customer_id, changes=changes)
+                self.updated += 1
+            else:
+                # Only the column selection changed
+                self.unchanged += 1
+        self._store(customer_id, digest, row)
+
+    def carry_over(self, customer_id):
+        """Keep a customer that could not be fetched this run, so it is not reported as deleted"""
+        self.conn.execute("UPDATE customers SET run = ? WHERE customer_id = ?", (self.run, customer_id))
+
+    def commit(self):
+        # Events go to disk before the state that stops them being emitted again
+        self.output.flush()
+        os.fsync(self.output.fileno())
+        self.conn.commit()
+
+    def finish(self):
+        """Emit deletes for customers not seen in this run"""
+        rows = self.conn.execute("SELECT customer_id, row FROM customers WHERE run != ?", (self.run,))
+        for customer_id, row in rows:
+            self._emit('delete', customer_id, row=json.loads(zlib.decompress(row)))
+            self.deleted += 1
+        self.output.flush()
+        os.fsync(self.output.fileno())
+        self.conn.execute("DELETE FROM customers WHERE run != ?", (self.run,))
+        self.conn.commit()
+
+    def summary(self):
+        return (f"{self.inserted} inserted, {self.updated} updated, {self.deleted} deleted, "
+                f"{self.unchanged} unchanged")
+
+    def close(self):
+        if self.output:
+            self.output.close()
+        self.conn.close()
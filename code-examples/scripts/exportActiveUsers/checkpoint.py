@@ -0,0 +1,122 @@
+"""
+Durable checkpoints for resumable ComPilot exports.
+
+A checkpoint is a small SQLite file stored next to the CSV
+(<csv>.checkpoint.sqlite) that records:
+- the last listing page whose customers have all been handled
+- the customer IDs already written to the CSV
+- the customer IDs that could not be fetched
+- the CSV size at the last commit
+- the page size and column selection, which a resumed run must keep
+
+Pages are handled in order, so a resumed run restarts at the first
+incomplete page, skips customers of that page that were already written
+and truncates any rows written after the last commit before appending.
+"""
+
+import os
+import sqlite3
+
+class ExportCheckpoint:
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS written (customer_id TEXT PRIMARY KEY, page INTEGER);
+            CREATE TABLE IF NOT EXISTS failed (customer_id TEXT PRIMARY KEY, page INTEGER, reason TEXT);
+        """)
+        self.pending_rows = 0
+
+    @staticmethod
+    def path_for(filename):
+        return f"{filename}.checkpoint.sqlite"
+
+    @classmethod
+    def create(cls, filename, page_size, columns=None):
+        """Start a fresh checkpoint for a new export"""
+        path = cls.path_for(filename)
+        if os.path.exists(path):
+            os.remove(path)
+        checkpoint = cls(path)
+        checkpoint._set('filename', filename)
+        checkpoint._set('page_size', page_size)
+        checkpoint._set('last_completed_page', 0)
+        checkpoint._set('csv_offset', 0)
+        if columns:
+            checkpoint._set('columns', ','.join(columns))
+        checkpoint.conn.commit()
+        return checkpoint
+
+    @classmethod
+    def open(cls, filename):
+        """Open the checkpoint of an interrupted export"""
+        path = cls.path_for(filename)
+        if not os.path.exists(path):
+            raise ValueError(f"No checkpoint found for {filename} (expected {path})")
+        return cls(path)
+
+    def _get(self, key, default=None):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    @property
+    def page_size(self):
+        return int(self._get('page_size'))
+
+    @property
+    def columns(self):
+        """The exported columns, or None for checkpoints that predate column selection"""
+        columns = self._get('columns')
+        return columns.split(',') if columns else None
+
+    @property
+    def last_completed_page(self):
+        return int(self._get('last_completed_page', 0))
+
+    @property
+    def csv_offset(self):
+        return int(self._get('csv_offset', 0))
+
+    def start_page(self):
+        return self.last_completed_page + 1
+
+    def written_ids(self, from_page):
+        """IDs already written for pages at or after `from_page`"""
+        rows = self.conn.execute("SELECT customer_id FROM written WHERE page >= ?", (from_page,))
+        return {row[0] for row in rows}
+
+    def failed_ids(self):
+        return [row[0] for row in self.conn.execute("SELECT customer_id FROM failed ORDER BY page")]
+
+    def record_written(self, customer_id, page):
+        self.conn.execute("INSERT OR REPLACE INTO written (customer_id, page) VALUES (?, ?)", (customer_id, page))
+        self.conn.execute("DELETE FROM failed WHERE customer_id = ?", (customer_id,))
+        self.pending_rows += 1
+
+    def record_failed(self, customer_id, page, reason):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO failed (customer_id, page, reason) VALUES (?, ?, ?)",
+            (customer_id, page, reason)
+        )
+        self.pending_rows += 1
+
+    def page_reached(self, page):
+        """Mark every page before `page` as complete (pages are handled in order)"""
+        if page - 1 > self.last_completed_page:
+            self._set('last_completed_page', page - 1)
+
+    def commit(self, sink):
+        """Persist progress, after making sure the rows it covers are on disk"""
+        # sink.sync() makes the rows durable and returns the file offset they end at
+        self._set('csv_offset', sink.sync())
+        self.conn.commit()
+        self.pending_rows = 0
+
+    def close(self, remove=False):
+        self.conn.close()
+        if remove:
+            os.remove(self.path)
@@ -0,0 +1,104 @@
+"""
+Column-driven fetch planning for the ComPilot export scripts.
+
+Every CSV column is built from one endpoint:
+
+- details: GET /customers/{id}       (claims, wallets, risk score, ...)
+- ips:     GET /customers/{id}/ips   (IP history)
+
+FetchPlan works out which endpoints a selection of columns actually needs.
+/ips is never called when no IP column is selected. Details are not fetched
+for a customer whose /customers listing entry already carries every field
+the selected columns read (customer_id and onboarding_level always do).
+
+With a ColumnSpec (see column_spec.py) instead of a column selection, the
+columns, detail fields and IP needs come from the spec's expressions.
+"""
+
+# Detail fields each column reads; IP columns read the /ips endpoint instead
+COLUMN_SOURCES = {
+    'customer_id': ('details', ['id']),
+    'name': ('details', ['customerClaims']),
+    'given_name': ('details', ['customerClaims']),
+    'family_name': ('details', ['customerClaims']),
+    'nationality': ('details', ['customerClaims']),
+    'country_of_residence': ('details', ['customerClaims']),
+    'birthdate': ('details', ['customerClaims']),
+    'wallets': ('details', ['customerWallets']),
+    'risk_score': ('details', ['riskScore']),
+    'status': ('details', ['status']),
+    'onboarding_level': ('details', ['onboardingLevel']),
+    'date_onboarded': ('details', ['createdAt']),
+    'email': ('details', ['customerEmails']),
+    'ip_addresses': ('ips', []),
+    'latest_ip': ('ips', []),
+    'latest_ip_date': ('ips', []),
+}
+
+# Detail fields that the listing spells differently
+LISTING_ALIASES = {
+    'onboardingLevel': 'onboarding_level',
+}
+
+def parse_columns(spec):
+    """Parse "customer_id,risk_score,wallets" into a column list (None selects every column)"""
+    if not spec:
+        return None
+    columns = [column.strip() for column in spec.split(',') if column.strip()]
+    unknown = [column for column in columns if column not in COLUMN_SOURCES]
+    if unknown:
+        raise ValueError(f"Unknown column(s) {', '.join(unknown)} (expected any of {', '.join(COLUMN_SOURCES)})")
+    return columns
+
+class FetchPlan:
+    def __init__(self, columns=None, spec=None):
+        self.spec = spec
+        self.columns = list(columns or COLUMN_SOURCES)
+        self.detail_fields = []
+        self.needs_ips = False
+        if spec is not None:
+            self.columns = list(spec.columns)
+            self.detail_fields = list(spec.detail_fields)
+            self.needs_ips = spec.needs_ips
+        else:
+            for column in self.columns:
+                source, fields = COLUMN_SOURCES[column]
+                if source == 'ips':
+                    self.needs_ips = True
+                for field in fields:
+                    if field not in self.detail_fields:
+                        self.detail_fields.append(field)
+
+        # Counters
+        self.details_from_listing = 0
+
+    @property
+    def complete(self):
+        """Whether every column is selected (a spec's rows have exactly its columns)"""
+        return self.spec is not None or set(self.columns) == set(COLUMN_SOURCES)
+
+    def listing_details(self, customer):
+        """
+        Details for `customer` built from its listing entry, or None when the
+        listing lacks a field the selected columns need.
+        """
+        details = {'id': customer['id']}
+        for field in self.detail_fields:
+            if field in customer:
+                details[field] = customer[field]
+            elif LISTING_ALIASES.get(field) in customer:
+                details[field] = customer[LISTING_ALIASES[field]]
+            else:
+                return None
+        self.details_from_listing += 1
+        return details
+
+    def describe(self):
+        if self.complete and self.spec is None:
+            return "all columns (details and IPs for every customer)"
+        # Every listing entry has an id
+        fields = [field for field in self.detail_fields if field != 'id']
+        calls = ["details when the listing lacks " + ', '.join(fields)] if fields else []
+        if self.needs_ips:
+            calls.append("IPs")
+        return f"{len(self.columns)} columns ({' + '.join(calls) or 'listing only'})"
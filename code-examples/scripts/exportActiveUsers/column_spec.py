@@ -0,0 +1,376 @@
+"""
+Declarative column specs for the ComPilot export scripts.
+
+A column spec maps each output column to an expression over the customer's
+details payload and IP history, e.g. in a JSON file:
+
+    {
+        "customer_id": "id",
+        "nationality": "customerClaims[0].nationality",
+        "wallets": "customerWallets[*].wallet",
+        "wallet_count": "count(customerWallets)",
+        "emails": "join(customerEmails[*].email, '; ')",
+        "latest_ip": "max_by(ips, createdAt, ipAddress)",
+        "first_seen": "min(ips[*].createdAt)"
+    }
+
+Expressions:
+
+- paths read the details payload: name.name, [0] / [-1] for list items and
+  [*] for every item (giving a list). A path starting with "ips" reads the
+  IP history instead. Missing fields and out-of-range items give None, and
+  [*] over a missing list gives []
+- first(list), last(list), count(list)
+- max(list), min(list): the largest/smallest value, ignoring None
+- join(list, 'sep'): the values joined into one string (sep defaults to ", ")
+- max_by(list, key, value), min_by(list, key, value): `value` of the item
+  with the largest/smallest `key`, both paths relative to the item; the
+  first such item wins and items without a key come last
+
+ColumnSpec parses the spec once and compiles it into one Python function
+that builds a whole row. Path prefixes shared by several columns (such as
+customerClaims[0]) are looked up once per row, and each step is an inline
+dict or list access rather than a generic path walk. The spec also tells
+FetchPlan which endpoints to call: /ips only when a path reads "ips", and
+details only when the listing lacks a field the paths read.
+
+Payloads are read as plain dicts, since a spec can read any field.
+
+    python csvExport.py --column-spec columns.json
+    python archive.py transform raw.ndjson.zst --output out.csv --column-spec columns.json
+    python column_spec.py columns.json      (prints the compiled extractor)
+"""
+
+import argparse
+import json
+import re
+import sys
+
+# The spec of the standard export columns (csvExport.FIELDNAMES)
+DEFAULT_SPEC = {
+    'customer_id': 'id',
+    'name': 'customerClaims[0].name',
+    'given_name': 'customerClaims[0].givenName',
+    'family_name': 'customerClaims[0].familyName',
+    'nationality': 'customerClaims[0].nationality',
+    'country_of_residence': 'customerClaims[0].countryOfResidence',
+    'birthdate': 'customerClaims[0].birthdate',
+    'wallets': 'customerWallets[*].wallet',
+    'risk_score': 'riskScore',
+    'status': 'status',
+    'onboarding_level': 'onboardingLevel',
+    'date_onboarded': 'createdAt',
+    'email': 'customerEmails[0].email',
+    'ip_addresses': 'ips[*].ipAddress',
+    'latest_ip': 'max_by(ips, createdAt, ipAddress)',
+    'latest_ip_date': 'max_by(ips, createdAt, createdAt)',
+}
+
+# Function name: (min args, max args); the first argument is a list
+FUNCTIONS = {
+    'first': (1, 1),
+    'last': (1, 1),
+    'count': (1, 1),
+    'max': (1, 1),
+    'min': (1, 1),
+    'join': (1, 2),
+    'max_by': (3, 3),
+    'min_by': (3, 3),
+}
+
+TOKEN = re.compile(r"""
+    \s*(?:
+        (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+      | \[(?P<index>-?\d+|\*)\]
+      | (?P<string>'[^']*'|"[^"]*")
+      | (?P<punct>[.,()])
+    )""", re.VERBOSE)
+
+class Path:
+    def __init__(self, root, steps):
+        # root is 'details', 'ips' or 'item' (relative to a list item);
+        # steps are field names (str) and list indexes (int or '*')
+        self.root = root
+        self.steps = steps
+
+class Call:
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+
+def _tokenize(expression):
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = TOKEN.match(expression, position)
+        if not match:
+            raise ValueError(f"unexpected {expression[position:].strip()[:10]!r}")
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'index':
+            value = value if value == '*' else int(value)
+        elif kind == 'string':
+            value = value[1:-1]
+        tokens.append((kind, value))
+        position = match.end()
+    return tokens
+
+class _Parser:
+    def __init__(self, expression):
+        self.tokens = _tokenize(expression)
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def take(self, kind, value=None):
+        found = self.peek()
+        if found[0] != kind or (value is not None and found[1] != value):
+            expected = repr(value) if value else f"a {kind}"
+            raise ValueError(f"expected {expected}, found {found[1]!r}" if found[0] else
+                             f"expected {expected} at the end")
+        self.position += 1
+        return found[1]
+
+    def parse(self):
+        node = self.expression()
+        if self.peek()[0]:
+            raise ValueError(f"unexpected {self.peek()[1]!r}")
+        return node
+
+    def expression(self):
+        kind, value = self.peek()
+        if kind == 'name' and self.position + 1 < len(self.tokens) and self.tokens[self.position + 1] == ('punct', '('):
+            return self.call()
+        return self.path()
+
+    def call(self):
+        function = self.take('name')
+        if function not in FUNCTIONS:
+            raise ValueError(f"unknown function {function}() (expected one of {', '.join(FUNCTIONS)})")
+        self.take('punct', '(')
+        args = [self.path()]
+        while self.peek() == ('punct', ','):
+            self.take('punct', ',')
+            if function == 'join':
+                args.append(self.take('string'))
+            else:
+                args.append(self.path(relative=True))
+        self.take('punct', ')')
+
+        least, most = FUNCTIONS[function]
+        if not least <= len(args) <= most:
+            raise ValueError(f"{function}() takes {least if least == most else f'{least} to {most}'} arguments")
+        return Call(function, args)
+
+    def path(self, relative=False):
+        steps = [self.take('name')]
+        while True:
+            kind, value = self.peek()
+            if kind == 'index':
+                steps.append(self.take('index'))
+            elif (kind, value) == ('punct', '.'):
+                self.take('punct', '.')
+                steps.append(self.take('name'))
+            else:
+                break
+        if relative:
+            return Path('item', steps)
+        if steps[0] == 'ips':
+            return Path('ips', steps[1:])
+        return Path('details', steps)
+
+def parse_expression(expression):
+    """Parse one column expression into a Path or Call"""
+    return _Parser(expression).parse()
+
+class _Compiler:
+    def __init__(self):
+        self.lines = []
+        self.helpers = []
+        # Variables and helpers already generated, by path
+        self.prefixes = {}
+        self.item_functions = {}
+        self.temps = 0
+
+    def temp(self, prefix):
+        self.temps += 1
+        return f"{prefix}{self.temps}"
+
+    @staticmethod
+    def step(source, step):
+        # An expression applying one field or index step to the variable `source`
+        if isinstance(step, str):
+            return f"({source}.get({step!r}) if {source}.__class__ is dict else None)"
+        if step >= 0:
+            return f"({source}[{step}] if {source}.__class__ is list and len({source}) > {step} else None)"
+        return f"({source}[{step}] if {source}.__class__ is list and len({source}) >= {-step} else None)"
+
+    def item_function(self, steps):
+        """The name of a helper applying `steps` to one list item"""
+        if tuple(steps) in self.item_functions:
+            return self.item_functions[tuple(steps)]
+        name = f"_item{len(self.helpers)}"
+        self.item_functions[tuple(steps)] = name
+        body = [f"def {name}(v):"]
+        for position, step in enumerate(steps):
+            if step == '*':
+                inner = self.item_function(steps[position + 1:])
+                body.append(f"    return [{inner}(e) for e in v] if v.__class__ is list else []")
+                break
+            body.append(f"    v = {self.step('v', step)}")
+        else:
+            body.append("    return v")
+        self.helpers.append('\n'.join(body))
+        return name
+
+    def item_expression(self, var, steps):
+        """An expression applying relative `steps` to the list item `var`"""
+        if not steps:
+            return var
+        if len(steps) == 1 and steps[0] != '*':
+            return self.step(var, steps[0])
+        return f"{self.item_function(steps)}({var})"
+
+    def dict_view(self, source):
+        # `source` as a dict, or an empty one, checked once for all its fields
+        key = ('dict', source)
+        if key not in self.prefixes:
+            self.prefixes[key] = self.temp('d')
+            self.lines.append(f"{self.prefixes[key]} = {source} if {source}.__class__ is dict else _EMPTY")
+        return self.prefixes[key]
+
+    def path(self, path):
+        """A variable holding the value of `path`, assigning shared prefixes once"""
+        source = path.root
+        steps = path.steps
+        for position, step in enumerate(steps):
+            if step == '*':
+                key = (path.root,) + tuple(steps)
+                if key not in self.prefixes:
+                    element = self.item_expression('e', steps[position + 1:])
+                    self.prefixes[key] = self.temp('v')
+                    self.lines.append(f"{self.prefixes[key]} = [{element} for e in {source}] "
+                                      f"if {source}.__class__ is list else []")
+                return self.prefixes[key]
+
+            key = (path.root,) + tuple(steps[:position + 1])
+            if key not in self.prefixes:
+                if isinstance(step, str):
+                    expression = f"{self.dict_view(source)}.get({step!r})"
+                else:
+                    expression = self.step(source, step)
+                self.prefixes[key] = self.temp('v')
+                self.lines.append(f"{self.prefixes[key]} = {expression}")
+            source = self.prefixes[key]
+        return source
+
+    def list_of(self, path):
+        var = self.path(path)
+        if '*' in path.steps:
+            return var
+        # A path to a list without [*]: [] when it is missing or not a list
+        key = ('list', path.root) + tuple(path.steps)
+        if key not in self.prefixes:
+            self.prefixes[key] = self.temp('l')
+            self.lines.append(f"{self.prefixes[key]} = {var} if {var}.__class__ is list else []")
+        return self.prefixes[key]
+
+    def call(self, call):
+        values = self.list_of(call.args[0])
+        function = call.function
+        if function == 'first':
+            return f"({values}[0] if {values} else None)"
+        if function == 'last':
+            return f"({values}[-1] if {values} else None)"
+        if function == 'count':
+            return f"len({values})"
+        if function in ('max', 'min'):
+            return f"{function}((x for x in {values} if x is not None), default=None)"
+        if function == 'join':
+            separator = call.args[1] if len(call.args) > 1 else ', '
+            return f"{separator!r}.join(str(x) for x in {values} if x is not None)"
+
+        key_steps = tuple(call.args[1].steps)
+        picked = self.prefixes.get((function, values, key_steps))
+        if picked is None:
+            # The first item with the largest (smallest) key; items without
+            # a key only win when no item has one
+            picked = self.prefixes[(function, values, key_steps)] = self.temp('p')
+            best = self.temp('k')
+            better = '>' if function == 'max_by' else '<'
+            self.lines += [
+                f"{picked} = {values}[0] if {values} else None",
+                f"{best} = None",
+                f"for e in {values}:",
+                f"    k = {self.item_expression('e', call.args[1].steps)}",
+                f"    if k is not None and ({best} is None or k {better} {best}):",
+                f"        {picked} = e",
+                f"        {best} = k",
+            ]
+        return f"({self.item_expression(picked, call.args[2].steps)} if {picked} is not None else None)"
+
+class ColumnSpec:
+    def __init__(self, spec, path=None):
+        if not isinstance(spec, dict) or not spec:
+            raise ValueError("A column spec must be a non-empty JSON object of column: expression")
+        self.path = path
+        self.spec = dict(spec)
+        self.columns = list(spec)
+        self.detail_fields = []
+        self.needs_ips = False
+
+        compiler = _Compiler()
+        values = []
+        for column, expression in spec.items():
+            if not isinstance(expression, str):
+                raise ValueError(f"Column {column}: the expression must be a string")
+            try:
+                node = parse_expression(expression)
+            except ValueError as e:
+                raise ValueError(f"Column {column}: {e} in {expression!r}") from None
+            for source in (node.args[:1] if isinstance(node, Call) else [node]):
+                if source.root == 'ips':
+                    self.needs_ips = True
+                elif source.steps[0] not in self.detail_fields:
+                    self.detail_fields.append(source.steps[0])
+            values.append(compiler.call(node) if isinstance(node, Call) else compiler.path(node))
+
+        body = compiler.lines + ["return {" + ", ".join(
+            f"{column!r}: {value}" for column, value in zip(self.columns, values)
+        ) + "}"]
+        self.source = '\n\n'.join(compiler.helpers + [
+            "def extract(details, ips):\n" + '\n'.join(f"    {line}" for line in body)
+        ]) + '\n'
+        namespace = {'_EMPTY': {}}
+        exec(compile(self.source, f"<column spec {path or ''}>", 'exec'), namespace)
+        # extract(details, ips) builds the row of one customer from its
+        # details and IP history as plain dicts
+        self.extract = namespace['extract']
+
+def load_column_spec(path):
+    """Load and compile a JSON column spec file"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            spec = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        raise ValueError(f"Cannot read column spec {path}: {e}") from None
+    return ColumnSpec(spec, path)
+
+def main():
+    parser = argparse.ArgumentParser(description="Check a column spec and print its compiled extractor")
+    parser.add_argument("spec", nargs='?', help="JSON column spec (default: the standard export columns)")
+    args = parser.parse_args()
+
+    try:
+        spec = load_column_spec(args.spec) if args.spec else ColumnSpec(DEFAULT_SPEC)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    endpoints = "details and IPs" if spec.needs_ips else "details"
+    print(f"# {len(spec.columns)} columns from {endpoints}; detail fields read: {', '.join(spec.detail_fields)}")
+    print(spec.source)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+"""
+Shared pytest fixtures for the export script tests (python -m pytest).
+
+mock_api serves a small generated dataset (mock_server.py) on a free local
+port, with a little latency jitter so concurrent requests finish out of
+order, and no rate limit. make_exporter() returns a CompiLotExporter
+pointed at it.
+"""
+
+import pytest
+
+from mock_server import MockCompiLotAPI
+
+@pytest.fixture(scope="session")
+def mock_api():
+    api = MockCompiLotAPI(customers=300, latency=0.004, latency_jitter=0.004, latency_distribution='uniform',
+                          rate_limits=None, seed=3)
+    api.start()
+    yield api
+    api.stop()
+
+@pytest.fixture
+def make_exporter(mock_api):
+    from csvExport import CompiLotExporter
+    from rate_limiter import RateLimiter
+
+    exporters = []
+
+    def make(page_size=20, **settings):
+        exporter = CompiLotExporter(api_token='test')
+        exporter.base_url = mock_api.url
+        exporter.rate_limiter = RateLimiter(tiers=[(100000, 1)])
+        exporter.page_size = page_size
+        for name, value in settings.items():
+            setattr(exporter, name, value)
+        exporters.append(exporter)
+        return exporter
+
+    yield make
+    for exporter in exporters:
+        exporter.close()
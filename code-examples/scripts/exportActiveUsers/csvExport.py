@@ -9,11 +9,49 @@ This script exports customer data from ComPilot's API to a CSV file, including:
 - Email information
 
 Features:
-- Rate limiting to respect API constraints (15 calls/sec, 300 calls/min)
-- Pagination handling for large datasets
+- Rate limiting to respect API constraints (15 calls/sec, 300 calls/min),
+  scheduled with a thread-safe GCRA limiter that sleeps exactly until the next slot
+- Adaptive rates: 429/Retry-After and rate limit headers from the API adjust
+  the budget at runtime, and throttled calls are re-queued instead of dropped
+- Optional asyncio mode that keeps many detail/IP requests in flight at once
+- Streaming pagination: each page is fetched, exported and written as soon as
+  it arrives, so memory stays bounded regardless of the number of customers
+- In --async mode, listing pages are fetched concurrently once totalCount is
+  known, and customers repeated across shifting pages are deduplicated
 - Filters for onboarded customers only
 - Detailed error handling and progress tracking
+- Per-request timeouts, retries with exponential backoff and jitter, and a
+  circuit breaker that holds new calls back while the API keeps failing;
+  customers that still fail go to a dead-letter file
+- Checkpointed, resumable exports
+- Incremental exports that only fetch customers whose listing changed
+- Column selection: only the endpoints the selected columns need are called
+- Declarative column specs: custom columns defined as path expressions and
+  aggregations over the API payloads, compiled once into a row extractor
+- Optional on-disk response cache with per-endpoint TTLs and ETag revalidation
+- Keep-alive connection pooling with compressed responses and optional HTTP/2
+- Typed decoding of detail and IP payloads with msgspec (or orjson), which
+  skips the fields the export does not read; falls back to the json module
 - IP address history tracking with timestamps
+- Optional NDJSON output, and gzip/zstd compressed CSV/NDJSON rotated into
+  parts by row count or size, compressed in a background thread and listed
+  in a manifest
+- Optional Parquet output with list-typed wallets/IPs and typed timestamps
+- Optional SQLite output that upserts customers, wallets and IPs into
+  indexed tables, so repeated exports update one database in place
+- Change data capture: inserted, updated (with field-level diffs) and
+  removed customers since the previous run, as an NDJSON stream
+- Sharded mode: several worker processes export page ranges in parallel
+  from one shared rate budget, and their output is merged into one file
+- Sorted exports (--sort-by) with an external merge sort that spills
+  compressed sorted runs to disk, so memory stays under a fixed cap
+- Multi-tenant mode: several workspaces exported concurrently in one
+  process, each with its own API key, rate budget, connection pool and output
+- Identity linkage: customers sharing IP addresses or wallets, indexed into
+  compact arrays and clustered as the export streams (linkage.py)
+- Two-stage extract/transform: raw API responses can be archived in a
+  compressed, indexed NDJSON file, from which exports with any column
+  layout are rebuilt offline (archive.py)
 
 Output CSV Fields:
 - customer_id: Unique identifier
@@ -31,223 +69,1286 @@ Output CSV Fields:
 - latest_ip_date: Timestamp of last IP usage
 
 Usage:
-1. Set COMPILOT_API_KEY in .env file
+1. Set COMPILOT_API_KEY in .env file (COMPILOT_API_URL overrides the API
+   base URL, e.g. to point at mock_server.py)
 2. Run script: python csvExport.py
+   - Add --async to fetch customer details and IPs concurrently
+     (--concurrency controls how many customers are in flight, default 32)
+   - Progress is checkpointed to <csv>.checkpoint.sqlite; after a crash, run
+     python csvExport.py --resume <csv> to continue where it stopped
+   - Customers that could not be fetched are listed in
+     <csv>.deadletter.ndjson; python csvExport.py --redrive <csv> retries
+     just those and appends their rows (--timeout, --max-retries tune retries)
+   - Add --incremental <state.sqlite> to reuse unchanged rows from the previous
+     run that used the same state file (nightly jobs only pay for churn)
+   - Add --cache <cache.sqlite> to reuse API responses across runs
+     (--cache-ttl details=3600,ips=600 sets per-endpoint TTLs)
+   - Add --columns customer_id,risk_score,wallets to export a subset of the
+     columns below (skips /ips unless an IP column is selected)
+   - Add --column-spec columns.json to define the columns yourself, e.g.
+     {"customer_id": "id", "nationality": "customerClaims[0].nationality"}
+     (see column_spec.py for the expressions)
+   - --pool-size sets the keep-alive pool size; --http2 multiplexes --async
+     requests over HTTP/2
+   - Add --compress gzip (or zstd) to write <output>.gz; --rotate-rows N or
+     --rotate-mb MB split the output into parts listed in
+     <output>.manifest.json (--format ndjson for JSON lines)
+   - Add --format parquet for a Parquet file instead of CSV (--row-group-size
+     and --compression tune it; Parquet exports cannot be resumed)
+   - Add --cdc <cdc.sqlite> to write what changed since the previous run with
+     the same state file to <output>.cdc.ndjson (or --cdc-output FILE)
+   - Add --shards 4 to use 4 worker processes (CSV or Parquet output); the
+     per-key rate limits are shared, and --resume <output> finishes the
+     shards that did not complete
+   - Add --sort-by risk_score (or date_onboarded, ...) to sort the finished
+     export; --sort-descending reverses it and --sort-memory-mb caps the
+     memory used (python external_sort.py sorts an existing file)
+   - Add --tenants tenants.json to export several workspaces at once (see
+     tenants.py for the file format; --tenant-concurrency limits how many
+     run at the same time)
+   - Add --format sqlite to upsert into compilot_customers.sqlite (or
+     --output FILE) with customers, wallets and ips tables; customers that
+     are no longer listed are removed once an export completes
+   - Add --linkage customers.linkage to index which customers share IPs or
+     wallets; python linkage.py query customers.linkage --customer <id>
+     lists the customers linked to one (see linkage.py for more queries)
+   - Add --archive raw.ndjson.zst to also archive every raw listing, details
+     and IPs response; python archive.py transform raw.ndjson.zst --output
+     FILE --columns ... rebuilds an export from it without API calls
 3. CSV file will be generated with timestamp in filename
+4. To serve exports over HTTP instead, run python http_service.py: GET
+   /export streams CSV or NDJSON to the client as rows are produced.
+   In Python code, CompiLotExporter().iter_rows() yields the rows directly
+5. To keep a continuously refreshed local replica instead of running full
+   exports, run python sync_daemon.py --replica replica.sqlite; then
+   python sync_daemon.py --replica replica.sqlite --export out.csv exports it
+   without API calls
 
 Requirements:
 - Python 3.x
 - requests library
+- httpx (for --async mode)
 - python-dotenv
+- Optional: h2 (for --http2), brotli (for brotli-compressed responses),
+  pyarrow (for --format parquet), zstandard (for --compress zstd and zstd archives), msgspec or orjson (faster JSON decoding;
+  python schema_benchmark.py compares them)
 """
 
-import requests
+import argparse
+import asyncio
 import csv
+import hashlib
+import math
 from datetime import datetime
-import time
-from collections import deque
+from collections import deque, namedtuple
 import os
+import queue
+import sys
+import threading
+import time
+import httpx
+import requests
 from dotenv import load_dotenv
+from rate_limiter import RateLimiter
+from checkpoint import ExportCheckpoint
+from delta_state import DeltaState
+from response_cache import ResponseCache, parse_ttls
+from http_session import PoolStats, create_async_client, create_session
+from id_set import IdSet
+from column_plan import COLUMN_SOURCES, FetchPlan, parse_columns
+from column_spec import load_column_spec
+from retry_policy import CircuitBreaker, RetryPolicy
+from dead_letter import DeadLetterFile, read_dead_letters, write_dead_letters
+from sinks import PARQUET_COMPRESSIONS, SINKS, STREAM_COMPRESSIONS, CompressedSink, CsvSink, SqliteSink, format_for, \
+    sink_for
+from cdc import ChangeCapture
+from shard import export_sharded, manifest_path
+from tenants import export_tenants, load_tenants
+from schema import decode_details, decode_ips, details_row, fast_loads, ip_columns
+from external_sort import check_sortable, sort_export
+from archive import RawArchive
+from linkage import LinkageIndex, check_linkable, print_summary as print_linkage_summary
 
 # Load environment variables from .env file
 load_dotenv()
 
-class RateLimiter:
-    def __init__(self, calls_per_second=15, calls_per_minute=300):
-        self.calls_per_second = calls_per_second
-        self.calls_per_minute = calls_per_minute
-        self.second_window = deque()
-        self.minute_window = deque()
+FIELDNAMES = [
+    'customer_id', 'name', 'given_name', 'family_name', 'nationality',
+    'country_of_residence', 'birthdate', 'wallets', 'risk_score',
+    'status', 'onboarding_level', 'date_onboarded', 'email',
+    'ip_addresses', 'latest_ip', 'latest_ip_date'
+]
 
-    def wait_if_needed(self):
-        current_time = time.time()
-        
-        # Clean up old timestamps
-        while self.second_window and self.second_window[0] <= current_time - 1:
-            self.second_window.popleft()
-        while self.minute_window and self.minute_window[0] <= current_time - 60:
-            self.minute_window.popleft()
-        
-        # Check if we need to wait for rate limits
-        while (len(self.second_window) >= self.calls_per_second or 
-               len(self.minute_window) >= self.calls_per_minute):
-            time.sleep(0.1)
-            current_time = time.time()
-            
-            # Clean up old timestamps again
-            while self.second_window and self.second_window[0] <= current_time - 1:
-                self.second_window.popleft()
-            while self.minute_window and self.minute_window[0] <= current_time - 60:
-                self.minute_window.popleft()
-        
-        # Record this call
-        self.second_window.append(current_time)
-        self.minute_window.append(current_time)
+# One onboarded customer as it flows through the export pipeline. row is set
+# when the customer was served from a previous run's state instead of being
+# fetched; otherwise details is None when the customer could not be fetched,
+# and error says why
+CustomerRecord = namedtuple('CustomerRecord', ['page', 'customer', 'details', 'ips', 'row', 'error'],
+                            defaults=(None, None))
+
+class FetchError(Exception):
+    pass
 
 class CompiLotExporter:
-    def __init__(self, api_token=None):
-        self.base_url = "https://api.compilot.ai"
+    def __init__(self, api_token=None, response_cache=None):
+        api_token = api_token or os.getenv('COMPILOT_API_KEY')
+        self.base_url = os.getenv('COMPILOT_API_URL', "https://api.compilot.ai").rstrip('/')
         self.headers = {
-            "Authorization": f"Bearer {api_token or os.getenv('COMPILOT_API_KEY')}"
+            "Authorization": f"Bearer {api_token}"
         }
-        if not api_token and not os.getenv('COMPILOT_API_KEY'):
+        if not api_token:
             raise ValueError("API key must be provided either as parameter or in .env file")
+        self.api_token = api_token
         self.customers = []
+        # (customer_id, reason) of customers the last iter_rows() run skipped
+        self.skipped = []
         self.rate_limiter = RateLimiter()
+        self.page_size = 100
+        self.page_concurrency = 8
+        # Last listing page to export (None lists to the end); set per shard
+        self.end_page = None
+        self.max_throttle_retries = 8
+        # A listing page that still fails after its retries is requested
+        # again (through the circuit breaker) this many times in total
+        # before the export gives up
+        self.page_attempts = 5
+
+        # Transient failures: per-request timeout, retries with backoff, and
+        # a breaker that stops hammering an API that keeps failing
+        self.request_timeout = 30
+        self.retry_policy = RetryPolicy()
+        self.circuit_breaker = CircuitBreaker()
+        # Which columns to export, and so which endpoints to call
+        self.plan = FetchPlan()
+
+        # Keep-alive connection pools, shared by every call of a run
+        self.pool_size = 32
+        self.http2 = False
+        self.session = None
+        self.pool_stats = PoolStats()
+
+        # Optional ResponseCache; entries are scoped to this API key
+        self.response_cache = response_cache
+        self.cache_scope = hashlib.sha256(api_token.encode('utf-8')).hexdigest()[:16]
+        # Optional RawArchive that export_to_file() appends raw responses to
+        self.archive = None
+
+    def _cache_lookup(self, method, url, kwargs):
+        # Returns a cached response, or adds If-None-Match to kwargs when a
+        # stale entry can be revalidated
+        if not self.response_cache:
+            return None
+
+        cached, etag = self.response_cache.lookup(method, url, kwargs.get('params'), self.cache_scope)
+        if etag:
+            kwargs['headers'] = {**kwargs.get('headers', {}), 'If-None-Match': etag}
+        return cached
+
+    def _cache_store(self, method, url, kwargs, response):
+        if not self.response_cache:
+            return response
+
+        if response.status_code == 304:
+            return self.response_cache.revalidated(method, url, kwargs.get('params'), self.cache_scope) or response
+
+        self.response_cache.store(method, url, kwargs.get('params'), response, self.cache_scope)
+        return response
+
+    def _cache_discard(self, url, params=None):
+        if self.response_cache:
+            self.response_cache.discard("GET", url, params, self.cache_scope)
+
+    def _session(self):
+        if self.session is None:
+            self.session = create_session(self.headers, self.pool_size)
+        return self.session
+
+    def _send(self, method, url, **kwargs):
+        self.pool_stats.request_started()
+        response = None
+        try:
+            response = self._session().request(method, url, timeout=self.request_timeout, **kwargs)
+            return response
+        finally:
+            self.pool_stats.request_finished(response)
+
+    async def _send_async(self, client, method, url, **kwargs):
+        self.pool_stats.request_started()
+        response = None
+        try:
+            response = await client.request(method, url, timeout=self.request_timeout,
+                                            extensions={'trace': self.pool_stats.trace}, **kwargs)
+            return response
+        finally:
+            self.pool_stats.request_finished(response)
+
+    def close(self):
+        """Close the connection pool, adding its connection counts to pool_stats"""
+        if self.session is not None:
+            self.pool_stats.collect_session(self.session)
+            self.session.close()
+            self.session = None
+
+    def _retry_delay(self, url, response, error, retries):
+        # Seconds to wait before retrying a failed attempt, or None to give up
+        if retries >= self.retry_policy.max_retries:
+            return None
+        delay = self.retry_policy.backoff(retries + 1)
+        reason = f"HTTP {response.status_code}" if response is not None else type(error).__name__
+        print(f"{reason} on {url}, retrying in {delay:.1f}s")
+        return delay
 
     def make_api_call(self, method, url, **kwargs):
-        """Make an API call with rate limiting"""
-        self.rate_limiter.wait_if_needed()
-        response = requests.request(method, url, **kwargs)
+        """
+        Make an API call with rate limiting, re-queueing throttled calls and
+        retrying timeouts, connection errors and 5xx responses with backoff.
+
+        Raises the last transport error once retries are exhausted. While
+        the circuit breaker is open, the call waits for it to close.
+        """
+        cached = self._cache_lookup(method, url, kwargs)
+        if cached:
+            return cached
+
+        # The breaker counts whole calls: retries of a call do not pass it again
+        self.circuit_breaker.before_call()
+        failed = True
+        try:
+            response = self._call_with_retries(method, url, **kwargs)
+            failed = self.retry_policy.is_retryable(response.status_code)
+        finally:
+            if failed:
+                self.circuit_breaker.record_failure()
+            else:
+                self.circuit_breaker.record_success()
+        return self._cache_store(method, url, kwargs, response)
+
+    def _call_with_retries(self, method, url, **kwargs):
+        throttles = retries = 0
+        while True:
+            self.rate_limiter.acquire()
+            try:
+                response = self._send(method, url, **kwargs)
+            except requests.RequestException as e:
+                delay = self._retry_delay(url, None, e, retries)
+                if delay is None:
+                    raise
+                retries += 1
+                time.sleep(delay)
+                continue
+
+            self.rate_limiter.update_from_response(response.status_code, response.headers)
+            if self.rate_limiter.is_throttled(response.status_code, response.headers):
+                throttles += 1
+                if throttles > self.max_throttle_retries:
+                    break
+                print(f"Throttled on {url} ({response.status_code}), re-queueing")
+                continue
+
+            if self.retry_policy.is_retryable(response.status_code):
+                delay = self._retry_delay(url, response, None, retries)
+                if delay is None:
+                    break
+                retries += 1
+                time.sleep(delay)
+                continue
+
+            break
+        return response
+
+    async def make_api_call_async(self, client, method, url, **kwargs):
+        """Make an API call with rate limiting and retries on a shared httpx.AsyncClient"""
+        cached = self._cache_lookup(method, url, kwargs)
+        if cached:
+            return cached
+
+        await self.circuit_breaker.before_call_async()
+        failed = True
+        try:
+            response = await self._call_with_retries_async(client, method, url, **kwargs)
+            failed = self.retry_policy.is_retryable(response.status_code)
+        finally:
+            if failed:
+                self.circuit_breaker.record_failure()
+            else:
+                self.circuit_breaker.record_success()
+        return self._cache_store(method, url, kwargs, response)
+
+    async def _call_with_retries_async(self, client, method, url, **kwargs):
+        throttles = retries = 0
+        while True:
+            await self.rate_limiter.acquire_async()
+            try:
+                response = await self._send_async(client, method, url, **kwargs)
+            except httpx.TransportError as e:
+                delay = self._retry_delay(url, None, e, retries)
+                if delay is None:
+                    raise
+                retries += 1
+                await asyncio.sleep(delay)
+                continue
+
+            self.rate_limiter.update_from_response(response.status_code, response.headers)
+            if self.rate_limiter.is_throttled(response.status_code, response.headers):
+                throttles += 1
+                if throttles > self.max_throttle_retries:
+                    break
+                print(f"Throttled on {url} ({response.status_code}), re-queueing")
+                continue
+
+            if self.retry_policy.is_retryable(response.status_code):
+                delay = self._retry_delay(url, response, None, retries)
+                if delay is None:
+                    break
+                retries += 1
+                await asyncio.sleep(delay)
+                continue
+
+            break
         return response
 
     def get_all_customers(self):
         """Fetch all customers using pagination"""
-        current_page = 1
-        limit = 100
-        total_processed = 0
+        self.customers.extend(self.iter_customers())
+
+    def iter_customer_pages(self, start_page=1):
+        """Yield (page, onboarded customers) for each page as soon as it arrives"""
+        current_page = start_page
+        total_processed = (start_page - 1) * self.page_size
+        seen = IdSet()
         
         while True:
-            response = self.make_api_call(
-                "GET",
-                f"{self.base_url}/customers",
-                params={"currentPage": current_page, "limit": limit},
-                headers=self.headers
-            )
-            
-            if response.status_code != 200:
-                raise Exception(f"Failed to fetch customers: {response.status_code}")
-            
-            data = response.json()
-            
-            # Filter only Onboarded customers
-            onboarded_customers = [
-                customer for customer in data["data"] 
-                if customer["onboarding_level"] == "Onboarded"
-            ]
-            self.customers.extend(onboarded_customers)
+            data = self.fetch_page(current_page)
+            yield current_page, self._onboarded(data, seen)
             
             total_processed += len(data["data"])
             print(f"Processed {total_processed} customers out of {data['totalCount']}")
             
-            if total_processed >= data["totalCount"]:
+            if total_processed >= data["totalCount"] or not data["data"] or current_page == self.end_page:
                 break
                 
             current_page += 1
 
+    def iter_customers(self):
+        """Yield onboarded customers one at a time, page by page"""
+        for page, customers in self.iter_customer_pages():
+            yield from customers
+
+    @staticmethod
+    def _onboarded(data, seen):
+        # Filter only Onboarded customers. Offsets shift when customers are
+        # added during the scan, so the same customer can show up on two
+        # consecutive pages; `seen` drops the repeat
+        return [
+            customer for customer in data["data"]
+            if customer["onboarding_level"] == "Onboarded" and seen.add(customer["id"])
+        ]
+
+    def _archive_response(self, kind, key, response):
+        if self.archive and response.status_code == 200:
+            self.archive.append(kind, key, response.content)
+
+    def _fetch_json(self, what, url, decode=fast_loads, archive_key=None):
+        # Raises FetchError describing why `what` could not be fetched
+        try:
+            response = self.make_api_call("GET", url, headers=self.headers)
+        except requests.RequestException as e:
+            raise FetchError(f"{what}: {type(e).__name__} {e}".strip()) from e
+
+        if response.status_code != 200:
+            raise FetchError(f"{what}: HTTP {response.status_code}")
+        try:
+            data = decode(response.content)
+        except ValueError as e:
+            # Malformed JSON, or (msgspec) a payload that does not match its Struct
+            self._cache_discard(url)
+            raise FetchError(f"{what}: invalid response ({type(e).__name__} {e})") from e
+        if archive_key is not None:
+            self._archive_response(what.lower(), archive_key, response)
+        return data
+
+    async def _fetch_json_async(self, client, what, url, decode=fast_loads, archive_key=None):
+        try:
+            response = await self.make_api_call_async(client, "GET", url)
+        except httpx.TransportError as e:
+            raise FetchError(f"{what}: {type(e).__name__} {e}".strip()) from e
+
+        if response.status_code != 200:
+            raise FetchError(f"{what}: HTTP {response.status_code}")
+        try:
+            data = decode(response.content)
+        except ValueError as e:
+            self._cache_discard(url)
+            raise FetchError(f"{what}: invalid response ({type(e).__name__} {e})") from e
+        if archive_key is not None:
+            self._archive_response(what.lower(), archive_key, response)
+        return data
+
     def get_customer_details(self, customer_id):
         """Fetch detailed information for a specific customer"""
-        response = self.make_api_call(
-            "GET",
-            f"{self.base_url}/customers/{customer_id}",
-            headers=self.headers
-        )
-        
-        if response.status_code != 200:
-            print(f"Failed to fetch details for customer {customer_id}")
+        try:
+            return self._fetch_json("details", f"{self.base_url}/customers/{customer_id}")
+        except FetchError as e:
+            print(f"Failed to fetch details for customer {customer_id} ({e})")
             return None
-            
-        return response.json()
 
     def get_customer_ips(self, customer_id):
         """Fetch IP information for a specific customer"""
-        response = self.make_api_call(
-            "GET",
-            f"{self.base_url}/customers/{customer_id}/ips",
-            headers=self.headers
-        )
-        
-        if response.status_code != 200:
-            print(f"Failed to fetch IP details for customer {customer_id}")
+        try:
+            return self._fetch_json("IPs", f"{self.base_url}/customers/{customer_id}/ips")
+        except FetchError as e:
+            print(f"Failed to fetch IP details for customer {customer_id} ({e})")
             return []
-        
-        return response.json()
-
-    def export_to_csv(self, filename):
-        """Export customer data to CSV file"""
-        fieldnames = [
-            'customer_id', 'name', 'given_name', 'family_name', 'nationality',
-            'country_of_residence', 'birthdate', 'wallets', 'risk_score',
-            'status', 'onboarding_level', 'date_onboarded', 'email',
-            'ip_addresses', 'latest_ip', 'latest_ip_date'  # New fields
-        ]
 
-        with open(filename, 'w', newline='', encoding='utf-8') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
-            
-            total_customers = len(self.customers)
-            for index, customer in enumerate(self.customers, 1):
-                details = self.get_customer_details(customer['id'])
-                if not details:
+    async def get_customer_details_async(self, client, customer_id):
+        """Async variant of get_customer_details"""
+        try:
+            return await self._fetch_json_async(client, "details", f"{self.base_url}/customers/{customer_id}")
+        except FetchError as e:
+            print(f"Failed to fetch details for customer {customer_id} ({e})")
+            return None
+
+    async def get_customer_ips_async(self, client, customer_id):
+        """Async variant of get_customer_ips"""
+        try:
+            return await self._fetch_json_async(client, "IPs", f"{self.base_url}/customers/{customer_id}/ips")
+        except FetchError as e:
+            print(f"Failed to fetch IP details for customer {customer_id} ({e})")
+            return []
+
+    def _decoders(self):
+        # A column spec can read any field, so it gets whole payloads as dicts
+        if self.plan.spec is not None:
+            return fast_loads, fast_loads
+        return decode_details, decode_ips
+
+    def fetch_customer(self, customer):
+        """
+        Fetch what the plan needs for one customer as (details, ips).
+
+        Unlike get_customer_details/get_customer_ips, a failure of either
+        call raises FetchError, so the customer is dead-lettered rather than
+        exported with missing IPs.
+        """
+        decode_details, decode_ips = self._decoders()
+        details = self.plan.listing_details(customer)
+        if details is None:
+            details = self._fetch_json("details", f"{self.base_url}/customers/{customer['id']}", decode_details,
+                                       customer['id'])
+        ips = []
+        if self.plan.needs_ips:
+            ips = self._fetch_json("IPs", f"{self.base_url}/customers/{customer['id']}/ips", decode_ips,
+                                   customer['id'])
+        return details, ips
+
+    async def fetch_customer_async(self, client, customer):
+        """Async variant of fetch_customer, with both requests in flight"""
+        decode_details, decode_ips = self._decoders()
+        details = self.plan.listing_details(customer)
+        details_url = f"{self.base_url}/customers/{customer['id']}"
+        ips_url = f"{self.base_url}/customers/{customer['id']}/ips"
+        customer_id = customer['id']
+        if details is None and self.plan.needs_ips:
+            return await asyncio.gather(
+                self._fetch_json_async(client, "details", details_url, decode_details, customer_id),
+                self._fetch_json_async(client, "IPs", ips_url, decode_ips, customer_id)
+            )
+        if details is None:
+            return await self._fetch_json_async(client, "details", details_url, decode_details, customer_id), []
+        if self.plan.needs_ips:
+            return details, await self._fetch_json_async(client, "IPs", ips_url, decode_ips, customer_id)
+        return details, []
+
+    @staticmethod
+    def build_row(details, ips):
+        """Build a CSV row from customer details and IP history"""
+        # Details and IPs are typed structs or plain dicts, depending on the
+        # decoder (see schema.py)
+        row = details_row(details)
+        row['ip_addresses'], row['latest_ip'], row['latest_ip_date'] = ip_columns(ips)
+        return row
+
+    def _page_failed(self, page, attempt, error):
+        # Whether to request a failed listing page again
+        if attempt >= self.page_attempts:
+            return False
+        print(f"Listing page {page} failed ({error}), requesting it again")
+        return True
+
+    def fetch_page(self, page):
+        """
+        The decoded listing page `page`. A page is requested again while the
+        API keeps failing (the circuit breaker spaces the attempts out);
+        after page_attempts failed requests, the export is aborted.
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                response = self.make_api_call(
+                    "GET",
+                    f"{self.base_url}/customers",
+                    params={"currentPage": page, "limit": self.page_size},
+                    headers=self.headers
+                )
+            except requests.RequestException as e:
+                if self._page_failed(page, attempt, f"{type(e).__name__} {e}".strip()):
                     continue
+                raise Exception(f"Failed to fetch customers: {type(e).__name__} {e}".strip()) from e
 
-                # Extract customer claims
-                claims = details.get('customerClaims', [])
-                claim = claims[0] if claims else {}
+            if response.status_code == 200:
+                try:
+                    data = fast_loads(response.content)
+                except ValueError as e:
+                    self._cache_discard(f"{self.base_url}/customers",
+                                        {"currentPage": page, "limit": self.page_size})
+                    if self._page_failed(page, attempt, f"invalid response: {e}"):
+                        continue
+                    raise Exception(f"Failed to fetch customers: invalid response ({e})") from e
+                self._archive_response('list', page, response)
+                return data
+            if not self.retry_policy.is_retryable(response.status_code) or \
+                    not self._page_failed(page, attempt, f"HTTP {response.status_code}"):
+                raise Exception(f"Failed to fetch customers: {response.status_code}")
 
-                # Extract customer emails
-                emails = details.get('customerEmails', [])
-                email = emails[0].get('email') if emails else None
+    async def _fetch_page_async(self, client, page):
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                response = await self.make_api_call_async(
+                    client,
+                    "GET",
+                    f"{self.base_url}/customers",
+                    params={"currentPage": page, "limit": self.page_size}
+                )
+            except httpx.TransportError as e:
+                if self._page_failed(page, attempt, f"{type(e).__name__} {e}".strip()):
+                    continue
+                raise Exception(f"Failed to fetch customers: {type(e).__name__} {e}".strip()) from e
 
-                # Extract wallets
-                wallets = [w.get('wallet') for w in details.get('customerWallets', [])]
+            if response.status_code == 200:
+                try:
+                    data = fast_loads(response.content)
+                except ValueError as e:
+                    self._cache_discard(f"{self.base_url}/customers",
+                                        {"currentPage": page, "limit": self.page_size})
+                    if self._page_failed(page, attempt, f"invalid response: {e}"):
+                        continue
+                    raise Exception(f"Failed to fetch customers: invalid response ({e})") from e
+                self._archive_response('list', page, response)
+                return data
+            if not self.retry_policy.is_retryable(response.status_code) or \
+                    not self._page_failed(page, attempt, f"HTTP {response.status_code}"):
+                raise Exception(f"Failed to fetch customers: {response.status_code}")
 
-                # Get IP information
-                ips = self.get_customer_ips(customer['id'])
-                ip_addresses = [ip.get('ipAddress') for ip in ips]
-                
-                # Get the latest IP and its date
-                latest_ip = None
-                latest_ip_date = None
-                if ips:
-                    # Sort IPs by creation date in descending order
-                    sorted_ips = sorted(ips, key=lambda x: x.get('createdAt', ''), reverse=True)
-                    latest_ip = sorted_ips[0].get('ipAddress')
-                    latest_ip_date = sorted_ips[0].get('createdAt')
-
-                row = {
-                    'customer_id': details.get('id'),
-                    'name': claim.get('name'),
-                    'given_name': claim.get('givenName'),
-                    'family_name': claim.get('familyName'),
-                    'nationality': claim.get('nationality'),
-                    'country_of_residence': claim.get('countryOfResidence'),
-                    'birthdate': claim.get('birthdate'),
-                    'wallets': ', '.join(wallets) if wallets else '',
-                    'risk_score': details.get('riskScore'),
-                    'status': details.get('status'),  # This already includes Active/Rejected status
-                    'onboarding_level': details.get('onboardingLevel'),
-                    'date_onboarded': details.get('createdAt'),
-                    'email': email,
-                    'ip_addresses': ', '.join(ip_addresses) if ip_addresses else '',
-                    'latest_ip': latest_ip,
-                    'latest_ip_date': latest_ip_date
-                }
-                writer.writerow(row)
-                
-                if index % 10 == 0:
-                    print(f"Processed {index}/{total_customers} customers")
+    async def iter_customer_pages_async(self, client, start_page=1):
+        """
+        Async variant of iter_customer_pages.
+
+        The first page tells us totalCount, after which the remaining pages
+        are requested up to `page_concurrency` at a time (the rate limiter
+        still paces them) and yielded in page order.
+        """
+        seen = IdSet()
+        data = await self._fetch_page_async(client, start_page)
+        yield start_page, self._onboarded(data, seen)
+
+        total_processed = (start_page - 1) * self.page_size + len(data["data"])
+        total_count = data["totalCount"]
+        print(f"Processed {total_processed} customers out of {total_count}")
+        if total_processed >= total_count or not data["data"] or start_page == self.end_page:
+            return
+
+        last_page = math.ceil(total_count / self.page_size)
+        if self.end_page:
+            last_page = min(last_page, self.end_page)
+        next_page = start_page + 1
+        pending = deque()
+        try:
+            while True:
+                while next_page <= last_page and len(pending) < self.page_concurrency:
+                    pending.append((next_page, asyncio.create_task(self._fetch_page_async(client, next_page))))
+                    next_page += 1
+
+                if not pending:
+                    break
+
+                page, task = pending.popleft()
+                data = await task
+                yield page, self._onboarded(data, seen)
+
+                total_processed += len(data["data"])
+                print(f"Processed {total_processed} customers out of {data['totalCount']}")
+
+                if not data["data"]:
+                    break
+                # Customers added during the scan push the listing onto extra pages
+                last_page = max(last_page, math.ceil(data["totalCount"] / self.page_size))
+                if self.end_page:
+                    last_page = min(last_page, self.end_page)
+        finally:
+            for page, task in pending:
+                task.cancel()
+
+    async def _list_customers_async(self, client, customers, start_page, skip_ids, source=None):
+        # Producer for iter_records_async: feeds (page, customer) into a
+        # bounded queue, so listing never runs far ahead of the fetches.
+        # None marks the end of the listing, an exception a failed listing.
+        # With `source`, its (page, customer) pairs are used instead of listing
+        try:
+            if source is not None:
+                for item in source:
+                    await customers.put(item)
+            else:
+                async for page, page_customers in self.iter_customer_pages_async(client, start_page):
+                    for customer in page_customers:
+                        if customer['id'] not in skip_ids:
+                            await customers.put((page, customer))
+        except Exception as e:
+            await customers.put(e)
+        else:
+            await customers.put(None)
+
+    async def iter_records_async(self, client, concurrency=32, start_page=1, skip_ids=(), cached_row=None,
+                                 source=None):
+        """
+        Yield a CustomerRecord for every onboarded customer, in listing order.
+
+        Pages are listed while earlier customers are still being fetched, and
+        up to `concurrency` customers are in flight at once.
+        """
+        customers = asyncio.Queue(maxsize=concurrency)
+        producer = asyncio.create_task(
+            self._list_customers_async(client, customers, start_page, skip_ids, source)
+        )
+        pending = deque()
+        listing_done = False
+
+        try:
+            while True:
+                # Top up the window of in-flight customers without blocking
+                # on the listing while there is already work to wait for
+                while not listing_done and len(pending) < concurrency:
+                    if pending:
+                        try:
+                            customer = customers.get_nowait()
+                        except asyncio.QueueEmpty:
+                            break
+                    else:
+                        customer = await customers.get()
+
+                    if customer is None:
+                        listing_done = True
+                    elif isinstance(customer, Exception):
+                        raise customer
+                    else:
+                        page, customer = customer
+                        row = cached_row(customer) if cached_row else None
+                        task = None if row else asyncio.create_task(self.fetch_customer_async(client, customer))
+                        pending.append((page, customer, task, row))
+
+                if not pending:
+                    break
+
+                # Rows are always produced in listing order, regardless of
+                # the order in which the fetches complete
+                page, customer, task, row = pending.popleft()
+                if row:
+                    yield CustomerRecord(page, customer, None, None, row)
+                    continue
+
+                try:
+                    details, ips = await task
+                except FetchError as e:
+                    print(f"Failed to fetch customer {customer['id']} ({e})")
+                    yield CustomerRecord(page, customer, None, [], error=str(e))
+                    continue
+                yield CustomerRecord(page, customer, details, ips)
+        finally:
+            producer.cancel()
+            for page, customer, task, row in pending:
+                if task:
+                    task.cancel()
+
+    async def _records_async(self, concurrency, start_page, skip_ids, cached_row, source):
+        # Each customer needs two requests, so size the pool for both
+        pool_size = max(self.pool_size, concurrency * 2)
+
+        async with create_async_client(self.headers, pool_size, self.http2) as client:
+            async for record in self.iter_records_async(client, concurrency, start_page, skip_ids, cached_row,
+                                                        source):
+                yield record
+
+    def _iter_from_async(self, make_agen, buffer=256):
+        """Run an async generator on a background event loop and yield its items"""
+        items = queue.Queue(maxsize=buffer)
+        stop = threading.Event()
+
+        async def pump():
+            agen = make_agen()
+            try:
+                async for item in agen:
+                    if stop.is_set():
+                        break
+                    # Block a worker thread rather than the event loop while
+                    # the consumer catches up
+                    await asyncio.to_thread(items.put, (True, item))
+            finally:
+                await agen.aclose()
+
+        def run():
+            try:
+                asyncio.run(pump())
+            except BaseException as e:
+                items.put((False, e))
+            else:
+                items.put((False, None))
+
+        # Named after the consuming thread, so its output is attributed to the same tenant
+        thread = threading.Thread(target=run, name=f"{threading.current_thread().name}/async", daemon=True)
+        thread.start()
+        try:
+            while True:
+                ok, item = items.get()
+                if not ok:
+                    if item is not None:
+                        raise item
+                    break
+                yield item
+        finally:
+            stop.set()
+            # Unblock the producer if it is waiting on a full queue
+            while thread.is_alive():
+                try:
+                    items.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+    def iter_records(self, concurrency=None, start_page=1, skip_ids=(), cached_row=None, source=None):
+        """
+        Yield a CustomerRecord for every onboarded customer, in listing order.
+
+        Customers are streamed page by page, so nothing is accumulated in
+        memory. With `concurrency` set, the asyncio engine fetches that many
+        customers at once on a background event loop. Listing starts at
+        `start_page` and customers in `skip_ids` are not fetched. When
+        `cached_row(customer)` returns a row, it is used instead of fetching.
+        `source`, an iterable of (page, customer) pairs, replaces the listing.
+        """
+        if concurrency:
+            yield from self._iter_from_async(
+                lambda: self._records_async(concurrency, start_page, skip_ids, cached_row, source)
+            )
+            return
+
+        if source is None:
+            source = (
+                (page, customer)
+                for page, customers in self.iter_customer_pages(start_page)
+                for customer in customers
+                if customer['id'] not in skip_ids
+            )
+
+        for page, customer in source:
+            row = cached_row(customer) if cached_row else None
+            if row:
+                yield CustomerRecord(page, customer, None, None, row)
+                continue
+
+            try:
+                details, ips = self.fetch_customer(customer)
+            except FetchError as e:
+                print(f"Failed to fetch customer {customer['id']} ({e})")
+                yield CustomerRecord(page, customer, None, [], error=str(e))
+                continue
+            yield CustomerRecord(page, customer, details, ips)
+
+    def record_row(self, record):
+        """The CSV row for a record, or None if the customer could not be fetched"""
+        if record.row:
+            return record.row
+        if record.details:
+            if self.plan.spec is not None:
+                return self.plan.spec.extract(record.details, record.ips)
+            return self.build_row(record.details, record.ips)
+        return None
+
+    def iter_rows(self, concurrency=None, columns=None):
+        """
+        Yield a row dict for every onboarded customer that could be fetched.
+
+        This is the entry point for using the exporter as a library: rows are
+        produced as customers are fetched and nothing is written to disk.
+        With `columns`, only those columns are fetched and yielded.
+        Customers that could not be fetched are skipped; they are listed in
+        self.skipped as (customer_id, reason) pairs.
+        """
+        if columns is not None:
+            self.plan = FetchPlan(columns)
+        self.skipped = []
+        for record in self.iter_records(concurrency):
+            row = self.record_row(record)
+            if row:
+                yield row if self.plan.complete else {column: row.get(column) for column in self.plan.columns}
+            else:
+                self.skipped.append((record.customer['id'], record.error or "details unavailable"))
+
+    def export_to_csv(self, filename, concurrency=None, resume=False, commit_every=100, delta=None):
+        """Export customer data to CSV file, streaming rows as customers are fetched"""
+        return self.export_to_file(filename, 'csv', concurrency=concurrency, resume=resume,
+                                   commit_every=commit_every, delta=delta)
+
+    def export_to_file(self, filename, output_format='csv', concurrency=None, resume=False, commit_every=100,
+                       delta=None, sink_options=None, cdc=None, start_page=1, linkage=None):
+        """
+        Export customer data to `filename` through the sink for
+        `output_format` (see sinks.SINKS), streaming rows as customers are
+        fetched. `sink_options` are passed to the sink, e.g. row_group_size
+        and compression for Parquet, or compress and rotate_rows for a
+        compressed, rotated CSV/NDJSON export (see sinks.sink_for).
+
+        Listing starts at `start_page` and stops after self.end_page, if set.
+        Progress is checkpointed next to the file every page (and every
+        `commit_every` customers). With resume=True an interrupted CSV
+        export of `filename` continues where its last checkpoint left off.
+
+        With a DeltaState as `delta`, customers whose listing entry did not
+        change since the previous run are taken from the state instead of
+        being fetched again, and the state is updated with this run's rows.
+
+        With a ChangeCapture as `cdc`, every row is compared with the
+        previous run's and inserts, updates and deletes are written to its
+        NDJSON change stream.
+
+        With a RawArchive as self.archive, the raw listing, details and IPs
+        responses of the run are appended to it as they arrive.
+
+        With a LinkageIndex as `linkage`, the wallets and IPs of every
+        exported row are added to it.
+
+        Customers that still fail after retries are written to the
+        dead-letter file <file>.deadletter.ndjson, for redrive().
+        """
+        sink_class = sink_for(output_format, sink_options)
+        if resume and not sink_class.resumable:
+            raise ValueError(f"{output_format} exports with these options cannot be resumed; start a new export")
+
+        if resume:
+            checkpoint = ExportCheckpoint.open(filename)
+            self.page_size = checkpoint.page_size
+            if self.plan.spec is not None:
+                if checkpoint.columns and checkpoint.columns != self.plan.columns:
+                    raise ValueError(f"{filename} was exported with other columns than this column spec")
+            elif checkpoint.columns:
+                if not set(checkpoint.columns) <= set(COLUMN_SOURCES):
+                    raise ValueError(f"{filename} was exported with a column spec; pass the same "
+                                     f"--column-spec to resume it")
+                self.plan = FetchPlan(checkpoint.columns)
+            start_page = checkpoint.start_page()
+            skip_ids = checkpoint.written_ids(start_page)
+            # Rows written after the last checkpoint are dropped and re-fetched
+            sink_class.discard_after(filename, checkpoint.csv_offset)
+            print(f"Resuming {filename} from page {start_page} "
+                  f"({len(skip_ids)} customers of that page already exported)")
+        else:
+            checkpoint = ExportCheckpoint.create(filename, self.page_size, self.plan.columns)
+            checkpoint.page_reached(start_page)
+            skip_ids = set()
+
+        cached_row = None
+        if delta:
+            delta.begin_run(resume=resume, columns=self.plan.columns)
+            cached_row = delta.cached_row
+
+        if cdc:
+            cdc.begin_run(resume=resume)
+
+        if self.archive:
+            self.archive.begin_run(resume=resume)
+
+        dead_letter = DeadLetterFile(DeadLetterFile.path_for(filename), append=resume)
+
+        sink = sink_class(filename, self.plan.columns, append=resume, **(sink_options or {}))
+        try:
+            def commit():
+                # The delta state and dead letters go first: a row they
+                # remember but the checkpoint does not is simply handled
+                # again on resume
+                if delta:
+                    delta.commit()
+                if cdc:
+                    cdc.commit()
+                if self.archive:
+                    self.archive.flush()
+                dead_letter.flush()
+                checkpoint.commit(sink)
+
+            if not resume:
+                commit()
+
+            index = 0
+            current_page = start_page
+            for record in self.iter_records(concurrency, start_page, skip_ids, cached_row):
+                if record.page != current_page:
+                    # Every customer of the previous pages has been handled
+                    checkpoint.page_reached(record.page)
+                    commit()
+                    current_page = record.page
+
+                row = self.record_row(record)
+                if row:
+                    sink.write(row)
+                    checkpoint.record_written(record.customer['id'], record.page)
+                    if delta and not record.row:
+                        delta.update(record.customer, row)
+                    if cdc:
+                        cdc.observe(row)
+                    if linkage:
+                        linkage.add_row(row)
+                    index += 1
+
+                    if index % 10 == 0:
+                        print(f"Exported {index} customers")
+                else:
+                    reason = record.error or "details unavailable"
+                    dead_letter.add(record.customer, record.page, reason)
+                    if cdc:
+                        cdc.carry_over(record.customer['id'])
+                    checkpoint.record_failed(record.customer['id'], record.page, reason)
+
+                if checkpoint.pending_rows >= commit_every:
+                    commit()
+
+            if delta:
+                delta.commit()
+            if cdc:
+                cdc.finish()
+            if self.archive:
+                self.archive.finish_run()
+            dead_letter.flush()
+            if sink_class is SqliteSink and start_page == 1 and self.end_page is None:
+                # Every listed customer was written or dead-lettered, so the
+                # database's other customers are no longer listed
+                removed = sink.remove_unlisted(checkpoint.failed_ids())
+                if removed:
+                    print(f"Removed {removed} customers that are no longer listed from {filename}")
+            checkpoint.commit(sink)
+        finally:
+            sink.close()
+
+        if delta:
+            removed = delta.finish()
+            print(f"Incremental export: {delta.hits} customers unchanged, {delta.misses} fetched, "
+                  f"{removed} no longer listed")
+        if cdc:
+            print(f"Changes since the previous run: {cdc.summary()} (written to {cdc.output_path})")
+
+        # Customers that failed and then succeeded on resume are dropped
+        failed = checkpoint.failed_ids()
+        dead_letter.close(keep_ids=set(failed))
+        if failed:
+            print(f"{len(failed)} customers could not be fetched; they are listed in {dead_letter.path}. "
+                  f"Run python csvExport.py --redrive {filename} to retry them")
+        checkpoint.close(remove=True)
+        return index
+
+    def redrive(self, filename, concurrency=None):
+        """
+        Retry the customers in the dead-letter file of `filename`, appending
+        the rows that can now be fetched to the CSV.
+
+        Customers that fail again stay in the dead-letter file, which is
+        removed once it is empty. Returns the number of rows appended.
+        """
+        if format_for(filename) != 'csv' or os.path.exists(CompressedSink.manifest_path(filename)):
+            raise ValueError("Only uncompressed CSV exports can be redriven, since rows are appended in place")
+
+        path = DeadLetterFile.path_for(filename)
+        entries = read_dead_letters(path)
+        if not entries:
+            print(f"Nothing to redrive for {filename} ({path} is empty or missing)")
+            return 0
+
+        with open(filename, 'r', newline='', encoding='utf-8') as csvfile:
+            reader = csv.reader(csvfile)
+            columns = next(reader, None)
+            if not columns:
+                raise ValueError(f"{filename} has no CSV header")
+            # A crash during a previous redrive can leave rows that were
+            # appended but are still dead-lettered
+            exported = IdSet()
+            if 'customer_id' in columns:
+                position = columns.index('customer_id')
+                for values in reader:
+                    if len(values) > position:
+                        exported.add(values[position])
+
+        self.plan = FetchPlan(columns)
+        by_id = {entry['customer_id']: entry for entry in entries}
+        source = [(entry['page'], entry['customer']) for entry in entries if entry['customer_id'] not in exported]
+        print(f"Redriving {len(source)} dead-lettered customers into {filename}")
+
+        handled = set()
+        remaining = []
+        index = 0
+        sink = CsvSink(filename, columns, append=True)
+        try:
+            for record in self.iter_records(concurrency, source=source):
+                entry = by_id[record.customer['id']]
+                handled.add(entry['customer_id'])
+                row = self.record_row(record)
+                if row:
+                    sink.write(row)
+                    index += 1
+                else:
+                    remaining.append(dict(entry, reason=record.error or entry['reason'],
+                                          attempts=entry.get('attempts', 1) + 1))
+        finally:
+            sink.sync()
+            sink.close()
+            # Customers not reached (if the redrive was interrupted) stay dead-lettered
+            write_dead_letters(path, remaining + [
+                entry for entry in entries
+                if entry['customer_id'] not in handled and entry['customer_id'] not in exported
+            ])
+
+        print(f"Redrive appended {index} rows; {len(remaining)} customers still failing")
+        return index
+
+    def export_to_csv_async(self, filename, concurrency=32):
+        """Export customer data to CSV file, fetching up to `concurrency` customers at once"""
+        return self.export_to_csv(filename, concurrency=concurrency)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Export ComPilot customers to CSV")
+    parser.add_argument("--async", dest="async_mode", action="store_true",
+                        help="fetch customer details and IPs concurrently")
+    parser.add_argument("--concurrency", type=int, default=32,
+                        help="customers in flight at once in --async mode (default: 32)")
+    parser.add_argument("--page-concurrency", type=int, default=8,
+                        help="listing pages requested at once in --async mode (default: 8)")
+    parser.add_argument("--columns", metavar="COLUMNS",
+                        help="comma-separated columns to export, e.g. customer_id,risk_score,wallets "
+                             "(default: all); endpoints no selected column needs are not called")
+    parser.add_argument("--column-spec", metavar="SPEC_FILE",
+                        help="JSON file mapping output columns to payload expressions (see column_spec.py)")
+    parser.add_argument("--format", choices=sorted(SINKS), default="csv",
+                        help="output format (default: csv); parquet needs the pyarrow package")
+    parser.add_argument("--output", metavar="FILE",
+                        help="output file (default: a timestamped file, or compilot_customers.sqlite "
+                             "for --format sqlite so repeated exports update it in place)")
+    parser.add_argument("--row-group-size", type=int, default=10000,
+                        help="rows per Parquet row group (default: 10000)")
+    parser.add_argument("--compression", choices=PARQUET_COMPRESSIONS, default="zstd",
+                        help="Parquet compression codec (default: zstd)")
+    parser.add_argument("--compress", choices=STREAM_COMPRESSIONS,
+                        help="compress CSV/NDJSON output in a background thread (zstd needs the zstandard "
+                             "package); cannot be resumed")
+    parser.add_argument("--compress-level", type=int,
+                        help="compression level (default: 6 for gzip, 3 for zstd)")
+    parser.add_argument("--rotate-rows", type=int, metavar="N",
+                        help="start a new CSV/NDJSON part every N rows; parts are listed in <output>.manifest.json")
+    parser.add_argument("--rotate-mb", type=int, metavar="MB",
+                        help="start a new CSV/NDJSON part once the current one reaches about MB megabytes")
+    parser.add_argument("--sort-by", choices=FIELDNAMES, metavar="COLUMN",
+                        help="sort the finished export by COLUMN, e.g. risk_score or date_onboarded "
+                             "(CSV and Parquet; rows without a value come last)")
+    parser.add_argument("--sort-descending", action="store_true",
+                        help="with --sort-by, largest values first")
+    parser.add_argument("--sort-memory-mb", type=int, default=64,
+                        help="memory for --sort-by before sorted runs are spilled to disk (default: 64)")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="split the export across this many worker processes sharing one rate budget "
+                             "(default: 1)")
+    parser.add_argument("--tenants", metavar="TENANTS_FILE",
+                        help="export every workspace listed in TENANTS_FILE (JSON) concurrently, "
+                             "each with its own API key, rate budget and output file")
+    parser.add_argument("--tenant-concurrency", type=int,
+                        help="tenants exported at once with --tenants (default: all)")
+    parser.add_argument("--resume", metavar="CSV_FILE",
+                        help="continue an interrupted export of CSV_FILE from its checkpoint")
+    parser.add_argument("--redrive", metavar="CSV_FILE",
+                        help="retry only the customers in CSV_FILE's dead-letter file and append their rows")
+    parser.add_argument("--timeout", type=float, default=30,
+                        help="per-request timeout in seconds (default: 30)")
+    parser.add_argument("--max-retries", type=int, default=4,
+                        help="retries for timeouts, connection errors and 5xx responses (default: 4)")
+    parser.add_argument("--incremental", metavar="STATE_FILE",
+                        help="only fetch customers whose listing changed since the run that wrote STATE_FILE")
+    parser.add_argument("--cdc", metavar="STATE_FILE",
+                        help="compare with the run that last used STATE_FILE and write the changes as NDJSON")
+    parser.add_argument("--linkage", metavar="INDEX_FILE",
+                        help="index the customers that share IPs or wallets into this file (see linkage.py)")
+    parser.add_argument("--archive", metavar="ARCHIVE_FILE",
+                        help="also append raw API responses to this compressed archive (see archive.py)")
+    parser.add_argument("--cdc-output", metavar="FILE",
+                        help="where --cdc writes its change events (default: <output>.cdc.ndjson)")
+    parser.add_argument("--pool-size", type=int, default=32,
+                        help="maximum keep-alive connections to the API (default: 32)")
+    parser.add_argument("--http2", action="store_true",
+                        help="multiplex --async requests over HTTP/2 (needs the h2 package)")
+    parser.add_argument("--cache", metavar="CACHE_FILE",
+                        help="cache API responses in CACHE_FILE (SQLite) and reuse them while fresh")
+    parser.add_argument("--cache-ttl", metavar="SPEC",
+                        help="per-endpoint TTLs in seconds, e.g. details=3600,ips=600,list=0")
+    parser.add_argument("--cache-max-mb", type=int, default=256,
+                        help="evict least recently used responses beyond this size (default: 256)")
+    return parser.parse_args()
 
 def main():
+    args = parse_args()
     try:
-        exporter = CompiLotExporter()
-        
-        print("Fetching customers...")
-        exporter.get_all_customers()
-        
-        print(f"Found {len(exporter.customers)} onboarded customers")
-        
-        filename = f"compilot_customers_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-        print(f"Exporting to {filename}...")
-        
-        exporter.export_to_csv(filename)
-        print("Export completed!")
+        cache = None
+        if args.cache:
+            cache = ResponseCache(args.cache, ttls=parse_ttls(args.cache_ttl),
+                                  max_bytes=args.cache_max_mb * 1024 * 1024)
+        column_spec = None
+        if args.column_spec:
+            if args.columns:
+                raise ValueError("--column-spec cannot be combined with --columns; list the columns in the spec")
+            if args.redrive or args.shards > 1 or args.format == 'sqlite':
+                raise ValueError("--column-spec cannot be combined with --redrive, --shards or --format sqlite")
+            column_spec = load_column_spec(args.column_spec)
+        def make_exporter(api_token=None):
+            exporter = CompiLotExporter(api_token=api_token, response_cache=cache)
+            exporter.pool_size = args.pool_size
+            exporter.page_concurrency = args.page_concurrency
+            exporter.http2 = args.http2
+            exporter.plan = FetchPlan(parse_columns(args.columns), spec=column_spec)
+            exporter.request_timeout = args.timeout
+            exporter.retry_policy.max_retries = args.max_retries
+            return exporter
+
+        def sink_options_for(output_format):
+            if args.compress or args.rotate_rows or args.rotate_mb:
+                if args.sort_by:
+                    raise ValueError("--sort-by cannot be combined with --compress or rotation")
+                sink_options = {'compress': args.compress, 'compress_level': args.compress_level,
+                                'rotate_rows': args.rotate_rows, 'rotate_mb': args.rotate_mb}
+                # Raises for formats that cannot be compressed or rotated
+                sink_for(output_format, sink_options)
+                return sink_options
+            if output_format == 'parquet':
+                return {'row_group_size': args.row_group_size, 'compression': args.compression}
+            return {}
+
+        concurrency = args.concurrency if args.async_mode else None
+        exporter_columns = FetchPlan(parse_columns(args.columns), spec=column_spec).columns
+        if args.tenants:
+            if args.resume or args.redrive or args.incremental or args.cdc or args.archive or args.linkage or \
+                    args.output or args.shards > 1:
+                raise ValueError("--tenants cannot be combined with --resume, --redrive, --incremental, --cdc, "
+                                 "--archive, --linkage, --output or --shards; set per-tenant outputs in the "
+                                 "tenants file")
+            sink_options = sink_options_for(args.format)
+            if args.sort_by:
+                check_sortable(args.format, exporter_columns, args.sort_by)
+            tenants = load_tenants(args.tenants)
+            print(f"Exporting {len(tenants)} tenants: {', '.join(tenant['name'] for tenant in tenants)}")
+            results = export_tenants(tenants, make_exporter, args.format, concurrency=concurrency,
+                                     sink_options=sink_options, max_parallel=args.tenant_concurrency)
+            for tenant in tenants:
+                rows, error = results[tenant['name']]
+                if not error and args.sort_by:
+                    sort_export(tenant['output'], args.sort_by, args.sort_descending, args.sort_memory_mb,
+                                args.format, sink_options)
+                outcome = f"failed: {error}" if error else f"{rows} customers exported to {tenant['output']}"
+                print(f"Tenant {tenant['name']}: {outcome}")
+            if cache:
+                cache.close()
+            failed = [name for name, (rows, error) in results.items() if error]
+            if failed:
+                print(f"{len(failed)} of {len(tenants)} tenants failed")
+                sys.exit(1)
+            return
+
+        exporter = make_exporter()
+        if args.redrive:
+            if args.archive or args.linkage:
+                raise ValueError("--archive and --linkage cannot be combined with --redrive")
+            if args.sort_by:
+                raise ValueError("--sort-by cannot be combined with --redrive; sort the file afterwards "
+                                 "with python external_sort.py")
+            exported = exporter.redrive(args.redrive, concurrency=concurrency)
+            exporter.close()
+        else:
+            output_format = format_for(args.resume) if args.resume else args.format
+            filename = args.resume or args.output
+            if not filename and output_format == 'sqlite':
+                filename = "compilot_customers.sqlite"
+            elif not filename:
+                filename = f"compilot_customers_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{output_format}"
+            print(f"Exporting to {filename}...")
+            if not args.resume:
+                print(f"Exporting {exporter.plan.describe()}")
+
+            sink_options = sink_options_for(output_format)
+            if args.sort_by:
+                check_sortable(output_format, exporter.plan.columns, args.sort_by)
+            linkage = None
+            if args.linkage:
+                if args.resume:
+                    raise ValueError(f"--linkage cannot be combined with --resume; once the export is complete, "
+                                     f"run python linkage.py build {filename} --output {args.linkage}")
+                check_linkable(exporter.plan.columns)
+                linkage = LinkageIndex()
+            sharded = args.shards > 1 or (args.resume and os.path.exists(manifest_path(args.resume)))
+            if sharded:
+                if args.incremental or args.cdc or args.archive or args.linkage:
+                    raise ValueError("--incremental, --cdc, --archive and --linkage cannot be combined with --shards")
+                exported = export_sharded(exporter, filename, args.shards, output_format, concurrency=concurrency,
+                                          resume=bool(args.resume), sink_options=sink_options)
+            else:
+                delta = DeltaState(args.incremental) if args.incremental else None
+                cdc = ChangeCapture(args.cdc, args.cdc_output or f"{filename}.cdc.ndjson") if args.cdc else None
+                exporter.archive = RawArchive(args.archive) if args.archive else None
+                try:
+                    exported = exporter.export_to_file(filename, output_format, concurrency=concurrency,
+                                                       resume=bool(args.resume), delta=delta,
+                                                       sink_options=sink_options, cdc=cdc, linkage=linkage)
+                finally:
+                    if exporter.archive:
+                        exporter.archive.close()
+                if delta:
+                    delta.close()
+                if cdc:
+                    cdc.close()
+                if linkage:
+                    linkage.save(args.linkage)
+                    print_linkage_summary(linkage, args.linkage)
+            exporter.close()
+            if args.sort_by:
+                print(f"Sorting {filename} by {args.sort_by}{' (descending)' if args.sort_descending else ''}")
+                sort_export(filename, args.sort_by, args.sort_descending, args.sort_memory_mb, output_format,
+                            sink_options)
+        print(f"Export completed! {exported} onboarded customers exported")
+
+        stats = exporter.rate_limiter.stats()
+        print(f"Rate limiter: {stats['calls']} calls, {stats['delayed_calls']} delayed, "
+              f"{stats['throttled']} throttled, {stats['wait_time']:.1f}s spent waiting")
+        rates = ', '.join(f"{calls:.1f}/{period}s" for calls, period in exporter.rate_limiter.current_rates())
+        print(f"Final rate limits: {rates}")
+        print(f"HTTP pool: {exporter.pool_stats.summary()}")
+        breaker = exporter.circuit_breaker
+        if breaker.times_opened:
+            print(f"Circuit breaker: opened {breaker.times_opened} times, {breaker.delayed} calls waited "
+                  f"{breaker.wait_time:.0f}s in total")
+        if exporter.plan.details_from_listing:
+            print(f"Column planner: {exporter.plan.details_from_listing} customers exported without a details call")
+        if cache:
+            cache_stats = cache.stats()
+            print(f"Response cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+                  f"{cache_stats['revalidations']} revalidated, {cache_stats['bytes'] / 1024 / 1024:.1f} MB stored")
+            cache.close()
     except ValueError as e:
         print(f"Error: {e}")
-        print("Please make sure COMPILOT_API_TOKEN is set in your .env file")
+        if not os.getenv('COMPILOT_API_KEY') and not args.tenants:
+            print("Please make sure COMPILOT_API_KEY is set in your .env file")
+        sys.exit(1)
     except Exception as e:
         print(f"An error occurred: {e}")
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
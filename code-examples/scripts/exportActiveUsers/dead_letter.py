@@ -0,0 +1,82 @@
+"""
+Dead-letter file for customers an export could not fetch.
+
+Stored next to the CSV as <csv>.deadletter.ndjson, one JSON object per line:
+
+    {"customer_id": ..., "page": ..., "reason": ..., "attempts": ...,
+     "failed_at": ..., "customer": {...listing entry...}}
+
+The listing entry is kept, so `python csvExport.py --redrive <csv>` can
+fetch exactly these customers without listing every customer again. A
+customer can appear more than once (for example after --resume); the last
+line wins.
+"""
+
+import json
+import os
+from datetime import datetime, timezone
+
+def read_dead_letters(path):
+    """The entries of a dead-letter file, one per customer, in file order"""
+    entries = {}
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # A line cut short by a crash
+                continue
+            entries.pop(entry['customer_id'], None)
+            entries[entry['customer_id']] = entry
+    return list(entries.values())
+
+def write_dead_letters(path, entries):
+    """Atomically replace a dead-letter file, removing it when nothing failed"""
+    if not entries:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+class DeadLetterFile:
+    def __init__(self, path, append=False):
+        self.path = path
+        self.file = open(path, 'a' if append else 'w', encoding='utf-8')
+
+    @staticmethod
+    def path_for(filename):
+        return f"{filename}.deadletter.ndjson"
+
+    def add(self, customer, page, reason, attempts=1):
+        self.file.write(json.dumps({
+            'customer_id': customer['id'],
+            'page': page,
+            'reason': reason,
+            'attempts': attempts,
+            'failed_at': datetime.now(timezone.utc).isoformat(),
+            'customer': customer,
+        }, default=str) + '\n')
+
+    def flush(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self, keep_ids=None):
+        """Close the file, keeping only the customers in `keep_ids` if given"""
+        self.file.close()
+        if keep_ids is not None:
+            write_dead_letters(self.path, [
+                entry for entry in read_dead_letters(self.path) if entry['customer_id'] in keep_ids
+            ])
@@ -0,0 +1,102 @@
+"""
+Local state for incremental (delta) ComPilot exports.
+
+The state file is a SQLite database that remembers, for every exported
+customer, a fingerprint of its entry in the /customers listing and the CSV
+row produced from it. On the next run a customer whose listing entry
+(including its timestamps) is unchanged is served from the state instead
+of calling /customers/{id} and /customers/{id}/ips, so API usage follows
+churn rather than the total number of customers.
+
+Note that only the listing is compared: a change that does not show up
+in the listing (for example a new IP address with no updated timestamp)
+is picked up the next time the customer's listing entry changes.
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+
+class DeltaState:
+    def __init__(self, path):
+        self.path = path
+        # Lookups come from the export engine's thread, updates from the writer
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS customers (
+                customer_id TEXT PRIMARY KEY,
+                fingerprint TEXT NOT NULL,
+                row TEXT NOT NULL,
+                run INTEGER NOT NULL
+            );
+        """)
+        self.run = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def fingerprint(customer):
+        """Stable hash of a customer's listing entry"""
+        payload = json.dumps(customer, sort_keys=True, separators=(',', ':'), default=str)
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+    def begin_run(self, resume=False, columns=None):
+        """
+        Start a new run, or continue the current one when resuming.
+
+        Rows remembered for a different column selection are dropped, since
+        they may lack the columns of this run.
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'run'").fetchone()
+            self.run = int(row[0]) if row else 0
+            if columns:
+                stored = self.conn.execute("SELECT value FROM meta WHERE key = 'columns'").fetchone()
+                if stored is None or stored[0] != ','.join(columns):
+                    self.conn.execute("DELETE FROM customers")
+                    self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('columns', ?)",
+                                      (','.join(columns),))
+                    self.conn.commit()
+            if not resume:
+                self.run += 1
+                self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('run', ?)", (str(self.run),))
+                self.conn.commit()
+
+    def cached_row(self, customer):
+        """The previous row for `customer` if its listing entry is unchanged, else None"""
+        with self.lock:
+            found = self.conn.execute(
+                "SELECT fingerprint, row FROM customers WHERE customer_id = ?", (customer['id'],)
+            ).fetchone()
+            if found and found[0] == self.fingerprint(customer):
+                self.conn.execute("UPDATE customers SET run = ? WHERE customer_id = ?", (self.run, customer['id']))
+                self.hits += 1
+                return json.loads(found[1])
+
+            self.misses += 1
+            return None
+
+    def update(self, customer, row):
+        """Remember the row produced for `customer` in this run"""
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO customers (customer_id, fingerprint, row, run) VALUES (?, ?, ?, ?)",
+                (customer['id'], self.fingerprint(customer), json.dumps(row), self.run)
+            )
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+
+    def finish(self):
+        """Forget customers that were not listed in this run, returning how many"""
+        with self.lock:
+            removed = self.conn.execute("DELETE FROM customers WHERE run != ?", (self.run,)).rowcount
+            self.conn.commit()
+            return removed
+
+    def close(self):
+        self.conn.close()
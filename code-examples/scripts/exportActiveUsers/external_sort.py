@@ -0,0 +1,222 @@
+"""
+Bounded-memory sorting of ComPilot exports (external merge sort).
+
+ExternalSorter buffers rows up to a memory cap. It then sorts the buffer
+and spills it to disk as a gzip-compressed run of JSON lines. Once every
+row has been added, the runs are merged with a k-way heap merge, at most
+MERGE_FAN_IN at a time, with extra merge passes when there are more runs.
+Memory therefore stays near the cap, whatever the number of rows.
+
+The sort is stable: customers with equal keys keep their listing order.
+Customers without a value for the sort column (or with one that cannot be
+parsed) come last in either direction.
+
+sort_export() sorts a finished CSV or Parquet export in place: it reads the
+rows back, sorts them, writes a new file next to it and swaps it in. When
+anything fails, the original file is kept unchanged.
+
+    python csvExport.py --sort-by risk_score --sort-descending
+    python external_sort.py export.csv --by date_onboarded --memory-mb 32
+"""
+
+import argparse
+import csv
+import gzip
+import heapq
+import json
+import os
+import shutil
+import sys
+import tempfile
+from datetime import date, datetime, timezone
+
+from sinks import DATE_COLUMNS, FLOAT_COLUMNS, SINKS, TIMESTAMP_COLUMNS, format_for, parse_date, \
+    parse_float, parse_timestamp
+
+MERGE_FAN_IN = 64
+# Rough per-row cost of the buffer beyond its encoded JSON (tuple, key, bytes header)
+ROW_OVERHEAD = 120
+
+SORTABLE_FORMATS = ('csv', 'parquet')
+
+def sort_key(column, descending=False):
+    """A key function ordering rows by `column`, missing values last"""
+    if column in FLOAT_COLUMNS:
+        parse, missing = parse_float, 0.0
+    elif column in TIMESTAMP_COLUMNS:
+        parse, missing = parse_timestamp, datetime.min.replace(tzinfo=timezone.utc)
+    elif column in DATE_COLUMNS:
+        parse, missing = parse_date, date.min
+    else:
+        parse, missing = (lambda value: None if value in (None, '') else str(value)), ''
+
+    # Merged in reverse when descending, so missing values must sort low then
+    def key(row):
+        value = parse(row.get(column))
+        if value is None:
+            return (not descending, missing)
+        return (descending, value)
+    return key
+
+class ExternalSorter:
+    def __init__(self, column, descending=False, memory_mb=64, tmp_dir=None):
+        self.column = column
+        self.descending = descending
+        self.memory_cap = memory_mb * 1024 * 1024
+        self.key = sort_key(column, descending)
+        self.tmp_dir = tempfile.mkdtemp(prefix='.sort-', dir=tmp_dir)
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.runs = []
+        self.runs_written = 0
+
+        # Counters
+        self.rows = 0
+        self.spilled_bytes = 0
+
+    def add(self, row):
+        line = json.dumps(row, default=str)
+        self.buffer.append((self.key(row), line))
+        self.buffered_bytes += len(line) + ROW_OVERHEAD
+        self.rows += 1
+        if self.buffered_bytes >= self.memory_cap:
+            self._spill()
+
+    def _run_path(self):
+        self.runs_written += 1
+        return os.path.join(self.tmp_dir, f"run{self.runs_written}.gz")
+
+    def _spill(self):
+        if not self.buffer:
+            return
+        # list.sort is stable, and so is heapq.merge across runs in order
+        self.buffer.sort(key=lambda entry: entry[0], reverse=self.descending)
+        path = self._run_path()
+        with gzip.open(path, 'wt', encoding='utf-8', compresslevel=1) as run:
+            for _, line in self.buffer:
+                run.write(line)
+                run.write('\n')
+        self.spilled_bytes += os.path.getsize(path)
+        self.runs.append(path)
+        self.buffer = []
+        self.buffered_bytes = 0
+
+    @staticmethod
+    def _read_run(path):
+        with gzip.open(path, 'rt', encoding='utf-8') as run:
+            for line in run:
+                yield json.loads(line)
+
+    def _merge(self, paths):
+        return heapq.merge(*(self._read_run(path) for path in paths), key=self.key, reverse=self.descending)
+
+    def sorted_rows(self):
+        """Yield every added row in order; the sorter is cleaned up once exhausted"""
+        try:
+            if not self.runs:
+                # Everything fit in memory
+                self.buffer.sort(key=lambda entry: entry[0], reverse=self.descending)
+                for _, line in self.buffer:
+                    yield json.loads(line)
+                return
+
+            self._spill()
+            while len(self.runs) > MERGE_FAN_IN:
+                # Merge consecutive runs so that ties keep their order
+                runs, self.runs = self.runs, []
+                for start in range(0, len(runs), MERGE_FAN_IN):
+                    group = runs[start:start + MERGE_FAN_IN]
+                    path = self._run_path()
+                    with gzip.open(path, 'wt', encoding='utf-8', compresslevel=1) as run:
+                        for row in self._merge(group):
+                            run.write(json.dumps(row, default=str))
+                            run.write('\n')
+                    self.runs.append(path)
+                    for merged in group:
+                        os.remove(merged)
+            yield from self._merge(self.runs)
+        finally:
+            self.close()
+
+    def close(self):
+        self.buffer = []
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+def _read_rows(filename, output_format):
+    # Yields the export's column names first, then its rows
+    if output_format == 'parquet':
+        import pyarrow.parquet as pq
+
+        parquet = pq.ParquetFile(filename)
+        yield parquet.schema_arrow.names
+        for batch in parquet.iter_batches(batch_size=10000):
+            yield from batch.to_pylist()
+        return
+
+    with open(filename, 'r', newline='', encoding='utf-8') as f:
+        reader = csv.DictReader(f)
+        yield reader.fieldnames
+        yield from reader
+
+def check_sortable(output_format, columns, column):
+    """Raise ValueError unless an export of `columns` in `output_format` can be sorted by `column`"""
+    if output_format not in SORTABLE_FORMATS:
+        raise ValueError(f"Only {', '.join(SORTABLE_FORMATS)} exports can be sorted, not {output_format}")
+    if column not in columns:
+        raise ValueError(f"Cannot sort by {column}: it is not one of the exported columns")
+
+def sort_export(filename, column, descending=False, memory_mb=64, output_format=None, sink_options=None):
+    """Sort a finished CSV or Parquet export by `column` in place. Returns the number of rows"""
+    output_format = output_format or format_for(filename)
+    if output_format not in SORTABLE_FORMATS:
+        raise ValueError(f"Only {', '.join(SORTABLE_FORMATS)} exports can be sorted, not {output_format}")
+
+    rows = _read_rows(filename, output_format)
+    columns = next(rows)
+    check_sortable(output_format, columns, column)
+
+    # Runs are spilled next to the export, where there is room for it
+    sorter = ExternalSorter(column, descending, memory_mb, tmp_dir=os.path.dirname(os.path.abspath(filename)))
+    tmp_path = f"{filename}.sorted.tmp"
+    try:
+        for row in rows:
+            sorter.add(row)
+        if sorter.runs:
+            print(f"Sorting {sorter.rows} rows by {column}: {len(sorter.runs)} runs spilled "
+                  f"({sorter.spilled_bytes / 1024 / 1024:.1f} MB compressed)")
+
+        sink = SINKS[output_format](tmp_path, columns, **(sink_options or {}))
+        try:
+            for row in sorter.sorted_rows():
+                sink.write(row)
+            sink.sync()
+        finally:
+            sink.close()
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    finally:
+        sorter.close()
+
+    os.replace(tmp_path, filename)
+    return sorter.rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Sort a ComPilot CSV or Parquet export in place")
+    parser.add_argument("filename")
+    parser.add_argument("--by", required=True, metavar="COLUMN", help="column to sort by, e.g. risk_score")
+    parser.add_argument("--descending", action="store_true", help="largest values first")
+    parser.add_argument("--memory-mb", type=int, default=64,
+                        help="rows held in memory before a sorted run is spilled to disk (default: 64)")
+    args = parser.parse_args()
+
+    try:
+        rows = sort_export(args.filename, args.by, args.descending, args.memory_mb)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    print(f"Sorted {rows} rows of {args.filename} by {args.by}")
+
+if __name__ == "__main__":
+    main()
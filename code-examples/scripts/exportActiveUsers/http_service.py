@@ -0,0 +1,352 @@
+"""
+HTTP service that streams ComPilot exports straight to the client.
+
+Rows come from CompiLotExporter.iter_rows(), the exporter's library
+generator. They are encoded as CSV or NDJSON and sent with chunked
+transfer encoding as soon as they are produced, so clients see the first
+rows within seconds and nothing is staged on disk.
+
+Endpoints:
+
+    GET /export?format=csv&columns=customer_id,risk_score,wallets
+    GET /export?format=ndjson&compress=none
+    GET /health
+
+- format:   csv (default) or ndjson
+- columns:  optional column selection, as for csvExport.py --columns
+- compress: gzip, zstd or none; by default the best encoding the client
+            accepts (Accept-Encoding), compressed incrementally per chunk
+
+Every export made by the service draws from one RateLimiter, since they all
+use the same API key. --max-exports limits how many run at once; beyond
+that, requests get 503 with Retry-After. With --token (or
+EXPORT_SERVICE_TOKEN), requests must send "Authorization: Bearer <token>".
+
+If the export fails midway, or any customer could not be fetched, the
+connection is closed without the final chunk, so clients see a truncated
+transfer rather than a short file that looks complete.
+
+Usage:
+    python http_service.py --port 8080 --async
+    curl -sN --compressed 'http://127.0.0.1:8080/export?format=ndjson' > customers.ndjson
+"""
+
+import argparse
+import csv
+import hmac
+import io
+import os
+import threading
+import time
+import zlib
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from dotenv import load_dotenv
+
+from column_plan import FetchPlan, parse_columns
+from csvExport import CompiLotExporter
+from rate_limiter import RateLimiter
+from sinks import flatten_row, ndjson_line
+
+# Load environment variables from .env file
+load_dotenv()
+
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson',
+}
+# A chunk goes out once this many bytes are encoded, or once a row arrives
+# this many seconds after the previous chunk
+FLUSH_BYTES = 64 * 1024
+FLUSH_INTERVAL = 1.0
+
+def available_encodings():
+    encodings = ['gzip']
+    try:
+        import zstandard
+        encodings.insert(0, 'zstd')
+    except ImportError:
+        pass
+    return encodings
+
+def negotiate_encoding(accept_encoding, requested=None):
+    """The content encoding to use: `requested` if given, else the best one the client accepts"""
+    available = available_encodings()
+    if requested:
+        if requested == 'none':
+            return None
+        if requested not in available:
+            raise ValueError(f"Unsupported compression '{requested}' (expected one of "
+                             f"{', '.join(available + ['none'])})")
+        return requested
+
+    accepted = set()
+    for token in (accept_encoding or '').split(','):
+        name, _, params = token.strip().partition(';')
+        if params.replace(' ', '') in ('q=0', 'q=0.0'):
+            continue
+        accepted.add(name.strip().lower())
+    for encoding in available:
+        if encoding in accepted:
+            return encoding
+    return None
+
+class StreamCompressor:
+    """Incremental gzip/zstd compression whose output is decodable chunk by chunk"""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == 'gzip':
+            self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        elif encoding == 'zstd':
+            import zstandard
+            self.zstd = zstandard
+            self.compressor = zstandard.ZstdCompressor(level=3).compressobj()
+
+    def compress(self, data):
+        if self.encoding is None:
+            return data
+        if self.encoding == 'gzip':
+            # A sync flush ends the chunk on a byte boundary the client can decode up to
+            return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        return self.compressor.compress(data) + self.compressor.flush(self.zstd.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        if self.encoding is None:
+            return b''
+        return self.compressor.flush()
+
+def encode_rows(rows, output_format, columns):
+    """Yield encoded chunks of `rows`, each ready to be sent"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction='ignore')
+    if output_format == 'csv':
+        writer.writeheader()
+    last_flush = None
+
+    for row in rows:
+        if output_format == 'csv':
+            writer.writerow(flatten_row(row))
+        else:
+            buffer.write(ndjson_line(row, columns))
+        now = time.monotonic()
+        if last_flush is None or buffer.tell() >= FLUSH_BYTES or now - last_flush >= FLUSH_INTERVAL:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+            last_flush = now
+
+    if buffer.tell() or last_flush is None:
+        yield buffer.getvalue().encode('utf-8')
+
+class ExportService:
+    def __init__(self, api_token=None, max_exports=2, service_token=None, concurrency=None, response_cache=None):
+        self.api_token = api_token or os.getenv('COMPILOT_API_KEY')
+        if not self.api_token:
+            raise ValueError("API key must be provided either as parameter or in .env file")
+        self.max_exports = max_exports
+        self.service_token = service_token
+        self.concurrency = concurrency
+        self.response_cache = response_cache
+        # Every export uses the same API key, so they share one budget
+        self.rate_limiter = RateLimiter()
+        self.slots = threading.BoundedSemaphore(max_exports)
+        self.server = None
+
+        # Counters
+        self.lock = threading.Lock()
+        self.exports = 0
+        self.rows = 0
+        self.rejected = 0
+
+    def make_exporter(self):
+        exporter = CompiLotExporter(api_token=self.api_token, response_cache=self.response_cache)
+        exporter.rate_limiter = self.rate_limiter
+        return exporter
+
+    def stream_export(self, write, output_format, columns, encoding):
+        """
+        Run one export, passing each compressed chunk to write(). Returns the
+        number of rows. Raises once the rows are sent if any customer could
+        not be fetched, so the response is not completed.
+        """
+        exporter = self.make_exporter()
+        compressor = StreamCompressor(encoding)
+        rows = 0
+
+        def counted(source):
+            nonlocal rows
+            for row in source:
+                rows += 1
+                yield row
+
+        try:
+            chunks = encode_rows(counted(exporter.iter_rows(self.concurrency, columns)), output_format,
+                                 FetchPlan(columns).columns)
+            for chunk in chunks:
+                data = compressor.compress(chunk)
+                if data:
+                    write(data)
+            if exporter.skipped:
+                customer_id, reason = exporter.skipped[0]
+                raise Exception(f"{len(exporter.skipped)} customers could not be fetched "
+                                f"(first: {customer_id}, {reason})")
+            write(compressor.finish())
+        finally:
+            exporter.close()
+        return rows
+
+    def authorized(self, header):
+        if not self.service_token:
+            return True
+        scheme, _, token = (header or '').partition(' ')
+        return scheme.lower() == 'bearer' and hmac.compare_digest(token.strip().encode('utf-8'), self.service_token.encode('utf-8'))
+
+    def make_handler(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, body=b'', headers=None):
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'text/plain; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if body:
+                    self.wfile.write(body)
+
+            def _write_chunk(self, data):
+                if data:
+                    self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+                    self.wfile.flush()
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == '/health':
+                    self._send(200, b'ok\n')
+                    return
+                if url.path != '/export':
+                    self._send(404, b'Not found\n')
+                    return
+                if not service.authorized(self.headers.get('Authorization')):
+                    self._send(401, b'Missing or invalid bearer token\n', {'WWW-Authenticate': 'Bearer'})
+                    return
+
+                query = parse_qs(url.query)
+                try:
+                    output_format = query.get('format', ['csv'])[0]
+                    if output_format not in CONTENT_TYPES:
+                        raise ValueError(f"Unknown format '{output_format}' (expected csv or ndjson)")
+                    columns = parse_columns(query['columns'][0]) if 'columns' in query else None
+                    encoding = negotiate_encoding(self.headers.get('Accept-Encoding'),
+                                                  query.get('compress', [None])[0])
+                except ValueError as e:
+                    self._send(400, f"{e}\n".encode('utf-8'))
+                    return
+
+                if not service.slots.acquire(blocking=False):
+                    with service.lock:
+                        service.rejected += 1
+                    self._send(503, b'Too many exports in progress\n', {'Retry-After': '30'})
+                    return
+                try:
+                    self._stream(output_format, columns, encoding)
+                finally:
+                    service.slots.release()
+
+            def _stream(self, output_format, columns, encoding):
+                started = time.monotonic()
+                filename = f"compilot_customers_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{output_format}"
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPES[output_format])
+                self.send_header('Content-Disposition', f'attachment; filename="{filename}"')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.send_header('Cache-Control', 'no-store')
+                if encoding:
+                    self.send_header('Content-Encoding', encoding)
+                self.end_headers()
+
+                print(f"Export started for {self.client_address[0]}: {output_format}, "
+                      f"{'all columns' if columns is None else ','.join(columns)}, {encoding or 'uncompressed'}")
+                try:
+                    rows = service.stream_export(self._write_chunk, output_format, columns, encoding)
+                except (BrokenPipeError, ConnectionResetError):
+                    print(f"Export cancelled: {self.client_address[0]} disconnected")
+                    self.close_connection = True
+                    return
+                except Exception as e:
+                    # Leave out the last chunk, so the client sees the transfer as incomplete
+                    print(f"Export failed: {e}")
+                    self.close_connection = True
+                    return
+
+                self.wfile.write(b"0\r\n\r\n")
+                with service.lock:
+                    service.exports += 1
+                    service.rows += rows
+                print(f"Export finished: {rows} rows in {time.monotonic() - started:.1f}s")
+
+        return Handler
+
+    def start(self, host='127.0.0.1', port=0):
+        """Serve on a background thread and return the base URL"""
+        self.server = ThreadingHTTPServer((host, port), self.make_handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.url
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve ComPilot exports as streamed CSV/NDJSON over HTTP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--async", dest="async_mode", action="store_true",
+                        help="fetch customer details and IPs concurrently")
+    parser.add_argument("--concurrency", type=int, default=32,
+                        help="customers in flight per export in --async mode (default: 32)")
+    parser.add_argument("--max-exports", type=int, default=2,
+                        help="exports streamed at once; more get 503 (default: 2)")
+    parser.add_argument("--token", default=os.getenv('EXPORT_SERVICE_TOKEN'),
+                        help="bearer token clients must send (default: EXPORT_SERVICE_TOKEN, or none)")
+    args = parser.parse_args()
+
+    try:
+        service = ExportService(max_exports=args.max_exports, service_token=args.token,
+                                concurrency=args.concurrency if args.async_mode else None)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return
+
+    url = service.start(args.host, args.port)
+    print(f"Export service listening on {url}/export")
+    if not args.token:
+        print("Warning: no --token set, so anyone who can reach this port can export customer data")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"Exports served: {service.exports} ({service.rows} rows), {service.rejected} rejected as busy")
+        service.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Pooled HTTP clients for the ComPilot export scripts.
+
+The module-level requests.request() helper builds a new Session, and so a
+new TCP+TLS connection, for every call. The exporter instead shares one
+keep-alive pool per run:
+
+- create_session():      requests.Session for the sync engine
+- create_async_client(): httpx.AsyncClient for the --async engine, with
+                         optional HTTP/2 multiplexing (needs the h2 package)
+
+Both advertise every response encoding they can decode (gzip/deflate, plus
+brotli when the brotli package is installed). PoolStats counts requests,
+connections opened and compressed responses, so the end-of-run report
+shows how often connections were reused.
+"""
+
+import threading
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+class PoolStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections_opened = 0
+        self.compressed = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.http_versions = {}
+
+    def request_started(self):
+        with self.lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def request_finished(self, response):
+        with self.lock:
+            self.in_flight -= 1
+            if response is None:
+                return
+            if response.headers.get('Content-Encoding'):
+                self.compressed += 1
+            version = getattr(response, 'http_version', None)
+            if version:
+                self.http_versions[version] = self.http_versions.get(version, 0) + 1
+
+    def connection_opened(self, count=1):
+        with self.lock:
+            self.connections_opened += count
+
+    async def trace(self, event_name, info):
+        """httpcore trace hook, passed as extensions={'trace': stats.trace}"""
+        if event_name == 'connection.connect_tcp.complete':
+            self.connection_opened()
+
+    def collect_session(self, session):
+        """Add the connections opened by a requests.Session's pools"""
+        # One adapter is usually mounted for both http:// and https://
+        adapters = {id(adapter): adapter for adapter in session.adapters.values()}
+        for adapter in adapters.values():
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is not None:
+                    self.connection_opened(pool.num_connections)
+
+    @property
+    def reuse_ratio(self):
+        if not self.requests:
+            return 0.0
+        return max(0.0, 1 - self.connections_opened / self.requests)
+
+    def summary(self):
+        with self.lock:
+            versions = ', '.join(f"{version}: {count}" for version, count in sorted(self.http_versions.items()))
+            return (f"{self.requests} requests over {self.connections_opened} connections "
+                    f"(reuse {self.reuse_ratio:.1%}, peak {self.peak_in_flight} in flight), "
+                    f"{self.compressed} compressed responses"
+                    + (f", {versions}" if versions else ""))
+
+def create_session(headers, pool_size=10):
+    """A keep-alive requests.Session whose pool holds up to `pool_size` connections"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update(headers)
+    return session
+
+def create_async_client(headers, pool_size=64, http2=False):
+    """A keep-alive httpx.AsyncClient, multiplexing over HTTP/2 if requested and available"""
+    if http2 and not HTTP2_AVAILABLE:
+        print("HTTP/2 requested but the h2 package is not installed; using HTTP/1.1")
+        http2 = False
+
+    limits = httpx.Limits(
+        max_connections=pool_size,
+        max_keepalive_connections=pool_size,
+        keepalive_expiry=30
+    )
+    return httpx.AsyncClient(headers=headers, limits=limits, http2=http2)
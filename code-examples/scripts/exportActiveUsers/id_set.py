@@ -0,0 +1,67 @@
+"""
+Compact set of customer IDs.
+
+IdSet stores each ID as a 64-bit BLAKE2b fingerprint in a flat, linearly
+probed array('Q') hash table, which costs about 16 bytes per ID instead of
+the ~100 bytes a Python set of strings needs. Two different IDs can only be
+confused if their fingerprints collide, which for a million IDs has a
+probability of about 3e-8.
+"""
+
+from array import array
+from hashlib import blake2b
+
+class IdSet:
+    def __init__(self, capacity=1024):
+        size = 16
+        while size < capacity * 2:
+            size *= 2
+        self._slots = array('Q', bytes(8 * size))
+        self._mask = size - 1
+        self._count = 0
+
+    @staticmethod
+    def fingerprint(value):
+        digest = blake2b(str(value).encode('utf-8'), digest_size=8).digest()
+        # 0 marks an empty slot
+        return int.from_bytes(digest, 'little') or 1
+
+    def _probe(self, fingerprint):
+        slots = self._slots
+        mask = self._mask
+        index = fingerprint & mask
+        while slots[index] and slots[index] != fingerprint:
+            index = (index + 1) & mask
+        return index
+
+    def add(self, value):
+        """Add `value`, returning False if it was already present"""
+        fingerprint = self.fingerprint(value)
+        index = self._probe(fingerprint)
+        if self._slots[index]:
+            return False
+
+        self._slots[index] = fingerprint
+        self._count += 1
+        # Keep the load factor under 1/2 so probes stay short
+        if self._count * 2 > len(self._slots):
+            self._grow()
+        return True
+
+    def _grow(self):
+        old = self._slots
+        self._slots = array('Q', bytes(16 * len(old)))
+        self._mask = len(self._slots) - 1
+        for fingerprint in old:
+            if fingerprint:
+                self._slots[self._probe(fingerprint)] = fingerprint
+
+    def __contains__(self, value):
+        return bool(self._slots[self._probe(self.fingerprint(value))])
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def nbytes(self):
+        return self._slots.itemsize * len(self._slots)
@@ -0,0 +1,525 @@
+"""
+Identity linkage over the wallets and IP addresses of exported customers.
+
+LinkageIndex answers the questions fraud reviews keep asking: which
+customers share an IP address or a wallet with this one, and which
+customers are linked through any chain of shared identifiers (a cluster).
+
+The index is built while an export streams (csvExport.py --linkage FILE),
+or afterwards from a CSV, NDJSON or Parquet export (python linkage.py build).
+Everything is kept in flat arrays rather than per-customer objects:
+
+- IPv4 addresses are packed into 32-bit integers and IPv6 addresses into
+  16 bytes; IPv4-mapped IPv6 addresses count as their IPv4 address
+- wallets are normalized (EVM 0x addresses are lowercased, since their case
+  is only a checksum) and interned, so each one is stored once
+- customer/identifier links are array('I') columns, turned into two
+  offset-indexed adjacency lists (customer -> identifiers and
+  identifier -> customers) when the index is saved
+- customers and identifiers are renumbered in sorted order when the index
+  is finished, so lookups by customer ID, IP or wallet are binary searches
+- clusters come from a union-find over the customers, with path halving
+  and union by size, run once over all the links; the members of each
+  cluster are kept in another offset-indexed list
+
+Identifiers shared by more than --max-shared customers (default 50), such
+as a carrier NAT address or an exchange deposit wallet, are kept for
+lookups but do not link customers into clusters, as they would otherwise
+merge unrelated customers into one giant cluster.
+
+The saved index is a small JSON header followed by the raw arrays, so it
+loads without parsing anything per customer.
+
+Usage:
+    python csvExport.py --linkage customers.linkage
+    python linkage.py build compilot_customers.csv --output customers.linkage
+    python linkage.py info customers.linkage
+    python linkage.py query customers.linkage --customer <customer id>
+    python linkage.py query customers.linkage --ip 203.0.113.7
+    python linkage.py query customers.linkage --wallet 0xabc...
+    python linkage.py clusters customers.linkage --min-size 3 --top 20
+"""
+
+import argparse
+import bisect
+import csv
+import json
+import os
+import re
+import socket
+import sys
+import time
+from array import array
+
+from sinks import as_list, format_for
+
+MAGIC = b'COMPILOT-LINKAGE 2\n'
+
+# Identifier kinds
+IPV4, IPV6, WALLET = 0, 1, 2
+
+EVM_ADDRESS = re.compile(r'0[xX][0-9a-fA-F]{40}')
+
+LINKAGE_COLUMNS = ('wallets', 'ip_addresses')
+
+def pack_ip(value):
+    """(kind, packed) for an IP address string, or None if it is not one"""
+    value = str(value).strip()
+    try:
+        return IPV4, int.from_bytes(socket.inet_pton(socket.AF_INET, value), 'big')
+    except OSError:
+        pass
+    try:
+        packed = socket.inet_pton(socket.AF_INET6, value.split('%', 1)[0])
+    except OSError:
+        return None
+    if packed[:12] == b'\0' * 10 + b'\xff\xff':
+        return IPV4, int.from_bytes(packed[12:], 'big')
+    return IPV6, packed
+
+def unpack_ip(kind, packed):
+    if kind == IPV4:
+        return socket.inet_ntop(socket.AF_INET, packed.to_bytes(4, 'big'))
+    return socket.inet_ntop(socket.AF_INET6, packed)
+
+def normalize_wallet(value):
+    """The canonical form of a wallet address, or None if it is empty"""
+    value = str(value).strip()
+    if not value:
+        return None
+    if EVM_ADDRESS.fullmatch(value):
+        return value.lower()
+    return value
+
+def check_linkable(columns):
+    """Raise ValueError unless rows with `columns` can be linked"""
+    if 'customer_id' not in columns or not any(column in columns for column in LINKAGE_COLUMNS):
+        raise ValueError("A linkage index needs the customer_id column and wallets and/or ip_addresses")
+
+class LinkageIndex:
+    def __init__(self, max_shared=50):
+        self.max_shared = max_shared
+        self.customer_ids = []
+        self.customer_index = {}
+        # Interned identifiers per kind; an identifier's local number is its
+        # position in these lists
+        self.ipv4 = array('I')
+        self.ipv6 = []
+        self.wallets = []
+        self._lookup = ({}, {}, {})
+        # One entry per link: customer number and identifier code (local * 3 + kind)
+        self.link_customers = array('I')
+        self.link_codes = array('I')
+
+        # Counters
+        self.invalid_ips = 0
+
+        # Filled in by finish() or load()
+        self.finished = False
+
+    # Building
+
+    def _intern(self, kind, value):
+        lookup = self._lookup[kind]
+        local = lookup.get(value)
+        if local is None:
+            if kind == IPV4:
+                local = len(self.ipv4)
+                self.ipv4.append(value)
+            elif kind == IPV6:
+                local = len(self.ipv6)
+                self.ipv6.append(value)
+            else:
+                local = len(self.wallets)
+                self.wallets.append(sys.intern(value))
+            lookup[value] = local
+        return local * 3 + kind
+
+    def add(self, customer_id, wallets=(), ips=()):
+        """Record the wallets and IP addresses of one customer"""
+        if self.finished:
+            raise Exception("Cannot add customers to a finished linkage index")
+        customer_id = str(customer_id)
+        customer = self.customer_index.get(customer_id)
+        if customer is None:
+            customer = self.customer_index[customer_id] = len(self.customer_ids)
+            self.customer_ids.append(customer_id)
+
+        codes = set()
+        for wallet in wallets:
+            wallet = normalize_wallet(wallet) if wallet is not None else None
+            if wallet:
+                codes.add(self._intern(WALLET, wallet))
+        for ip in ips:
+            packed = pack_ip(ip) if ip is not None else None
+            if packed is None:
+                self.invalid_ips += 1
+                continue
+            codes.add(self._intern(*packed))
+        for code in codes:
+            self.link_customers.append(customer)
+            self.link_codes.append(code)
+
+    def add_row(self, row):
+        """Record an export row (lists, or the joined strings of a CSV export)"""
+        self.add(row['customer_id'], as_list(row.get('wallets')), as_list(row.get('ip_addresses')))
+
+    def finish(self):
+        """Build the adjacency lists and clusters; no customers can be added afterwards"""
+        self.finished = True
+        self._lookup = ({}, {}, {})
+        self.customer_index = {}
+        customers = len(self.customer_ids)
+
+        # Renumber customers and identifiers in sorted order, so lookups can bisect
+        order, customer_ranks = self._sort_order(self.customer_ids)
+        self.customer_ids = [self.customer_ids[old] for old in order]
+        order, ipv4_ranks = self._sort_order(self.ipv4)
+        self.ipv4 = array('I', (self.ipv4[old] for old in order))
+        order, ipv6_ranks = self._sort_order(self.ipv6)
+        self.ipv6 = [self.ipv6[old] for old in order]
+        order, wallet_ranks = self._sort_order(self.wallets)
+        self.wallets = [self.wallets[old] for old in order]
+        ranks = (ipv4_ranks, ipv6_ranks, wallet_ranks)
+
+        # Global identifier numbers: IPv4, then IPv6, then wallets
+        self.kind_offsets = (0, len(self.ipv4), len(self.ipv4) + len(self.ipv6))
+        identifiers = self.kind_offsets[2] + len(self.wallets)
+        offsets = self.kind_offsets
+        link_identifiers = array('I', (offsets[code % 3] + ranks[code % 3][code // 3] for code in self.link_codes))
+        self.link_codes = array('I')
+        link_customers = array('I', (customer_ranks[customer] for customer in self.link_customers))
+        self.link_customers = array('I')
+
+        self.identifier_offsets, self.identifier_members = self._group(link_identifiers, link_customers,
+                                                                      identifiers)
+        self.customer_offsets, self.customer_identifiers = self._group(link_customers, link_identifiers,
+                                                                      customers)
+        self.cluster = self._clusters(customers)
+        self.cluster_offsets, self.cluster_members_by_root = self._group(self.cluster, range(customers), customers)
+        self.cluster_sizes = array('I', (self.cluster_offsets[root + 1] - self.cluster_offsets[root]
+                                         for root in range(customers)))
+
+    @staticmethod
+    def _sort_order(values):
+        # (old numbers in sorted order, new number of every old number)
+        order = sorted(range(len(values)), key=values.__getitem__)
+        ranks = array('I', bytes(4 * len(values)))
+        for new, old in enumerate(order):
+            ranks[old] = new
+        return order, ranks
+
+    @staticmethod
+    def _group(keys, values, count):
+        # Counting sort of `values` by `keys`: offsets[k]:offsets[k + 1] are the values of key k
+        offsets = array('I', bytes(4 * (count + 1)))
+        for key in keys:
+            offsets[key + 1] += 1
+        for position in range(count):
+            offsets[position + 1] += offsets[position]
+        grouped = array('I', bytes(4 * len(values)))
+        cursor = array('I', offsets[:-1])
+        for key, value in zip(keys, values):
+            grouped[cursor[key]] = value
+            cursor[key] += 1
+        return offsets, grouped
+
+    def _clusters(self, customers):
+        parent = array('I', range(customers))
+        size = array('I', [1]) * customers
+        offsets, members = self.identifier_offsets, self.identifier_members
+        for identifier in range(len(offsets) - 1):
+            start, end = offsets[identifier], offsets[identifier + 1]
+            if end - start < 2 or end - start > self.max_shared:
+                continue
+            root = members[start]
+            while parent[root] != root:
+                parent[root] = parent[parent[root]]
+                root = parent[root]
+            for position in range(start + 1, end):
+                other = members[position]
+                while parent[other] != other:
+                    parent[other] = parent[parent[other]]
+                    other = parent[other]
+                if other == root:
+                    continue
+                if size[other] > size[root]:
+                    root, other = other, root
+                parent[other] = root
+                size[root] += size[other]
+
+        # Point every customer straight at its root
+        for customer in range(customers):
+            root = customer
+            while parent[root] != root:
+                root = parent[root]
+            parent[customer] = root
+        return parent
+
+    # Saving and loading
+
+    ARRAYS = ('ipv4', 'identifier_offsets', 'identifier_members', 'customer_offsets', 'customer_identifiers',
+              'cluster', 'cluster_sizes', 'cluster_offsets', 'cluster_members_by_root')
+
+    def save(self, path):
+        """Write the index to `path` (finishing it first if needed)"""
+        if not self.finished:
+            self.finish()
+        blobs = {
+            'customer_ids': '\n'.join(self.customer_ids).encode('utf-8'),
+            'ipv6': b''.join(self.ipv6),
+            'wallets': '\n'.join(self.wallets).encode('utf-8'),
+        }
+        header = {
+            'customers': len(self.customer_ids),
+            'max_shared': self.max_shared,
+            'kind_offsets': self.kind_offsets,
+            'arrays': [[name, len(getattr(self, name))] for name in self.ARRAYS],
+            'blobs': [[name, len(blob)] for name, blob in blobs.items()],
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        }
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(json.dumps(header).encode('utf-8') + b'\n')
+            for name in self.ARRAYS:
+                getattr(self, name).tofile(f)
+            for blob in blobs.values():
+                f.write(blob)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            magic = f.readline()
+            if magic != MAGIC:
+                if magic.startswith(b'COMPILOT-LINKAGE '):
+                    raise ValueError(f"{path} was built by an older version; build it again")
+                raise ValueError(f"{path} is not a linkage index")
+            header = json.loads(f.readline())
+            index = cls(header['max_shared'])
+            for name, count in header['arrays']:
+                values = array('I')
+                values.fromfile(f, count)
+                setattr(index, name, values)
+            blobs = {name: f.read(length) for name, length in header['blobs']}
+        index.customer_ids = blobs['customer_ids'].decode('utf-8').split('\n') if header['customers'] else []
+        ipv6 = blobs['ipv6']
+        index.ipv6 = [ipv6[start:start + 16] for start in range(0, len(ipv6), 16)]
+        index.wallets = blobs['wallets'].decode('utf-8').split('\n') if blobs['wallets'] else []
+        index.kind_offsets = tuple(header['kind_offsets'])
+        index.finished = True
+        return index
+
+    # Queries
+
+    def identifier_label(self, identifier):
+        """(kind name, value) of a global identifier number"""
+        if identifier >= self.kind_offsets[2]:
+            return 'wallet', self.wallets[identifier - self.kind_offsets[2]]
+        if identifier >= self.kind_offsets[1]:
+            return 'ip', unpack_ip(IPV6, self.ipv6[identifier - self.kind_offsets[1]])
+        return 'ip', unpack_ip(IPV4, self.ipv4[identifier])
+
+    @staticmethod
+    def _search(values, value):
+        # Position of `value` in the sorted `values`, or None
+        position = bisect.bisect_left(values, value)
+        if position < len(values) and values[position] == value:
+            return position
+        return None
+
+    def find_customer(self, customer_id):
+        return self._search(self.customer_ids, str(customer_id))
+
+    def find_ip(self, ip):
+        packed = pack_ip(ip)
+        if packed is None:
+            raise ValueError(f"{ip} is not an IP address")
+        kind, value = packed
+        if kind == IPV4:
+            return self._search(self.ipv4, value)
+        found = self._search(self.ipv6, value)
+        return None if found is None else self.kind_offsets[1] + found
+
+    def find_wallet(self, wallet):
+        wallet = normalize_wallet(wallet)
+        if wallet is None:
+            return None
+        found = self._search(self.wallets, wallet)
+        return None if found is None else self.kind_offsets[2] + found
+
+    def holders(self, identifier):
+        """The customer numbers holding an identifier"""
+        return self.identifier_members[self.identifier_offsets[identifier]:self.identifier_offsets[identifier + 1]]
+
+    def identifiers_of(self, customer):
+        return self.customer_identifiers[self.customer_offsets[customer]:self.customer_offsets[customer + 1]]
+
+    def neighbours(self, customer):
+        """{other customer: [shared identifiers]} for customers sharing an identifier with `customer`"""
+        shared = {}
+        for identifier in self.identifiers_of(customer):
+            for other in self.holders(identifier):
+                if other != customer:
+                    shared.setdefault(other, []).append(identifier)
+        return shared
+
+    def cluster_members(self, customer):
+        root = self.cluster[customer]
+        return self.cluster_members_by_root[self.cluster_offsets[root]:self.cluster_offsets[root + 1]]
+
+    def clusters(self, min_size=2):
+        """(size, root) of every cluster of at least `min_size` customers, largest first"""
+        return sorted(
+            ((size, root) for root, size in enumerate(self.cluster_sizes) if size >= min_size),
+            reverse=True
+        )
+
+    def stats(self):
+        linked = sum(size for size in self.cluster_sizes if size > 1)
+        return {
+            'customers': len(self.customer_ids),
+            'ips': len(self.ipv4) + len(self.ipv6),
+            'wallets': len(self.wallets),
+            'links': len(self.customer_identifiers),
+            'clusters': sum(1 for size in self.cluster_sizes if size > 1),
+            'linked_customers': linked,
+            'largest_cluster': max(self.cluster_sizes, default=0),
+        }
+
+def read_export_rows(filename):
+    """Yield the rows of a CSV, NDJSON or Parquet export"""
+    output_format = format_for(filename)
+    if output_format == 'parquet':
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ValueError("Reading Parquet exports needs the pyarrow package (pip install pyarrow)")
+        parquet = pq.ParquetFile(filename)
+        check_linkable(parquet.schema_arrow.names)
+        for batch in parquet.iter_batches(batch_size=10000, columns=['customer_id'] + [
+                column for column in LINKAGE_COLUMNS if column in parquet.schema_arrow.names]):
+            yield from batch.to_pylist()
+        return
+    if output_format not in ('csv', 'ndjson'):
+        raise ValueError(f"Cannot build a linkage index from a {output_format} export")
+
+    with open(filename, 'r', newline='', encoding='utf-8') as f:
+        if output_format == 'ndjson':
+            checked = False
+            for line in f:
+                if line.strip():
+                    row = json.loads(line)
+                    if not checked:
+                        check_linkable(row)
+                        checked = True
+                    yield row
+            return
+        reader = csv.DictReader(f)
+        check_linkable(reader.fieldnames or [])
+        yield from reader
+
+def build_from_export(filename, max_shared=50):
+    index = LinkageIndex(max_shared)
+    for row in read_export_rows(filename):
+        index.add_row(row)
+    index.finish()
+    return index
+
+def print_summary(index, path):
+    stats = index.stats()
+    print(f"Linkage index {path}: {stats['customers']} customers, {stats['ips']} IPs, {stats['wallets']} wallets, "
+          f"{stats['links']} links; {stats['clusters']} clusters linking {stats['linked_customers']} customers "
+          f"(largest {stats['largest_cluster']})")
+    if index.invalid_ips:
+        print(f"Skipped {index.invalid_ips} values that are not IP addresses")
+
+def _describe_identifiers(index, identifiers):
+    return ', '.join(f"{kind} {value}" for kind, value in (index.identifier_label(i) for i in identifiers))
+
+def query(index, customer_id=None, ip=None, wallet=None, limit=50):
+    if customer_id is not None:
+        customer = index.find_customer(customer_id)
+        if customer is None:
+            raise ValueError(f"Customer {customer_id} is not in the index")
+        customers = [customer]
+    else:
+        identifier = index.find_ip(ip) if ip is not None else index.find_wallet(wallet)
+        if identifier is None:
+            print(f"No customer has {'IP' if ip is not None else 'wallet'} {ip if ip is not None else wallet}")
+            return
+        customers = list(index.holders(identifier))
+        print(f"{len(customers)} customers have {_describe_identifiers(index, [identifier])}")
+
+    for customer in customers[:limit]:
+        root = index.cluster[customer]
+        print(f"\nCustomer {index.customer_ids[customer]}: cluster of {index.cluster_sizes[root]} customers "
+              f"(cluster {index.customer_ids[root]})")
+        neighbours = index.neighbours(customer)
+        print(f"  {len(neighbours)} customers share an identifier with it")
+        for other, shared in sorted(neighbours.items(), key=lambda item: -len(item[1]))[:limit]:
+            print(f"  - {index.customer_ids[other]}: {_describe_identifiers(index, shared)}")
+        hot = [i for i in index.identifiers_of(customer) if len(index.holders(i)) > index.max_shared]
+        if hot:
+            print(f"  Not used for clustering (shared by more than {index.max_shared} customers): "
+                  f"{_describe_identifiers(index, hot)}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Link ComPilot customers that share wallets or IP addresses")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = commands.add_parser("build", help="build an index from a CSV, NDJSON or Parquet export")
+    build_parser.add_argument("export")
+    build_parser.add_argument("--output", required=True, metavar="INDEX_FILE")
+    build_parser.add_argument("--max-shared", type=int, default=50,
+                              help="identifiers shared by more customers do not link them (default: 50)")
+
+    info_parser = commands.add_parser("info", help="summarize an index")
+    info_parser.add_argument("index")
+
+    query_parser = commands.add_parser("query", help="customers linked to a customer, IP or wallet")
+    query_parser.add_argument("index")
+    target = query_parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--customer", metavar="CUSTOMER_ID")
+    target.add_argument("--ip")
+    target.add_argument("--wallet")
+    query_parser.add_argument("--limit", type=int, default=50, help="customers listed at most (default: 50)")
+
+    clusters_parser = commands.add_parser("clusters", help="list the largest clusters")
+    clusters_parser.add_argument("index")
+    clusters_parser.add_argument("--min-size", type=int, default=2)
+    clusters_parser.add_argument("--top", type=int, default=20)
+    clusters_parser.add_argument("--members", action="store_true", help="list the customers of each cluster")
+    args = parser.parse_args()
+
+    try:
+        if args.command == "build":
+            started = time.monotonic()
+            index = build_from_export(args.export, args.max_shared)
+            index.save(args.output)
+            print_summary(index, args.output)
+            print(f"Built in {time.monotonic() - started:.1f}s")
+            return
+
+        index = LinkageIndex.load(args.index)
+        if args.command == "info":
+            print_summary(index, args.index)
+        elif args.command == "query":
+            query(index, args.customer, args.ip, args.wallet, args.limit)
+        else:
+            clusters = index.clusters(args.min_size)
+            print(f"{len(clusters)} clusters of at least {args.min_size} customers")
+            for size, root in clusters[:args.top]:
+                print(f"- {size} customers (cluster {index.customer_ids[root]})")
+                if args.members:
+                    for member in index.cluster_members(root):
+                        print(f"    {index.customer_ids[member]}")
+    except (ValueError, OSError) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
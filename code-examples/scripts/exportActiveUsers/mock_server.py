@@ -0,0 +1,324 @@
+"""
+Local stand-in for the ComPilot customer API.
+
+Serves the three endpoints the exporter uses, from a generated dataset:
+
+- GET /customers?currentPage=N&limit=M
+- GET /customers/{id}
+- GET /customers/{id}/ips
+
+It also simulates the parts of the real API that matter for performance:
+
+- latency:     fixed, uniform or lognormal per-request delay
+- errors:      a fraction of detail/IP requests answer 500
+- rate limits: fixed-window tiers (15/s and 300/min by default); requests over
+               budget get 429 with Retry-After, and X-RateLimit-* headers
+               can be advertised on every response
+- ETags:       If-None-Match is answered with 304 Not Modified
+
+Usage:
+    python mock_server.py --customers 1000 --latency 0.05 --error-rate 0.01
+    COMPILOT_API_URL=http://127.0.0.1:8765 COMPILOT_API_KEY=test python csvExport.py
+
+Any bearer token is accepted. The dataset is generated from --seed, so two
+servers started with the same options serve identical data.
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+LATENCY_DISTRIBUTIONS = ('fixed', 'uniform', 'lognormal')
+
+def parse_rate_limits(spec):
+    """Parse "15/1,300/60" into [(calls, period)] tiers; "" or "none" disables limiting"""
+    if not spec or spec.strip().lower() == 'none':
+        return []
+    tiers = []
+    for item in spec.split(','):
+        calls, _, period = item.strip().partition('/')
+        tiers.append((int(calls), float(period or 1)))
+    return tiers
+
+def generate_customers(count, onboarded_ratio=0.7, seed=0):
+    """The /customers listing entries plus the details and IPs behind them"""
+    rng = random.Random(seed)
+    customers = []
+    details = {}
+    ips = {}
+    for index in range(count):
+        customer_id = f"{index:08x}-mock-{rng.getrandbits(32):08x}"
+        level = "Onboarded" if rng.random() < onboarded_ratio else rng.choice(["Pending", "Started"])
+        created = f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T{rng.randint(0, 23):02d}:00:00Z"
+        customers.append({
+            "id": customer_id,
+            "onboarding_level": level,
+            "createdAt": created,
+            "updatedAt": created,
+        })
+        details[customer_id] = {
+            "id": customer_id,
+            "riskScore": rng.randint(0, 100),
+            "status": rng.choice(["Active", "Active", "Active", "Rejected"]),
+            "onboardingLevel": level,
+            "createdAt": created,
+            "customerClaims": [{
+                "name": f"Customer {index}",
+                "givenName": "Customer",
+                "familyName": str(index),
+                "nationality": rng.choice(["FR", "DE", "ES", "GB", "US"]),
+                "countryOfResidence": rng.choice(["FR", "DE", "ES", "GB", "US"]),
+                "birthdate": f"19{rng.randint(50, 99)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+            }],
+            "customerEmails": [{"email": f"customer{index}@example.com"}],
+            "customerWallets": [
+                {"wallet": "0x" + hashlib.sha1(f"{customer_id}:{n}".encode()).hexdigest()[:40]}
+                for n in range(rng.randint(0, 3))
+            ],
+        }
+        ips[customer_id] = [
+            {
+                "ipAddress": f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}",
+                "createdAt": f"2024-{month:02d}-01T00:00:00Z",
+            }
+            for month in range(1, rng.randint(1, 5) + 1)
+        ]
+    return customers, details, ips
+
+class FixedWindowLimiter:
+    """Server-side budget: at most `calls` requests per fixed window of `period` seconds, per tier"""
+
+    def __init__(self, tiers):
+        self.tiers = tiers
+        self.lock = threading.Lock()
+        self.windows = [(0, 0) for _ in tiers]
+
+    def check(self):
+        """Count one request; return (allowed, retry_after, headers)"""
+        now = time.time()
+        with self.lock:
+            retry_after = 0.0
+            for index, (calls, period) in enumerate(self.tiers):
+                window, used = self.windows[index]
+                current = int(now // period)
+                if current != window:
+                    window, used = current, 0
+                    self.windows[index] = (window, used)
+                if used >= calls:
+                    retry_after = max(retry_after, (window + 1) * period - now)
+
+            if retry_after:
+                return False, retry_after, self._headers(now)
+
+            for index, (window, used) in enumerate(self.windows):
+                self.windows[index] = (window, used + 1)
+            return True, 0.0, self._headers(now)
+
+    def _headers(self, now):
+        # Report the tier with the least remaining quota
+        if not self.tiers:
+            return {}
+        remaining, reset, calls, period = min(
+            (calls - used, (window + 1) * period - now, calls, period)
+            for (calls, period), (window, used) in zip(self.tiers, self.windows)
+        )
+        return {
+            'X-RateLimit-Limit': str(calls),
+            'X-RateLimit-Remaining': str(max(0, remaining)),
+            'X-RateLimit-Reset': f"{reset:.3f}",
+            'RateLimit-Policy': ', '.join(f"{calls};w={period:g}" for calls, period in self.tiers),
+        }
+
+class MockCompiLotAPI:
+    def __init__(self, customers=1000, onboarded_ratio=0.7, latency=0.05, latency_jitter=0.02,
+                 latency_distribution='fixed', error_rate=0.0, rate_limits=((15, 1), (300, 60)),
+                 rate_limit_headers=False, seed=0):
+        if latency_distribution not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution '{latency_distribution}' "
+                             f"(expected one of {', '.join(LATENCY_DISTRIBUTIONS)})")
+        self.customers, self.details, self.ips = generate_customers(customers, onboarded_ratio, seed)
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.latency_distribution = latency_distribution
+        self.error_rate = error_rate
+        self.limiter = FixedWindowLimiter(list(rate_limits or []))
+        self.rate_limit_headers = rate_limit_headers
+        self.rng = random.Random(seed + 1)
+        self.lock = threading.Lock()
+        self.server = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {'requests': 0, 'ok': 0, 'not_modified': 0, 'throttled': 0, 'errors': 0, 'not_found': 0}
+
+    def _count(self, key):
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats[key] += 1
+
+    def delay(self):
+        """Sampled latency of one request, in seconds"""
+        with self.lock:
+            if self.latency_distribution == 'uniform':
+                value = self.rng.uniform(self.latency - self.latency_jitter, self.latency + self.latency_jitter)
+            elif self.latency_distribution == 'lognormal' and self.latency > 0:
+                # Median `latency`, with a long tail controlled by the jitter
+                value = self.rng.lognormvariate(0, self.latency_jitter / self.latency) * self.latency
+            else:
+                value = self.latency
+        return max(0.0, value)
+
+    def fails(self):
+        with self.lock:
+            return self.rng.random() < self.error_rate
+
+    def handle(self, path, query):
+        """Return (status, body) for one GET request"""
+        parts = path.strip('/').split('/')
+        if parts == ['customers']:
+            page = max(1, int(query.get('currentPage', ['1'])[0]))
+            limit = max(1, int(query.get('limit', ['100'])[0]))
+            start = (page - 1) * limit
+            return 200, {"data": self.customers[start:start + limit], "totalCount": len(self.customers)}
+
+        if len(parts) in (2, 3) and parts[0] == 'customers' and parts[1] in self.details:
+            if self.fails():
+                return 500, {"message": "Simulated server error"}
+            if len(parts) == 2:
+                return 200, self.details[parts[1]]
+            if parts[2] == 'ips':
+                return 200, self.ips[parts[1]]
+
+        return 404, {"message": "Not found"}
+
+    def make_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body go out in two writes; with Nagle's algorithm
+            # the body then waits for the client's delayed ACK (~40 ms) on
+            # every reused connection
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, body=b'', headers=None):
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if body:
+                    self.wfile.write(body)
+
+            def do_GET(self):
+                allowed, retry_after, limit_headers = api.limiter.check()
+                headers = dict(limit_headers) if api.rate_limit_headers else {}
+                if not allowed:
+                    api._count('throttled')
+                    headers['Retry-After'] = str(max(1, round(retry_after)))
+                    self._send(429, b'{"message": "Too many requests"}', headers)
+                    return
+
+                time.sleep(api.delay())
+                url = urlparse(self.path)
+                status, body = api.handle(url.path, parse_qs(url.query))
+                content = json.dumps(body).encode('utf-8')
+                headers['Content-Type'] = 'application/json'
+
+                if status == 200:
+                    etag = '"' + hashlib.sha1(content).hexdigest()[:16] + '"'
+                    headers['ETag'] = etag
+                    if self.headers.get('If-None-Match') == etag:
+                        api._count('not_modified')
+                        self._send(304, headers={'ETag': etag})
+                        return
+                    api._count('ok')
+                else:
+                    api._count('errors' if status >= 500 else 'not_found')
+                self._send(status, content, headers)
+
+        return Handler
+
+    def start(self, host='127.0.0.1', port=0):
+        """Serve on a background thread and return the base URL"""
+        self.server = ThreadingHTTPServer((host, port), self.make_handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.url
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+def add_server_arguments(parser):
+    """Options shared by this script and benchmark.py"""
+    parser.add_argument("--customers", type=int, default=1000,
+                        help="number of customers in the listing (default: 1000)")
+    parser.add_argument("--onboarded-ratio", type=float, default=0.7,
+                        help="fraction of customers that are onboarded (default: 0.7)")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="median response latency in seconds (default: 0.05)")
+    parser.add_argument("--latency-jitter", type=float, default=0.02,
+                        help="latency spread in seconds for uniform/lognormal (default: 0.02)")
+    parser.add_argument("--latency-distribution", choices=LATENCY_DISTRIBUTIONS, default='fixed',
+                        help="latency distribution (default: fixed)")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of detail/IP requests answered with 500 (default: 0)")
+    parser.add_argument("--rate-limit", default="15/1,300/60",
+                        help="enforced CALLS/SECONDS tiers, or 'none' (default: 15/1,300/60)")
+    parser.add_argument("--rate-limit-headers", action="store_true",
+                        help="advertise X-RateLimit-* and RateLimit-Policy headers on every response")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="dataset and latency random seed (default: 0)")
+
+def api_from_args(args):
+    return MockCompiLotAPI(
+        customers=args.customers,
+        onboarded_ratio=args.onboarded_ratio,
+        latency=args.latency,
+        latency_jitter=args.latency_jitter,
+        latency_distribution=args.latency_distribution,
+        error_rate=args.error_rate,
+        rate_limits=parse_rate_limits(args.rate_limit),
+        rate_limit_headers=args.rate_limit_headers,
+        seed=args.seed,
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a local mock of the ComPilot customer API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    api = api_from_args(args)
+    url = api.start(args.host, args.port)
+    print(f"Mock ComPilot API serving {args.customers} customers on {url}")
+    print(f"Run the exporter with COMPILOT_API_URL={url}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"Requests served: {api.stats}")
+        api.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,403 @@
+"""
+Rate limiting for the ComPilot export scripts.
+
+RateLimiter schedules calls with GCRA (generic cell rate algorithm) over
+several tiers (15 calls/sec and 300 calls/min by default) and adapts those
+tiers at runtime from what the API reports:
+
+- 429 responses halve the rate and pause for Retry-After (AIMD decrease)
+- after that pause, successful responses ramp the rate back up over time,
+  by the full rate per recovery_time seconds (AIMD increase)
+- RateLimit-* / X-RateLimit-* headers pace calls so the remaining quota
+  lasts until the window resets, and an advertised RateLimit-Policy
+  replaces the configured guess for that window
+"""
+
+import asyncio
+import math
+import re
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+def _header(headers, *names):
+    for name in names:
+        value = headers.get(name)
+        if value is not None:
+            return value
+    return None
+
+def _first_number(value):
+    match = re.search(r'\d+(\.\d+)?', value or '')
+    return float(match.group()) if match else None
+
+def parse_retry_after(value):
+    """Parse a Retry-After header (delta seconds or HTTP date) into seconds"""
+    if value is None:
+        return None
+    value = value.strip()
+    if value.replace('.', '', 1).isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def parse_reset(value):
+    """Parse a rate limit reset header into seconds from now"""
+    reset = _first_number(value)
+    if reset is None:
+        return None
+    # Some servers send an epoch timestamp rather than a delay
+    if reset > 1e9:
+        reset -= time.time()
+    return max(0.0, reset)
+
+def parse_policy(value):
+    """Parse a RateLimit-Policy header ("300;w=60, 15;w=1") into (calls, period) pairs"""
+    policies = []
+    for item in (value or '').split(','):
+        match = re.match(r'\s*(\d+)\s*;.*?\bw=(\d+)', item)
+        if match:
+            policies.append((int(match.group(1)), int(match.group(2))))
+    return policies
+
+def burst_tiers(tiers, burst=None):
+    """
+    (calls, period, burst) for (calls, period) tiers. The shortest tier may
+    let up to `burst` calls (at most its calls) through back to back. By
+    default that is the largest burst that leaves its sustained rate at
+    least that of the longer tiers, which are then what paces long runs.
+    Longer tiers allow the same burst. Tiers that already have a burst keep
+    it.
+    """
+    shortest = min(tier[1] for tier in tiers)
+    short_calls = min(tier[0] for tier in tiers if tier[1] == shortest)
+    longer_rates = [tier[0] / tier[1] for tier in tiers if tier[1] > shortest]
+    if burst is None:
+        burst = short_calls - math.ceil(min(longer_rates) * shortest) + 1 if longer_rates else 1
+    burst = max(1, min(int(burst), int(short_calls)))
+    return [tuple(tier) if len(tier) > 2 else (tier[0], tier[1], max(1, min(burst, int(tier[0]))))
+            for tier in tiers]
+
+class RateTier:
+    """
+    One rate budget of `calls` per `period` seconds, tracked with GCRA. Up to
+    `burst` calls may go back to back; beyond that calls are spaced so that
+    no window of `period` seconds holds more than `calls`.
+    """
+
+    def __init__(self, calls, period, burst=1):
+        self.base_calls = calls
+        self.period = period
+        self.burst = burst
+        self.scale = 1.0
+        # Theoretical arrival time of the next call (time.monotonic() based)
+        self.tat = 0.0
+
+    @property
+    def calls(self):
+        return max(self.base_calls * self.scale, 1e-6)
+
+    @property
+    def burst_calls(self):
+        return max(1.0, min(self.burst * self.scale, self.calls))
+
+    @property
+    def interval(self):
+        # A burst uses up part of the window, so the sustained rate is lower
+        return self.period / max(self.calls - self.burst_calls + 1, 1e-6)
+
+    def earliest(self):
+        """Earliest time at which this tier admits another call"""
+        return self.tat - (self.burst_calls - 1) * self.interval
+
+    def record(self, start):
+        self.tat = max(self.tat, start) + self.interval
+
+    def pause_until(self, until):
+        self.tat = max(self.tat, until + (self.burst_calls - 1) * self.interval)
+
+    def restart_at(self, start):
+        self.tat = start + (self.burst_calls - 1) * self.interval
+
+class RateLimiter:
+    """
+    Multi-tier, adaptive GCRA rate limiter.
+
+    Every call reserves the earliest slot that all tiers agree on and then
+    sleeps exactly until that slot, so there is no polling and no slot is
+    lost. Tiers given as (calls, period) get bursts from burst_tiers(): an
+    idle limiter lets a short burst through at once (11 calls with the
+    default tiers), and calls are evenly spaced beyond it, never exceeding
+    any tier's budget over a sliding window. Pass tiers as (calls, period, 1)
+    for strictly even spacing.
+
+    Feed every response to update_from_response() so the limiter can follow
+    the server: throttling cuts the rate quickly, successes restore it
+    slowly, and advertised limits replace the configured ones.
+
+    Reservations are made under a lock, so one limiter can be shared by
+    several threads. Use acquire() from threads and acquire_async() from
+    coroutines. A throttling signal voids every reservation that has not
+    started yet, so waiting callers re-reserve against the reduced rate
+    instead of firing at the old one.
+    """
+
+    def __init__(self, calls_per_second=15, calls_per_minute=300, tiers=None,
+                 decrease_factor=0.5, recovery_time=None, min_scale=0.05,
+                 default_backoff=1.0, burst=None):
+        self.calls_per_second = calls_per_second
+        self.calls_per_minute = calls_per_minute
+        if tiers is None:
+            tiers = [(calls_per_second, 1), (calls_per_minute, 60)]
+        self.tiers = [RateTier(*tier) for tier in burst_tiers(tiers, burst)]
+        self._lock = threading.Lock()
+
+        # AIMD settings. The rate climbs back by its full value per
+        # recovery_time seconds, by default the longest tier's window
+        self.decrease_factor = decrease_factor
+        self.recovery_time = recovery_time or max(tier.period for tier in self.tiers)
+        self.min_scale = min_scale
+        self.default_backoff = default_backoff
+        self.scale = 1.0
+        # Responses to calls already in flight when the rate was cut report
+        # the same congestion, so only cut once per cooldown
+        self._decrease_cooldown_until = 0.0
+        # Time up to which the rate has been ramped back up
+        self._recovered_until = 0.0
+        # Bumped whenever outstanding reservations are voided
+        self.generation = 0
+
+        # Paces the remaining quota reported by the server until its reset
+        self.server_tier = None
+        self.server_tier_expires = 0.0
+
+        # Counters
+        self.calls = 0
+        self.delayed_calls = 0
+        self.throttled = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def _active_tiers(self, now):
+        if self.server_tier and now >= self.server_tier_expires:
+            self.server_tier = None
+        if self.server_tier:
+            return self.tiers + [self.server_tier]
+        return self.tiers
+
+    def reserve(self):
+        """Reserve the next permitted slot, returning (delay, generation)"""
+        with self._lock:
+            now = time.monotonic()
+            tiers = self._active_tiers(now)
+            start = max([now] + [tier.earliest() for tier in tiers])
+            for tier in tiers:
+                tier.record(start)
+            return start - now, self.generation
+
+    def _record_wait(self, waited):
+        with self._lock:
+            self.calls += 1
+            if waited > 0:
+                self.delayed_calls += 1
+                self.wait_time += waited
+                self.max_wait = max(self.max_wait, waited)
+
+    def acquire(self):
+        """Block the calling thread until the next permitted slot"""
+        started = time.monotonic()
+        waited = 0.0
+        while True:
+            delay, generation = self.reserve()
+            if delay > 0:
+                time.sleep(delay)
+                waited = time.monotonic() - started
+            if generation == self.generation:
+                break
+        self._record_wait(waited)
+
+    async def acquire_async(self):
+        """Wait on the event loop until the next permitted slot"""
+        started = time.monotonic()
+        waited = 0.0
+        while True:
+            delay, generation = self.reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                waited = time.monotonic() - started
+            if generation == self.generation:
+                break
+        self._record_wait(waited)
+
+    # Backwards-compatible name
+    wait_if_needed = acquire
+
+    def _set_scale(self, scale):
+        self.scale = min(1.0, max(self.min_scale, scale))
+        for tier in self.tiers:
+            tier.scale = self.scale
+
+    def _pause_until(self, until):
+        for tier in self.tiers:
+            tier.pause_until(until)
+
+    def _apply_headers(self, headers, now):
+        # An advertised policy is the real budget for our key
+        policy = _header(headers, 'RateLimit-Policy', 'X-RateLimit-Policy')
+        for calls, period in parse_policy(policy):
+            for tier in self.tiers:
+                if tier.period == period:
+                    tier.base_calls = calls
+                    tier.burst = max(1, min(tier.burst, calls))
+                    break
+            else:
+                tier = RateTier(calls, period)
+                tier.scale = self.scale
+                self.tiers.append(tier)
+
+        remaining = _first_number(_header(headers, 'RateLimit-Remaining', 'X-RateLimit-Remaining'))
+        reset = parse_reset(_header(headers, 'RateLimit-Reset', 'X-RateLimit-Reset'))
+        if remaining is None or reset is None:
+            return
+
+        if remaining < 1:
+            self._pause_until(now + reset)
+        elif reset > 0:
+            # Spread what is left of the window evenly until it resets
+            if self.server_tier is None:
+                self.server_tier = RateTier(remaining, reset)
+                self.server_tier.tat = now
+            else:
+                self.server_tier.base_calls = remaining
+                self.server_tier.period = reset
+            self.server_tier_expires = now + reset
+
+    def update_from_response(self, status_code, headers):
+        """Adapt the budget to the status code and rate limit headers of one response"""
+        with self._lock:
+            now = time.monotonic()
+            self._apply_headers(headers, now)
+
+            if self.is_throttled(status_code, headers):
+                retry_after = parse_retry_after(headers.get('Retry-After'))
+                backoff = retry_after if retry_after is not None else self.default_backoff
+                self.throttled += 1
+                if now >= self._decrease_cooldown_until:
+                    self._set_scale(self.scale * self.decrease_factor)
+                    self._decrease_cooldown_until = now + max(backoff, self.default_backoff)
+                    self._recovered_until = self._decrease_cooldown_until
+                    # Void outstanding reservations and restart after the pause
+                    self.generation += 1
+                    for tier in self.tiers:
+                        tier.restart_at(now + backoff)
+                else:
+                    self._pause_until(now + backoff)
+            elif 200 <= status_code < 300 and self.scale < 1.0 and now > self._recovered_until:
+                # Ramp up by the time since the last increase (or the end of
+                # the pause), however many calls succeeded in it
+                self._set_scale(self.scale + (now - self._recovered_until) / self.recovery_time)
+                self._recovered_until = now
+
+    @staticmethod
+    def is_throttled(status_code, headers):
+        """Whether a response should be re-queued rather than treated as a failure"""
+        return status_code == 429 or (status_code == 503 and 'Retry-After' in headers)
+
+    def current_rates(self):
+        """Effective (calls, period) of every tier"""
+        with self._lock:
+            return [(tier.calls, tier.period) for tier in self.tiers]
+
+    def stats(self):
+        """Counters describing how much time was spent waiting on the budget"""
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'delayed_calls': self.delayed_calls,
+                'throttled': self.throttled,
+                'wait_time': self.wait_time,
+                'max_wait': self.max_wait,
+                'rate_scale': self.scale,
+            }
+
+class SharedRateLimiter(RateLimiter):
+    """
+    RateLimiter whose budget is shared by several processes.
+
+    The GCRA state (each configured tier's theoretical arrival time, the
+    AIMD scale, the decrease cooldown, the recovery time and the
+    reservation generation) lives
+    in a multiprocessing.Array, and is loaded and stored under the array's
+    lock around every reservation and response. Every process therefore
+    draws from one budget and reacts to throttling seen by any of them.
+    time.monotonic() is system-wide, so the timestamps are comparable.
+
+    Create one in the parent and pass `limiter.shared` (with the same
+    tiers) to each worker process:
+
+        limiter = SharedRateLimiter(tiers=tiers)
+        Process(target=work, args=(tiers, limiter.shared))
+        ...
+        limiter = SharedRateLimiter(tiers=tiers, shared=shared)  # in the worker
+
+    Tiers added later from RateLimit-Policy headers, and the pacing from
+    remaining-quota headers, stay local to each process.
+    """
+
+    # Layout of the shared array; tier TATs follow
+    GENERATION, SCALE, COOLDOWN, RECOVERED, TATS = range(5)
+
+    def __init__(self, *args, shared=None, context=None, **kwargs):
+        self.shared = None
+        super().__init__(*args, **kwargs)
+        if shared is None:
+            import multiprocessing
+            shared = (context or multiprocessing).Array('d', self.TATS + len(self.tiers))
+            shared[self.SCALE] = 1.0
+        self.shared = shared
+        self.shared_tiers = self.tiers[:len(shared) - self.TATS]
+
+    @property
+    def generation(self):
+        if self.shared is None:
+            return self._generation
+        return int(self.shared[self.GENERATION])
+
+    @generation.setter
+    def generation(self, value):
+        if self.shared is None:
+            self._generation = value
+        else:
+            self.shared[self.GENERATION] = value
+
+    def _load(self):
+        shared = self.shared
+        if shared[self.SCALE] != self.scale:
+            self._set_scale(shared[self.SCALE])
+        self._decrease_cooldown_until = shared[self.COOLDOWN]
+        self._recovered_until = shared[self.RECOVERED]
+        for index, tier in enumerate(self.shared_tiers):
+            tier.tat = shared[self.TATS + index]
+
+    def _save(self):
+        shared = self.shared
+        shared[self.SCALE] = self.scale
+        shared[self.COOLDOWN] = self._decrease_cooldown_until
+        shared[self.RECOVERED] = self._recovered_until
+        for index, tier in enumerate(self.shared_tiers):
+            shared[self.TATS + index] = tier.tat
+
+    def reserve(self):
+        with self.shared.get_lock():
+            self._load()
+            result = super().reserve()
+            self._save()
+            return result
+
+    def update_from_response(self, status_code, headers):
+        with self.shared.get_lock():
+            self._load()
+            super().update_from_response(status_code, headers)
+            self._save()
@@ -0,0 +1,216 @@
+"""
+Persistent response cache for the ComPilot export scripts.
+
+ResponseCache stores successful GET responses in a SQLite file, keyed by
+URL, query parameters and a scope (a hash of the API key, so workspaces
+never share entries). Each endpoint has its own TTL:
+
+- list:    GET /customers                (default 0, always fetched)
+- details: GET /customers/{id}           (default 1 hour)
+- ips:     GET /customers/{id}/ips       (default 1 hour)
+
+Fresh entries are served without an API call. Stale entries that carry an
+ETag are revalidated with If-None-Match, and a 304 refreshes them. Once the
+cache grows past max_bytes, the least recently used entries are evicted.
+
+Any object with the same lookup() / store() / revalidated() methods can be
+plugged into CompiLotExporter.response_cache instead.
+"""
+
+import json
+import re
+import sqlite3
+import threading
+import time
+from urllib.parse import urlencode, urlparse
+
+DEFAULT_TTLS = {
+    'list': 0,
+    'details': 3600,
+    'ips': 3600,
+}
+
+ENDPOINTS = [
+    ('ips', re.compile(r'/customers/[^/]+/ips/?$')),
+    ('details', re.compile(r'/customers/[^/]+/?$')),
+    ('list', re.compile(r'/customers/?$')),
+]
+
+def endpoint_for(url):
+    path = urlparse(url).path
+    for name, pattern in ENDPOINTS:
+        if pattern.search(path):
+            return name
+    return None
+
+def parse_ttls(spec):
+    """Parse "details=3600,ips=600" into a TTL mapping on top of the defaults"""
+    ttls = dict(DEFAULT_TTLS)
+    for item in filter(None, (part.strip() for part in (spec or '').split(','))):
+        name, _, seconds = item.partition('=')
+        if name not in ttls:
+            raise ValueError(f"Unknown cache endpoint '{name}' (expected one of {', '.join(ttls)})")
+        ttls[name] = float(seconds)
+    return ttls
+
+class CachedResponse:
+    """Minimal stand-in for a requests/httpx response served from the cache"""
+    from_cache = True
+
+    def __init__(self, status_code, content, headers):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.content)
+
+class ResponseCache:
+    def __init__(self, path, ttls=None, max_bytes=256 * 1024 * 1024):
+        self.path = path
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # Sharded exports share one cache file between processes
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        # WAL keeps the per-hit commits cheap and lets other readers in
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                endpoint TEXT NOT NULL,
+                content BLOB NOT NULL,
+                content_type TEXT,
+                etag TEXT,
+                stored_at REAL NOT NULL,
+                last_access REAL NOT NULL,
+                size INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access);
+        """)
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+
+    @staticmethod
+    def key(method, url, params=None, scope=''):
+        query = urlencode(sorted((params or {}).items()))
+        return f"{scope}:{method.upper()} {url}?{query}"
+
+    def _response(self, row):
+        content, content_type, etag = row
+        headers = {'Content-Type': content_type or 'application/json'}
+        if etag:
+            headers['ETag'] = etag
+        return CachedResponse(200, content, headers)
+
+    def lookup(self, method, url, params=None, scope=''):
+        """
+        Return (response, etag) for a request.
+
+        response is a CachedResponse when a fresh entry exists. Otherwise
+        etag is set when a stale entry can be revalidated.
+        """
+        endpoint = endpoint_for(url)
+        if method.upper() != 'GET' or not self.ttls.get(endpoint):
+            return None, None
+
+        key = self.key(method, url, params, scope)
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT content, content_type, etag, stored_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None, None
+
+            content, content_type, etag, stored_at = row
+            if now - stored_at <= self.ttls[endpoint]:
+                self.conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+                self.conn.commit()
+                self.hits += 1
+                return self._response((content, content_type, etag)), None
+
+            self.misses += 1
+            return None, etag
+
+    def store(self, method, url, params, response, scope=''):
+        """Remember a successful response"""
+        endpoint = endpoint_for(url)
+        if method.upper() != 'GET' or response.status_code != 200 or not self.ttls.get(endpoint):
+            return
+
+        key = self.key(method, url, params, scope)
+        content = response.content
+        now = time.time()
+        with self.lock:
+            old = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses "
+                "(key, endpoint, content, content_type, etag, stored_at, last_access, size) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, endpoint, content, response.headers.get('Content-Type'),
+                 response.headers.get('ETag'), now, now, len(content))
+            )
+            self.total_bytes += len(content) - (old[0] if old else 0)
+            self._evict()
+            self.conn.commit()
+
+    def revalidated(self, method, url, params=None, scope=''):
+        """Refresh a stale entry after a 304 Not Modified and return it"""
+        key = self.key(method, url, params, scope)
+        now = time.time()
+        with self.lock:
+            self.conn.execute("UPDATE responses SET stored_at = ?, last_access = ? WHERE key = ?", (now, now, key))
+            self.conn.commit()
+            row = self.conn.execute(
+                "SELECT content, content_type, etag FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            self.revalidations += 1
+            return self._response(row) if row else None
+
+    def discard(self, method, url, params=None, scope=''):
+        """Forget the entry for a request, e.g. when its content turned out to be malformed"""
+        key = self.key(method, url, params, scope)
+        with self.lock:
+            old = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            if old:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.total_bytes -= old[0]
+                self.conn.commit()
+
+    def _evict(self):
+        # Drop least recently used entries in batches until under the limit
+        while self.total_bytes > self.max_bytes:
+            rows = self.conn.execute(
+                "SELECT key, size FROM responses ORDER BY last_access LIMIT 100"
+            ).fetchall()
+            if not rows:
+                self.total_bytes = 0
+                break
+            for key, size in rows:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.total_bytes -= size
+                if self.total_bytes <= self.max_bytes:
+                    break
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'revalidations': self.revalidations,
+                'bytes': self.total_bytes,
+            }
+
+    def close(self):
+        self.conn.close()
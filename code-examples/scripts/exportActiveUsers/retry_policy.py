@@ -0,0 +1,115 @@
+"""
+Retries and circuit breaking for the ComPilot export scripts.
+
+Throttling (429) is handled by the RateLimiter, which re-queues the call.
+This module covers the other transient failures:
+
+- RetryPolicy:    which responses are worth retrying (408 and 5xx), and how
+                  long to back off between attempts (exponential, full jitter)
+- CircuitBreaker: after `failure_threshold` consecutive calls that failed
+                  even after their retries, new calls wait for
+                  `reset_timeout` seconds; then a single trial call decides
+                  whether to close it again while the others keep waiting.
+                  A flaky stretch of the API is ridden out instead of every
+                  queued customer failing at once
+"""
+
+import asyncio
+import random
+import threading
+import time
+
+class RetryPolicy:
+    RETRYABLE_STATUSES = {408, 500, 502, 503, 504}
+
+    def __init__(self, max_retries=4, base_delay=0.5, max_delay=30.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def is_retryable(self, status_code):
+        return status_code in self.RETRYABLE_STATUSES
+
+    def backoff(self, attempt):
+        """Seconds to wait before retry number `attempt` (1-based)"""
+        # Full jitter keeps clients that failed together from retrying together
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=10, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+
+        # Counters
+        self.times_opened = 0
+        self.delayed = 0
+        self.wait_time = 0.0
+
+    def _delay(self):
+        # Seconds a new call must wait before checking again, or 0 if it may go out now
+        with self.lock:
+            elapsed = time.monotonic() - self.opened_at
+            if self.state == self.OPEN and elapsed >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.trial_in_flight = False
+
+            if self.state == self.CLOSED:
+                return 0.0
+            if self.state == self.HALF_OPEN and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return 0.0
+            if self.state == self.OPEN:
+                return self.reset_timeout - elapsed
+            # The trial call is still in flight
+            return min(1.0, self.reset_timeout)
+
+    def before_call(self):
+        """
+        Wait until a new call may go out. Every call that passes must end with
+        record_success() or record_failure(), once its retries are over.
+        """
+        delay = self._delay()
+        if delay:
+            self.delayed += 1
+        while delay:
+            time.sleep(delay)
+            self.wait_time += delay
+            delay = self._delay()
+
+    async def before_call_async(self):
+        """Async variant of before_call"""
+        delay = self._delay()
+        if delay:
+            self.delayed += 1
+        while delay:
+            await asyncio.sleep(delay)
+            self.wait_time += delay
+            delay = self._delay()
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        """Record a call that failed after all its retries"""
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.times_opened += 1
+                    print(f"Circuit breaker opened after {self.failures} consecutive failed calls; "
+                          f"new calls wait {self.reset_timeout:g}s")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self.trial_in_flight = False
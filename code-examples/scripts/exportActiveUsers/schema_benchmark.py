@@ -0,0 +1,113 @@
+"""
+Micro-benchmark of payload decoding and row building for the ComPilot exporter.
+
+Runs offline on detail and IP payloads generated by mock_server.py, and
+compares the decode + build_row paths of schema.py for every decoder that is
+installed:
+
+- json:    response.json()-style stdlib decoding into dicts (the old path)
+- orjson:  orjson decoding into dicts
+- msgspec: msgspec decoding into typed structs
+- compiled: the fastest dict decoder with the row built by the compiled
+            default column spec (column_spec.py) instead of details_row()
+
+For each path it reports:
+
+- rows/sec:     customers decoded and turned into rows per second of CPU time
+- blocks/row:   memory blocks the decoded payloads of one customer hold,
+                counted with tracemalloc
+- bytes/row:    memory those decoded payloads hold
+
+Usage:
+    python schema_benchmark.py --customers 2000 --repeat 5
+    python schema_benchmark.py --padding 40
+
+--padding adds that many unused fields to every detail payload, as the live
+API returns far more fields than the export reads.
+"""
+
+import argparse
+import json
+import time
+import tracemalloc
+
+import schema
+from column_spec import DEFAULT_SPEC, ColumnSpec
+from mock_server import generate_customers
+
+def make_payloads(count, padding, seed):
+    """(details bytes, IP bytes) for `count` customers"""
+    customers, details, ips = generate_customers(count, seed=seed)
+    payloads = []
+    for customer in customers:
+        detail = dict(details[customer['id']])
+        for n in range(padding):
+            detail[f"extraField{n}"] = {"value": f"unused {n}", "updatedAt": detail['createdAt']}
+        payloads.append((json.dumps(detail).encode('utf-8'), json.dumps(ips[customer['id']]).encode('utf-8')))
+    return payloads
+
+def schema_row(details, ips):
+    row = schema.details_row(details)
+    row['ip_addresses'], row['latest_ip'], row['latest_ip_date'] = schema.ip_columns(ips)
+    return row
+
+def decoder_paths():
+    """The (decode details, decode IPs, build row) functions to compare, by name"""
+    paths = {'json': (schema.json_loads, schema.json_loads, schema_row)}
+    if schema.orjson is not None:
+        paths['orjson'] = (schema.orjson.loads, schema.orjson.loads, schema_row)
+    if schema.msgspec is not None:
+        paths['msgspec'] = (schema.decode_details, schema.decode_ips, schema_row)
+    loads = schema.orjson.loads if schema.orjson is not None else schema.fast_loads
+    paths['compiled'] = (loads, loads, ColumnSpec(DEFAULT_SPEC).extract)
+    return paths
+
+def build_rows(payloads, decode_details, decode_ips, build_row):
+    return [build_row(decode_details(detail), decode_ips(ips)) for detail, ips in payloads]
+
+def measure(payloads, decode_details, decode_ips, build_row, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.process_time()
+        build_rows(payloads, decode_details, decode_ips, build_row)
+        elapsed = time.process_time() - started
+        best = elapsed if best is None else min(best, elapsed)
+
+    # Allocations of the decoded payloads themselves: everything decoding
+    # builds and the row is later read from
+    tracemalloc.start()
+    decoded = [(decode_details(detail), decode_ips(ips)) for detail, ips in payloads]
+    current = tracemalloc.get_traced_memory()[0]
+    blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+    tracemalloc.stop()
+    del decoded
+
+    return {
+        'rows_per_sec': len(payloads) / best if best else float('inf'),
+        'blocks_per_row': blocks / len(payloads),
+        'bytes_per_row': current / len(payloads),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark decoding and row building for each JSON decoder")
+    parser.add_argument("--customers", type=int, default=2000, help="payloads to decode (default: 2000)")
+    parser.add_argument("--padding", type=int, default=20,
+                        help="unused fields added to every detail payload (default: 20)")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per decoder; the best counts (default: 5)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    payloads = make_payloads(args.customers, args.padding, args.seed)
+    print(f"{args.customers} customers, {sum(len(d) + len(i) for d, i in payloads) / len(payloads):.0f} "
+          f"bytes of JSON per customer, exporter decoder: {schema.DECODER}")
+    print(f"{'decoder':<10}{'rows/sec':>12}{'speedup':>10}{'blocks/row':>12}{'bytes/row':>11}")
+
+    baseline = None
+    for name, (decode_details, decode_ips, build_row) in decoder_paths().items():
+        result = measure(payloads, decode_details, decode_ips, build_row, args.repeat)
+        baseline = baseline or result['rows_per_sec']
+        print(f"{name:<10}{result['rows_per_sec']:>12,.0f}{result['rows_per_sec'] / baseline:>9.2f}x"
+              f"{result['blocks_per_row']:>12.1f}{result['bytes_per_row']:>11,.0f}")
+
+if __name__ == "__main__":
+    main()
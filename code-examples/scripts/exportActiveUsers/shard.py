@@ -0,0 +1,278 @@
+"""
+Multi-process (sharded) exports for the ComPilot export scripts.
+
+Once the network side is concurrent, one process is bound by a single core
+for JSON decoding and row encoding. export_sharded() splits the listing
+into page ranges, one per worker process. Each worker runs a normal
+checkpointed export into its own shard file, drawing from one
+SharedRateLimiter so that together they never exceed the per-key budget.
+When every shard has finished, the shard files are concatenated in page
+order into the requested output, and their dead letters are merged.
+
+The listing can shift while the shards run, as customers are onboarded or
+removed, so a customer near a range boundary may be listed in both
+neighbouring ranges, or in neither. Neighbouring ranges therefore overlap
+by one page, and the merge keeps only the first row of every customer ID.
+Shards always export customer_id for this; it is dropped from the merged
+output when it was not among the selected columns.
+
+Progress is kept in <output>.shards.json. After a crash, running again
+with resume=True (--resume <output>) restarts only the unfinished shards,
+each from its own checkpoint.
+
+CSV and Parquet output are supported. Incremental state, CDC state and
+SQLite output are single-writer files, so they are not available in
+sharded mode.
+"""
+
+import csv
+import json
+import math
+import multiprocessing
+import os
+import queue
+
+from checkpoint import ExportCheckpoint
+from dead_letter import DeadLetterFile, read_dead_letters, write_dead_letters
+from id_set import IdSet
+from rate_limiter import SharedRateLimiter
+from sinks import SINKS, sink_for
+
+SHARDABLE_FORMATS = ('csv', 'parquet')
+
+def manifest_path(filename):
+    return f"{filename}.shards.json"
+
+def shard_path(filename, index):
+    root, ext = os.path.splitext(filename)
+    return f"{root}.shard{index}{ext}"
+
+def plan_shards(total_pages, shards):
+    """
+    Split pages 1..total_pages into at most `shards` (start, end) ranges,
+    each also covering the first page of the next
+    """
+    per_shard = max(1, math.ceil(total_pages / shards))
+    ranges = []
+    for start in range(1, max(total_pages, 1) + 1, per_shard):
+        ranges.append([start, start + per_shard])
+    # The last shard also takes pages added while the export runs
+    ranges[-1][1] = None
+    return ranges
+
+def _save_manifest(filename, manifest):
+    tmp_path = manifest_path(filename) + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path(filename))
+
+def shard_columns(columns):
+    return columns if 'customer_id' in columns else ['customer_id'] + columns
+
+def _exporter_settings(exporter):
+    cache = exporter.response_cache
+    return {
+        'api_token': exporter.api_token,
+        'base_url': exporter.base_url,
+        'page_size': exporter.page_size,
+        'page_concurrency': exporter.page_concurrency,
+        'pool_size': exporter.pool_size,
+        'http2': exporter.http2,
+        # The merge dedupes shards by customer_id
+        'columns': shard_columns(exporter.plan.columns),
+        'request_timeout': exporter.request_timeout,
+        'max_retries': exporter.retry_policy.max_retries,
+        'cache': (cache.path, cache.ttls, cache.max_bytes) if cache else None,
+    }
+
+def _run_shard(settings, index, start_page, end_page, path, output_format, concurrency, resume, sink_options,
+               tiers, shared, results):
+    # Worker process entry point: export one page range into its shard file
+    from csvExport import CompiLotExporter
+    from column_plan import FetchPlan
+    from response_cache import ResponseCache
+
+    cache = ResponseCache(*settings['cache']) if settings['cache'] else None
+    exporter = CompiLotExporter(api_token=settings['api_token'], response_cache=cache)
+    exporter.base_url = settings['base_url']
+    exporter.page_size = settings['page_size']
+    exporter.page_concurrency = settings['page_concurrency']
+    exporter.pool_size = settings['pool_size']
+    exporter.http2 = settings['http2']
+    exporter.plan = FetchPlan(settings['columns'])
+    exporter.request_timeout = settings['request_timeout']
+    exporter.retry_policy.max_retries = settings['max_retries']
+    exporter.rate_limiter = SharedRateLimiter(tiers=tiers, shared=shared)
+    exporter.end_page = end_page
+
+    print(f"Shard {index}: {'resuming' if resume else 'exporting'} pages {start_page}-{end_page or 'end'}")
+    rows = exporter.export_to_file(path, output_format, concurrency=concurrency, resume=resume,
+                                   sink_options=sink_options, start_page=start_page)
+    exporter.close()
+    if cache:
+        cache.close()
+
+    stats = exporter.rate_limiter.stats()
+    print(f"Shard {index}: {rows} customers exported, {stats['calls']} API calls, "
+          f"{stats['throttled']} throttled, {stats['wait_time']:.1f}s waiting")
+    results.put((index, rows))
+
+def _merge_csv(filename, paths, drop_id):
+    # Returns (rows written, duplicate rows left out)
+    seen = IdSet()
+    rows = duplicates = 0
+    with open(filename, 'w', newline='', encoding='utf-8') as out:
+        writer = csv.writer(out)
+        for number, path in enumerate(paths):
+            with open(path, 'r', newline='', encoding='utf-8') as shard:
+                reader = csv.reader(shard)
+                header = next(reader)
+                id_index = header.index('customer_id')
+                if number == 0:
+                    writer.writerow(header[1:] if drop_id else header)
+                for row in reader:
+                    if not seen.add(row[id_index]):
+                        duplicates += 1
+                        continue
+                    writer.writerow(row[1:] if drop_id else row)
+                    rows += 1
+        out.flush()
+        os.fsync(out.fileno())
+    return rows, duplicates
+
+def _merge_parquet(filename, paths, compression, drop_id):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    seen = IdSet()
+    rows = duplicates = 0
+    writer = None
+    try:
+        for path in paths:
+            shard = pq.ParquetFile(path)
+            if writer is None:
+                schema = shard.schema_arrow.remove(0) if drop_id else shard.schema_arrow
+                writer = pq.ParquetWriter(filename, schema,
+                                          compression=None if compression == 'none' else compression)
+            # One row group at a time, so memory stays bounded
+            for group in range(shard.num_row_groups):
+                table = shard.read_row_group(group)
+                keep = [seen.add(customer_id) for customer_id in table.column('customer_id').to_pylist()]
+                if not all(keep):
+                    duplicates += keep.count(False)
+                    table = table.filter(pa.array(keep))
+                if drop_id:
+                    table = table.remove_column(0)
+                writer.write_table(table)
+                rows += table.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows, duplicates
+
+def export_sharded(exporter, filename, shards, output_format='csv', concurrency=None, resume=False,
+                   sink_options=None):
+    """
+    Export with `shards` worker processes sharing `exporter`'s settings and
+    rate budget, merging their output into `filename`. Returns the number of
+    customers exported.
+    """
+    if output_format not in SHARDABLE_FORMATS:
+        raise ValueError(f"Sharded exports support {', '.join(SHARDABLE_FORMATS)} output, not {output_format}")
+    if sink_for(output_format, sink_options) is not SINKS[output_format]:
+        raise ValueError("Sharded exports cannot be compressed or rotated")
+
+    if resume:
+        if not os.path.exists(manifest_path(filename)):
+            raise ValueError(f"No shard manifest found for {filename} (expected {manifest_path(filename)})")
+        with open(manifest_path(filename), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        exporter.page_size = manifest['page_size']
+        print(f"Resuming sharded export of {filename}: {len(manifest['done'])} of "
+              f"{len(manifest['ranges'])} shards already complete")
+    else:
+        # One listing call tells us how many pages there are to split
+        first_page = exporter.fetch_page(1)
+        total_pages = math.ceil(first_page["totalCount"] / exporter.page_size)
+        manifest = {
+            'format': output_format,
+            'page_size': exporter.page_size,
+            'ranges': plan_shards(total_pages, shards),
+            'done': [],
+            'rows': {},
+        }
+        _save_manifest(filename, manifest)
+        print(f"Exporting {total_pages} pages with {len(manifest['ranges'])} worker processes")
+
+    # Workers are spawned rather than forked: the parent may already run
+    # threads (the async engine), which do not survive a fork
+    context = multiprocessing.get_context('spawn')
+    tiers = [(tier.base_calls, tier.period, tier.burst) for tier in exporter.rate_limiter.tiers]
+    limiter = SharedRateLimiter(tiers=tiers, context=context)
+    results = context.Queue()
+    settings = _exporter_settings(exporter)
+
+    workers = []
+    for index, (start_page, end_page) in enumerate(manifest['ranges']):
+        if index in manifest['done']:
+            continue
+        path = shard_path(filename, index)
+        resume_shard = (resume and SINKS[output_format].resumable
+                        and os.path.exists(ExportCheckpoint.path_for(path)))
+        worker = context.Process(
+            target=_run_shard,
+            args=(settings, index, start_page, end_page, path, output_format, concurrency, resume_shard,
+                  sink_options, tiers, limiter.shared, results),
+            name=f"shard-{index}"
+        )
+        worker.start()
+        workers.append((index, worker))
+
+    # Results are read while the workers run: a worker only exits once what
+    # it put on the queue has been read
+    finished = {}
+    while True:
+        try:
+            index, rows = results.get(timeout=0.5)
+        except queue.Empty:
+            if not any(worker.is_alive() for _, worker in workers):
+                break
+            continue
+        finished[index] = rows
+    for index, worker in workers:
+        worker.join()
+    for index, worker in workers:
+        if worker.exitcode == 0 and index in finished:
+            manifest['done'].append(index)
+            manifest['rows'][str(index)] = finished[index]
+    _save_manifest(filename, manifest)
+
+    failed = [index for index, worker in workers if index not in manifest['done']]
+    if failed:
+        raise Exception(f"Shard(s) {', '.join(map(str, failed))} failed; "
+                        f"run again with --resume {filename} to finish them")
+
+    paths = [shard_path(filename, index) for index in range(len(manifest['ranges']))]
+    print(f"Merging {len(paths)} shards into {filename}")
+    drop_id = 'customer_id' not in exporter.plan.columns
+    if output_format == 'parquet':
+        rows, duplicates = _merge_parquet(filename, paths, (sink_options or {}).get('compression', 'zstd'), drop_id)
+    else:
+        rows, duplicates = _merge_csv(filename, paths, drop_id)
+    if duplicates:
+        print(f"Left out {duplicates} rows of customers exported by two shards")
+
+    dead_letters = []
+    for path in paths:
+        dead_letters.extend(read_dead_letters(DeadLetterFile.path_for(path)))
+    write_dead_letters(DeadLetterFile.path_for(filename), dead_letters)
+    if dead_letters:
+        print(f"{len(dead_letters)} customers could not be fetched; they are listed in "
+              f"{DeadLetterFile.path_for(filename)}")
+
+    for path in paths:
+        for leftover in (path, DeadLetterFile.path_for(path)):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    os.remove(manifest_path(filename))
+    return rows
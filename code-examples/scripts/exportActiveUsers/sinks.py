@@ -0,0 +1,577 @@
+"""
+Output sinks for the ComPilot export scripts.
+
+Rows are dicts whose wallets and ip_addresses are lists. Each sink stores
+them in its own format:
+
+- CsvSink:     one text row per customer; lists are joined with ", "
+- NdjsonSink:  one JSON object per customer, with lists as JSON arrays
+- ParquetSink: Arrow record batches with list<string> wallets/IPs, typed
+               timestamps and dates, written in row groups of a configurable
+               size and compression (needs the pyarrow package)
+- SqliteSink:  upserts into indexed customers, wallets and ips tables, so
+               repeated exports update one database in place; a complete
+               run also removes customers that are no longer listed
+- CompressedCsvSink / CompressedNdjsonSink: gzip or zstd compressed CSV or
+               NDJSON, optionally rotated into parts of a maximum row count
+               or size, with a manifest of the parts (see CompressedSink)
+
+Every sink has write(row), close() and sync(). sync() makes the rows written
+so far durable and returns the offset they end at, which ExportCheckpoint
+stores. On resume, discard_after(path, offset) drops anything written after
+that point. A Parquet file is only readable once closed, so it cannot be
+resumed, and neither can a compressed or rotated export.
+
+sink_for(output_format, sink_options) picks the sink class for an export.
+
+Example lookups on a SQLite export:
+
+    SELECT customer_id FROM wallets WHERE wallet = '0xabc...';
+    SELECT customer_id FROM ips WHERE ip_address = '203.0.113.7';
+"""
+
+import csv
+import gzip
+import hashlib
+import io
+import json
+import os
+import queue
+import sqlite3
+import threading
+from datetime import date, datetime, timezone
+
+LIST_COLUMNS = {'wallets', 'ip_addresses'}
+TIMESTAMP_COLUMNS = {'date_onboarded', 'latest_ip_date'}
+DATE_COLUMNS = {'birthdate'}
+FLOAT_COLUMNS = {'risk_score'}
+
+PARQUET_COMPRESSIONS = ('zstd', 'snappy', 'gzip', 'brotli', 'lz4', 'none')
+STREAM_COMPRESSIONS = ('gzip', 'zstd')
+
+def as_list(value):
+    """A list column value; rows stored by older versions hold joined strings"""
+    if value is None or value == '':
+        return []
+    if isinstance(value, str):
+        return value.split(', ')
+    return list(value)
+
+def flatten_row(row):
+    """The row with its list columns joined for text output"""
+    return {
+        key: ', '.join(value) if isinstance(value, (list, tuple)) else value
+        for key, value in row.items()
+    }
+
+def parse_timestamp(value):
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        return value
+    try:
+        parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+def parse_date(value):
+    if not value:
+        return None
+    if isinstance(value, date):
+        return value
+    try:
+        return date.fromisoformat(str(value)[:10])
+    except ValueError:
+        return None
+
+def parse_float(value):
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+class CsvSink:
+    resumable = True
+
+    def __init__(self, path, columns, append=False):
+        self.path = path
+        self.file = open(path, 'a' if append else 'w', newline='', encoding='utf-8')
+        self.writer = csv.DictWriter(self.file, fieldnames=columns, extrasaction='ignore')
+        if not append:
+            self.writer.writeheader()
+
+    @staticmethod
+    def discard_after(path, offset):
+        with open(path, 'r+b') as f:
+            f.truncate(offset)
+
+    def write(self, row):
+        self.writer.writerow(flatten_row(row))
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+class NdjsonSink:
+    resumable = True
+
+    def __init__(self, path, columns, append=False):
+        self.path = path
+        self.columns = list(columns)
+        self.file = open(path, 'a' if append else 'w', encoding='utf-8')
+
+    @staticmethod
+    def discard_after(path, offset):
+        with open(path, 'r+b') as f:
+            f.truncate(offset)
+
+    def write(self, row):
+        self.file.write(ndjson_line(row, self.columns))
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+def ndjson_line(row, columns):
+    return json.dumps({column: row.get(column) for column in columns}, default=str, ensure_ascii=False) + '\n'
+
+class ParquetSink:
+    resumable = False
+
+    def __init__(self, path, columns, append=False, row_group_size=10000, compression='zstd'):
+        if append:
+            raise ValueError("Parquet exports cannot be resumed or appended to; start a new export")
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ValueError("Parquet output needs the pyarrow package (pip install pyarrow)")
+
+        self.pa = pyarrow
+        self.path = path
+        self.columns = list(columns)
+        self.row_group_size = row_group_size
+        self.schema = pyarrow.schema([(column, self._type(column)) for column in self.columns])
+        self.file = open(path, 'wb')
+        self.writer = pyarrow.parquet.ParquetWriter(
+            self.file, self.schema,
+            compression=None if compression == 'none' else compression
+        )
+        self.buffer = {column: [] for column in self.columns}
+        self.buffered = 0
+
+    def _type(self, column):
+        pa = self.pa
+        if column in LIST_COLUMNS:
+            return pa.list_(pa.string())
+        if column in TIMESTAMP_COLUMNS:
+            return pa.timestamp('us', tz='UTC')
+        if column in DATE_COLUMNS:
+            return pa.date32()
+        if column in FLOAT_COLUMNS:
+            return pa.float64()
+        return pa.string()
+
+    def _value(self, column, value):
+        if column in LIST_COLUMNS:
+            return as_list(value)
+        if column in TIMESTAMP_COLUMNS:
+            return parse_timestamp(value)
+        if column in DATE_COLUMNS:
+            return parse_date(value)
+        if column in FLOAT_COLUMNS:
+            return parse_float(value)
+        if isinstance(value, (list, tuple)):
+            # A list a column spec built for a column not typed as a list
+            return ', '.join('' if item is None else str(item) for item in value)
+        return None if value is None else str(value)
+
+    def write(self, row):
+        for column in self.columns:
+            self.buffer[column].append(self._value(column, row.get(column)))
+        self.buffered += 1
+        if self.buffered >= self.row_group_size:
+            self._write_batch()
+
+    def _write_batch(self):
+        if not self.buffered:
+            return
+        batch = self.pa.record_batch(
+            [self.pa.array(self.buffer[column], type=self.schema.field(column).type) for column in self.columns],
+            schema=self.schema
+        )
+        self.writer.write_batch(batch, row_group_size=self.row_group_size)
+        self.buffer = {column: [] for column in self.columns}
+        self.buffered = 0
+
+    def sync(self):
+        # Rows are buffered until a full row group is ready
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return self.file.tell()
+
+    def close(self):
+        self._write_batch()
+        self.writer.close()
+        self.file.close()
+
+class SqliteSink:
+    resumable = True
+
+    # Scalar columns of the customers table; wallets and IPs get their own tables
+    CUSTOMER_COLUMNS = [
+        ('name', 'TEXT'), ('given_name', 'TEXT'), ('family_name', 'TEXT'), ('nationality', 'TEXT'),
+        ('country_of_residence', 'TEXT'), ('birthdate', 'TEXT'), ('risk_score', 'REAL'), ('status', 'TEXT'),
+        ('onboarding_level', 'TEXT'), ('date_onboarded', 'TEXT'), ('email', 'TEXT'), ('latest_ip', 'TEXT'),
+        ('latest_ip_date', 'TEXT'),
+    ]
+
+    def __init__(self, path, columns, append=False):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(f"""
+            CREATE TABLE IF NOT EXISTS customers (
+                customer_id TEXT PRIMARY KEY,
+                {', '.join(f'{name} {kind}' for name, kind in self.CUSTOMER_COLUMNS)},
+                exported_at TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS wallets (
+                customer_id TEXT NOT NULL,
+                wallet TEXT NOT NULL COLLATE NOCASE,
+                PRIMARY KEY (customer_id, wallet)
+            );
+            CREATE INDEX IF NOT EXISTS wallets_wallet ON wallets (wallet);
+            CREATE TABLE IF NOT EXISTS ips (
+                customer_id TEXT NOT NULL,
+                ip_address TEXT NOT NULL,
+                PRIMARY KEY (customer_id, ip_address)
+            );
+            CREATE INDEX IF NOT EXISTS ips_ip_address ON ips (ip_address);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        """)
+
+        # Only the selected columns are written, so a slim export never
+        # blanks out columns filled by an earlier full one
+        self.scalar_columns = [name for name, kind in self.CUSTOMER_COLUMNS if name in columns]
+        self.write_wallets = 'wallets' in columns
+        self.write_ips = 'ip_addresses' in columns
+        names = ['customer_id'] + self.scalar_columns + ['exported_at']
+        updates = ', '.join(f"{name} = excluded.{name}" for name in names[1:])
+        self.upsert = (
+            f"INSERT INTO customers ({', '.join(names)}) VALUES ({', '.join('?' for _ in names)}) "
+            f"ON CONFLICT (customer_id) DO UPDATE SET {updates}"
+        )
+        # Every row of a run carries the run's start time, also when the run
+        # is resumed, so remove_unlisted() can tell which rows it wrote
+        found = self.conn.execute("SELECT value FROM meta WHERE key = 'run_started'").fetchone()
+        if append and found:
+            self.exported_at = found[0]
+        else:
+            self.exported_at = datetime.now(timezone.utc).isoformat()
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('run_started', ?)",
+                              (self.exported_at,))
+            self.conn.commit()
+        self.rows = 0
+
+    @staticmethod
+    def discard_after(path, offset):
+        # Uncommitted upserts were rolled back when the previous run died
+        pass
+
+    def write(self, row):
+        customer_id = row['customer_id']
+        self.conn.execute(self.upsert, [customer_id] + [row.get(name) for name in self.scalar_columns]
+                          + [self.exported_at])
+        if self.write_wallets:
+            self.conn.execute("DELETE FROM wallets WHERE customer_id = ?", (customer_id,))
+            self.conn.executemany("INSERT OR IGNORE INTO wallets (customer_id, wallet) VALUES (?, ?)",
+                                  [(customer_id, wallet) for wallet in as_list(row.get('wallets')) if wallet])
+        if self.write_ips:
+            self.conn.execute("DELETE FROM ips WHERE customer_id = ?", (customer_id,))
+            self.conn.executemany("INSERT OR IGNORE INTO ips (customer_id, ip_address) VALUES (?, ?)",
+                                  [(customer_id, ip) for ip in as_list(row.get('ip_addresses')) if ip])
+        self.rows += 1
+
+    def sync(self):
+        # Rows are upserted in one transaction per checkpoint
+        self.conn.commit()
+        return self.rows
+
+    def remove_unlisted(self, keep_ids=()):
+        """
+        After a run that handled every listed customer, delete the customers
+        it did not write, except `keep_ids` (listed, but could not be
+        fetched). Returns how many were deleted.
+        """
+        self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS keep (customer_id TEXT PRIMARY KEY)")
+        self.conn.execute("DELETE FROM keep")
+        self.conn.executemany("INSERT OR IGNORE INTO keep (customer_id) VALUES (?)",
+                              [(customer_id,) for customer_id in keep_ids])
+        unlisted = ("SELECT customer_id FROM customers WHERE exported_at != ? "
+                    "AND customer_id NOT IN (SELECT customer_id FROM keep)")
+        self.conn.execute(f"DELETE FROM wallets WHERE customer_id IN ({unlisted})", (self.exported_at,))
+        self.conn.execute(f"DELETE FROM ips WHERE customer_id IN ({unlisted})", (self.exported_at,))
+        removed = self.conn.execute(f"DELETE FROM customers WHERE customer_id IN ({unlisted})",
+                                    (self.exported_at,)).rowcount
+        self.conn.execute("DELETE FROM keep")
+        self.conn.commit()
+        return removed
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+class _PartFile:
+    # Counts and hashes the compressed bytes of one part as they are written
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.sha256 = hashlib.sha256()
+        self.bytes = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.bytes += len(data)
+        return self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+class CompressedSink:
+    """
+    Streams CSV or NDJSON rows through gzip or zstd, optionally rotating to a
+    new part after `rotate_rows` rows or about `rotate_mb` compressed MB.
+
+    Rows are encoded on the calling thread and handed over in chunks to a
+    background thread that compresses and writes them, so compression
+    overlaps with the network I/O of the export. Each CSV part has its own
+    header. The parts are listed, with their row counts, sizes and SHA-256
+    digests, in <path>.manifest.json.
+
+    Without rotation the output is <path>.gz or <path>.zst; with rotation
+    the parts are <root>.part00001<ext>.gz and so on.
+    """
+    resumable = False
+    encoding = None
+    CHUNK_BYTES = 256 * 1024
+    SUFFIXES = {'gzip': '.gz', 'zstd': '.zst', None: ''}
+
+    def __init__(self, path, columns, append=False, compress='gzip', compress_level=None, rotate_rows=None,
+                 rotate_mb=None):
+        if append:
+            raise ValueError("Compressed or rotated exports cannot be resumed or appended to; start a new export")
+        if compress not in STREAM_COMPRESSIONS and compress is not None:
+            raise ValueError(f"Unknown compression '{compress}' (expected one of {', '.join(STREAM_COMPRESSIONS)})")
+        if compress == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                raise ValueError("zstd compression needs the zstandard package (pip install zstandard)")
+            self.zstd = zstandard.ZstdCompressor(level=compress_level or 3)
+
+        self.path = path
+        self.columns = list(columns)
+        self.compress = compress
+        self.compress_level = compress_level
+        self.rotate_rows = rotate_rows
+        self.rotate_bytes = rotate_mb * 1024 * 1024 if rotate_mb else None
+        self.parts = []
+        self.rows = 0
+
+        self.buffer = io.StringIO()
+        self.buffered_rows = 0
+        self.writer = csv.DictWriter(self.buffer, fieldnames=self.columns, extrasaction='ignore')
+        self.part_number = 0
+        self.part_rows = 0
+        # Compressed size of the part the background thread is writing, as (part number, bytes)
+        self.written = (0, 0)
+        self.error = None
+        self.queue = queue.Queue(maxsize=4)
+        self.thread = threading.Thread(target=self._compress_loop, daemon=True,
+                                       name=f"{threading.current_thread().name}/compress")
+        self.thread.start()
+        self._new_part()
+
+    @staticmethod
+    def manifest_path(path):
+        return f"{path}.manifest.json"
+
+    @staticmethod
+    def discard_after(path, offset):
+        raise ValueError("Compressed or rotated exports cannot be resumed; start a new export")
+
+    def part_path(self, number):
+        suffix = self.SUFFIXES[self.compress]
+        if not (self.rotate_rows or self.rotate_bytes):
+            return self.path + suffix
+        root, ext = os.path.splitext(self.path)
+        return f"{root}.part{number:05d}{ext}{suffix}"
+
+    def _new_part(self):
+        self._flush_buffer()
+        self.part_number += 1
+        self.part_rows = 0
+        self._put(('open', self.part_number, self.part_path(self.part_number)))
+        if self.encoding == 'csv':
+            self.writer.writeheader()
+
+    def _put(self, message):
+        if self.error:
+            raise Exception(f"Writing {self.path} failed: {self.error}")
+        self.queue.put(message)
+
+    def _flush_buffer(self):
+        if self.buffer.tell():
+            self._put(('data', self.buffer.getvalue().encode('utf-8'), self.buffered_rows))
+            self.buffer.seek(0)
+            self.buffer.truncate()
+            self.buffered_rows = 0
+
+    def write(self, row):
+        if self.part_rows and self._part_full():
+            self._new_part()
+        if self.encoding == 'csv':
+            self.writer.writerow(flatten_row(row))
+        else:
+            self.buffer.write(ndjson_line(row, self.columns))
+        self.buffered_rows += 1
+        self.part_rows += 1
+        self.rows += 1
+        if self.buffer.tell() >= self.CHUNK_BYTES:
+            self._flush_buffer()
+
+    def _part_full(self):
+        if self.rotate_rows and self.part_rows >= self.rotate_rows:
+            return True
+        if self.rotate_bytes:
+            # The background thread lags by a few chunks, so size rotation is approximate
+            part, written = self.written
+            return part == self.part_number and written >= self.rotate_bytes
+        return False
+
+    def _open(self, path):
+        part_file = _PartFile(path)
+        if self.compress == 'gzip':
+            stream = gzip.GzipFile(filename='', mode='wb', fileobj=part_file, mtime=0,
+                                   compresslevel=self.compress_level or 6)
+        elif self.compress == 'zstd':
+            stream = self.zstd.stream_writer(part_file, closefd=False)
+        else:
+            stream = part_file
+        return part_file, stream
+
+    def _close_part(self, part, part_file, stream):
+        if stream is not part_file:
+            stream.close()
+        part_file.file.flush()
+        os.fsync(part_file.file.fileno())
+        part_file.file.close()
+        part.update(bytes=part_file.bytes, sha256=part_file.sha256.hexdigest())
+        self.parts.append(part)
+        self._save_manifest(complete=False)
+
+    def _compress_loop(self):
+        part = part_file = stream = None
+        while True:
+            message = self.queue.get()
+            if self.error:
+                # Keep draining so the exporter never blocks on a full queue
+                if message[0] == 'close':
+                    return
+                continue
+            try:
+                if message[0] == 'open':
+                    if part:
+                        self._close_part(part, part_file, stream)
+                    number, path = message[1], message[2]
+                    part = {'file': os.path.basename(path), 'rows': 0, 'uncompressed_bytes': 0}
+                    part_file, stream = self._open(path)
+                    self.written = (number, 0)
+                elif message[0] == 'data':
+                    stream.write(message[1])
+                    part['rows'] += message[2]
+                    part['uncompressed_bytes'] += len(message[1])
+                    self.written = (self.written[0], part_file.bytes)
+                else:
+                    if part:
+                        self._close_part(part, part_file, stream)
+                    return
+            except Exception as e:
+                self.error = e
+
+    def _save_manifest(self, complete):
+        manifest = {
+            'format': self.encoding,
+            'compression': self.compress,
+            'columns': self.columns,
+            'rows': sum(part['rows'] for part in self.parts),
+            'complete': complete,
+            'parts': self.parts,
+        }
+        tmp_path = self.manifest_path(self.path) + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path(self.path))
+
+    def sync(self):
+        # Parts only become readable once closed, so there is no resumable offset
+        if self.error:
+            raise Exception(f"Writing {self.path} failed: {self.error}")
+        return self.written[1]
+
+    def close(self):
+        if self.thread.is_alive():
+            self._flush_buffer()
+            self.queue.put(('close',))
+            self.thread.join()
+        if self.error:
+            raise Exception(f"Writing {self.path} failed: {self.error}")
+        self._save_manifest(complete=True)
+
+class CompressedCsvSink(CompressedSink):
+    encoding = 'csv'
+
+class CompressedNdjsonSink(CompressedSink):
+    encoding = 'ndjson'
+
+SINKS = {
+    'csv': CsvSink,
+    'ndjson': NdjsonSink,
+    'parquet': ParquetSink,
+    'sqlite': SqliteSink,
+}
+
+COMPRESSED_SINKS = {
+    'csv': CompressedCsvSink,
+    'ndjson': CompressedNdjsonSink,
+}
+
+def sink_for(output_format, sink_options=None):
+    """The sink class for an export; compression or rotation options select a CompressedSink"""
+    if output_format not in SINKS:
+        raise ValueError(f"Unknown output format '{output_format}' (expected one of {', '.join(SINKS)})")
+    options = sink_options or {}
+    if options.get('compress') or options.get('rotate_rows') or options.get('rotate_mb'):
+        if output_format not in COMPRESSED_SINKS:
+            raise ValueError(f"Compression and rotation options apply to {', '.join(COMPRESSED_SINKS)} output, "
+                             f"not {output_format}")
+        return COMPRESSED_SINKS[output_format]
+    return SINKS[output_format]
+
+def format_for(filename):
+    """The sink format of an existing export file, from its extension"""
+    for name in SINKS:
+        if filename.endswith('.' + name):
+            return name
+    return 'csv'
@@ -0,0 +1,378 @@
+"""
+Continuous sync daemon for the ComPilot export scripts.
+
+SyncDaemon keeps a local replica of every onboarded customer warm, instead
+of paying for a full sweep on every cron run. The replica is a SQLite file
+holding each customer's exported row and IP history. Two loops share the
+exporter's rate budget:
+
+- the listing sweep pages through /customers every --list-interval seconds
+  (one call per page). New customers and customers whose listing entry
+  changed are refreshed at once. Customers no longer listed as onboarded
+  are dropped from the replica.
+- the refresher fetches details and IPs for the customers that are due, in
+  order, and reschedules each of them with RefreshPolicy
+
+RefreshPolicy gives every customer a refresh interval between
+--min-interval and --max-interval. The interval is shortened for a high
+risk_score, a recent onboarding, or a recent change seen by the daemon.
+Hot customers are therefore refreshed often and dormant ones rarely.
+Customers that fail are retried with backoff, and their last good row is
+kept.
+
+Exporting from the replica makes no API calls and can run while the daemon
+does:
+
+    python sync_daemon.py --replica replica.sqlite
+    python sync_daemon.py --replica replica.sqlite --export customers.csv
+    python sync_daemon.py --replica replica.sqlite --status
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import signal
+import sqlite3
+import time
+from datetime import datetime, timezone
+
+from dotenv import load_dotenv
+
+from csvExport import FIELDNAMES, CompiLotExporter, FetchError
+from http_session import create_async_client
+from schema import ip_history
+from sinks import SINKS, format_for, parse_float, parse_timestamp
+
+# Load environment variables from .env file
+load_dotenv()
+
+DAY = 24 * 3600
+
+class RefreshPolicy:
+    """How long a customer's replica row may age before it is refreshed"""
+
+    def __init__(self, min_interval=300, max_interval=DAY, failure_backoff=60):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.failure_backoff = failure_backoff
+
+    def heat(self, row, changed_at, now):
+        """0 (dormant) to 1 (hottest); the hottest reason wins"""
+        heat = 0.0
+        risk = parse_float(row.get('risk_score'))
+        if risk is not None:
+            heat = max(heat, min(1.0, risk / 100))
+
+        onboarded = parse_timestamp(row.get('date_onboarded'))
+        if onboarded:
+            age_days = (datetime.fromtimestamp(now, timezone.utc) - onboarded).total_seconds() / DAY
+            if age_days < 7:
+                heat = max(heat, 1.0)
+            elif age_days < 30:
+                heat = max(heat, 0.7)
+
+        if changed_at:
+            days_since_change = (now - changed_at) / DAY
+            if days_since_change < 1:
+                heat = max(heat, 1.0)
+            elif days_since_change < 7:
+                heat = max(heat, 0.6)
+        return heat
+
+    def interval(self, row, changed_at, now):
+        # Geometric between max_interval (heat 0) and min_interval (heat 1)
+        ratio = self.min_interval / self.max_interval
+        interval = self.max_interval * ratio ** self.heat(row, changed_at, now)
+        # Jitter spreads customers fetched together over time
+        return interval * random.uniform(0.9, 1.1)
+
+    def retry_after(self, failures):
+        return min(self.max_interval, self.failure_backoff * 2 ** (failures - 1))
+
+def row_hash(row):
+    payload = json.dumps(row, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=8).digest()
+
+class Replica:
+    def __init__(self, path):
+        self.path = path
+        # The daemon and exports may use the replica at the same time
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS customers (
+                customer_id TEXT PRIMARY KEY,
+                listing TEXT NOT NULL,
+                listing_hash BLOB NOT NULL,
+                row TEXT,
+                ip_history TEXT,
+                row_hash BLOB,
+                fetched_at REAL,
+                changed_at REAL,
+                next_refresh REAL NOT NULL,
+                failures INTEGER NOT NULL DEFAULT 0,
+                sweep INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS customers_next_refresh ON customers (next_refresh);
+        """)
+
+    def get_meta(self, key, default=None):
+        found = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return found[0] if found else default
+
+    def set_meta(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def listed(self, customer, sweep, now):
+        """Record a listing entry; new or changed customers become due now. Returns True if so"""
+        listing = json.dumps(customer, sort_keys=True, default=str)
+        digest = hashlib.blake2b(listing.encode('utf-8'), digest_size=8).digest()
+        found = self.conn.execute(
+            "SELECT listing_hash FROM customers WHERE customer_id = ?", (customer['id'],)
+        ).fetchone()
+        if found is None:
+            self.conn.execute(
+                "INSERT INTO customers (customer_id, listing, listing_hash, next_refresh, sweep) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (customer['id'], listing, digest, now, sweep)
+            )
+            return True
+        if found[0] != digest:
+            self.conn.execute(
+                "UPDATE customers SET listing = ?, listing_hash = ?, next_refresh = ?, sweep = ? "
+                "WHERE customer_id = ?",
+                (listing, digest, now, sweep, customer['id'])
+            )
+            return True
+        self.conn.execute("UPDATE customers SET sweep = ? WHERE customer_id = ?", (sweep, customer['id']))
+        return False
+
+    def finish_sweep(self, sweep):
+        """Drop customers the finished sweep did not list. Returns how many"""
+        removed = self.conn.execute("DELETE FROM customers WHERE sweep != ?", (sweep,)).rowcount
+        self.set_meta('sweep', sweep)
+        self.set_meta('swept_at', time.time())
+        self.conn.commit()
+        return removed
+
+    def due(self, now, limit):
+        rows = self.conn.execute(
+            "SELECT customer_id, listing, row, changed_at, row_hash, failures FROM customers "
+            "WHERE next_refresh <= ? ORDER BY next_refresh LIMIT ?",
+            (now, limit)
+        )
+        return rows.fetchall()
+
+    def next_due(self):
+        found = self.conn.execute("SELECT MIN(next_refresh) FROM customers").fetchone()
+        return found[0]
+
+    def refreshed(self, customer_id, row, history, digest, changed_at, now, next_refresh):
+        self.conn.execute(
+            "UPDATE customers SET row = ?, ip_history = ?, row_hash = ?, fetched_at = ?, changed_at = ?, "
+            "next_refresh = ?, failures = 0 WHERE customer_id = ?",
+            (json.dumps(row, default=str), json.dumps(history), digest, now, changed_at, next_refresh,
+             customer_id)
+        )
+
+    def failed(self, customer_id, failures, next_refresh):
+        self.conn.execute(
+            "UPDATE customers SET failures = ?, next_refresh = ? WHERE customer_id = ?",
+            (failures, next_refresh, customer_id)
+        )
+
+    def commit(self):
+        self.conn.commit()
+
+    def rows(self):
+        """Replica rows in customer ID order, skipping customers not fetched yet"""
+        for (row,) in self.conn.execute("SELECT row FROM customers WHERE row IS NOT NULL ORDER BY customer_id"):
+            yield json.loads(row)
+
+    def status(self, now=None):
+        now = now or time.time()
+        total, fetched, due, failing, oldest = self.conn.execute(
+            "SELECT COUNT(*), COUNT(row), SUM(next_refresh <= ?), SUM(failures > 0), MIN(fetched_at) "
+            "FROM customers", (now,)
+        ).fetchone()
+        return {
+            'customers': total,
+            'fetched': fetched,
+            'due': due or 0,
+            'failing': failing or 0,
+            'oldest_age': now - oldest if oldest else None,
+            'swept_at': float(self.get_meta('swept_at', 0)) or None,
+        }
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+class SyncDaemon:
+    def __init__(self, exporter, replica, policy=None, list_interval=600, concurrency=8, report_every=60):
+        self.exporter = exporter
+        self.replica = replica
+        self.policy = policy or RefreshPolicy()
+        self.list_interval = list_interval
+        self.concurrency = concurrency
+        self.report_every = report_every
+        self.stopping = asyncio.Event()
+
+        # Counters
+        self.refreshed = 0
+        self.changed = 0
+        self.failures = 0
+
+    def stop(self):
+        self.stopping.set()
+
+    async def _sleep(self, seconds):
+        try:
+            await asyncio.wait_for(self.stopping.wait(), timeout=max(0.0, seconds))
+        except asyncio.TimeoutError:
+            pass
+
+    async def sweep(self, client):
+        """Page through the listing once, scheduling new and changed customers"""
+        sweep = int(self.replica.get_meta('sweep', 0)) + 1
+        listed = changed = 0
+        async for page, customers in self.exporter.iter_customer_pages_async(client):
+            now = time.time()
+            for customer in customers:
+                listed += 1
+                if self.replica.listed(customer, sweep, now):
+                    changed += 1
+            self.replica.commit()
+            if self.stopping.is_set():
+                # An interrupted sweep must not drop the customers it did not reach
+                return
+        removed = self.replica.finish_sweep(sweep)
+        print(f"Listing sweep {sweep}: {listed} onboarded customers, {changed} new or changed, {removed} removed")
+
+    async def sweep_loop(self, client):
+        swept_at = float(self.replica.get_meta('swept_at', 0))
+        while not self.stopping.is_set():
+            wait = swept_at + self.list_interval - time.time()
+            if wait > 0:
+                await self._sleep(wait)
+                continue
+            try:
+                await self.sweep(client)
+            except Exception as e:
+                print(f"Listing sweep failed: {e}")
+            swept_at = time.time()
+
+    async def _refresh(self, client, due, semaphore):
+        customer_id, listing, old_row, changed_at, old_hash, failures = due
+        async with semaphore:
+            try:
+                details, ips = await self.exporter.fetch_customer_async(client, json.loads(listing))
+            except FetchError as e:
+                failures += 1
+                self.failures += 1
+                retry_after = self.policy.retry_after(failures)
+                print(f"Refreshing {customer_id} failed ({e}); retrying in {retry_after:.0f}s")
+                self.replica.failed(customer_id, failures, time.time() + retry_after)
+                return
+
+        now = time.time()
+        row = self.exporter.build_row(details, ips)
+        digest = row_hash(row)
+        if old_row is not None and digest != old_hash:
+            changed_at = now
+            self.changed += 1
+        self.refreshed += 1
+        next_refresh = now + self.policy.interval(row, changed_at, now)
+        self.replica.refreshed(customer_id, row, ip_history(ips), digest, changed_at, now, next_refresh)
+
+    async def refresh_loop(self, client):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        while not self.stopping.is_set():
+            due = self.replica.due(time.time(), self.concurrency * 4)
+            if not due:
+                next_due = self.replica.next_due()
+                await self._sleep(min(5.0, next_due - time.time()) if next_due else 5.0)
+                continue
+            await asyncio.gather(*(self._refresh(client, entry, semaphore) for entry in due))
+            self.replica.commit()
+
+    async def report_loop(self):
+        while not self.stopping.is_set():
+            await self._sleep(self.report_every)
+            status = self.replica.status()
+            oldest = f"{status['oldest_age'] / 60:.0f} min" if status['oldest_age'] else "n/a"
+            print(f"Replica: {status['fetched']}/{status['customers']} customers, {status['due']} due, "
+                  f"{status['failing']} failing, oldest row {oldest}; {self.refreshed} refreshed "
+                  f"({self.changed} changed, {self.failures} failures) since start")
+
+    async def run(self):
+        pool_size = max(self.exporter.pool_size, self.concurrency * 2)
+        async with create_async_client(self.exporter.headers, pool_size, self.exporter.http2) as client:
+            await asyncio.gather(self.sweep_loop(client), self.refresh_loop(client), self.report_loop())
+        self.replica.commit()
+
+def export_replica(replica, filename, output_format=None):
+    """Write every replica row to `filename` without calling the API. Returns the number of rows"""
+    output_format = output_format or format_for(filename)
+    sink = SINKS[output_format](filename, FIELDNAMES)
+    count = 0
+    try:
+        for row in replica.rows():
+            sink.write(row)
+            count += 1
+        sink.sync()
+    finally:
+        sink.close()
+    return count
+
+def main():
+    parser = argparse.ArgumentParser(description="Keep a local replica of ComPilot customers continuously fresh")
+    parser.add_argument("--replica", required=True, metavar="REPLICA_FILE",
+                        help="SQLite replica file, created if missing")
+    parser.add_argument("--export", metavar="FILE",
+                        help="write the replica to FILE (format from its extension) and exit, without API calls")
+    parser.add_argument("--status", action="store_true", help="print the replica's freshness and exit")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="customers refreshed at once (default: 8)")
+    parser.add_argument("--list-interval", type=int, default=600,
+                        help="seconds between listing sweeps (default: 600)")
+    parser.add_argument("--min-interval", type=int, default=300,
+                        help="refresh interval of the hottest customers, in seconds (default: 300)")
+    parser.add_argument("--max-interval", type=int, default=DAY,
+                        help="refresh interval of dormant customers, in seconds (default: 86400)")
+    args = parser.parse_args()
+
+    replica = Replica(args.replica)
+    try:
+        if args.export:
+            count = export_replica(replica, args.export)
+            print(f"Exported {count} customers from {args.replica} to {args.export}")
+            return
+        if args.status:
+            print(json.dumps(replica.status(), indent=2))
+            return
+
+        exporter = CompiLotExporter()
+        policy = RefreshPolicy(args.min_interval, args.max_interval)
+        daemon = SyncDaemon(exporter, replica, policy, args.list_interval, args.concurrency)
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(signum, daemon.stop)
+            print(f"Syncing {args.replica}: listing every {args.list_interval}s, refreshing customers every "
+                  f"{args.min_interval}s (hottest) to {args.max_interval}s (dormant)")
+            await daemon.run()
+
+        asyncio.run(run())
+        print(f"Stopped after {daemon.refreshed} refreshes ({daemon.changed} changed)")
+    except ValueError as e:
+        print(f"Error: {e}")
+    finally:
+        replica.close()
+
+if __name__ == "__main__":
+    main()
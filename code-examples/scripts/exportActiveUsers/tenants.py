@@ -0,0 +1,178 @@
+"""
+Multi-tenant exports for the ComPilot export scripts.
+
+export_tenants() exports several ComPilot workspaces concurrently in one
+process, one thread per tenant. Every tenant gets its own CompiLotExporter,
+and so its own RateLimiter budget and connection pool for its API key, and
+its own output file. Tenants do not wait for each other's budgets, so the
+wall time is close to that of the slowest tenant rather than the sum.
+
+Tenants are listed in a JSON file:
+
+    [
+      {"name": "acme", "api_key_env": "COMPILOT_API_KEY_ACME"},
+      {"name": "globex", "api_key": "...", "output": "globex.parquet"}
+    ]
+
+- name:        used in log lines and the default output file name
+- api_key_env: environment variable (or .env entry) holding the API key;
+  api_key gives the key inline instead
+- output:      optional output file (default: compilot_customers_<name>_<timestamp>.<format>)
+- base_url:    optional API base URL for this tenant
+
+A tenant that fails does not stop the others; its error is reported in the
+summary.
+"""
+
+import json
+import os
+import re
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+THREAD_PREFIX = 'tenant:'
+
+def load_tenants(path):
+    """The tenants of a tenants file, each with its API key resolved"""
+    with open(path, 'r', encoding='utf-8') as f:
+        try:
+            entries = json.load(f)
+        except ValueError as e:
+            raise ValueError(f"{path} is not valid JSON: {e}")
+    if not isinstance(entries, list) or not entries:
+        raise ValueError(f"{path} must contain a non-empty list of tenants")
+
+    tenants = []
+    names = set()
+    for number, entry in enumerate(entries, start=1):
+        name = str(entry.get('name') or '').strip()
+        if not name:
+            raise ValueError(f"Tenant {number} in {path} has no name")
+        if not re.fullmatch(r'[\w.-]+', name):
+            raise ValueError(f"Tenant name {name!r} may only contain letters, digits, '_', '.' and '-'")
+        if name in names:
+            raise ValueError(f"Tenant {name} is listed twice in {path}")
+        names.add(name)
+
+        api_key = entry.get('api_key')
+        if not api_key and entry.get('api_key_env'):
+            api_key = os.getenv(entry['api_key_env'])
+            if not api_key:
+                raise ValueError(f"Tenant {name}: {entry['api_key_env']} is not set")
+        if not api_key:
+            raise ValueError(f"Tenant {name} needs an api_key or api_key_env")
+
+        tenants.append({
+            'name': name,
+            'api_key': api_key,
+            'output': entry.get('output'),
+            'base_url': entry.get('base_url'),
+        })
+    return tenants
+
+def default_output(name, output_format, started):
+    if output_format == 'sqlite':
+        return f"compilot_customers_{name}.sqlite"
+    return f"compilot_customers_{name}_{started.strftime('%Y%m%d_%H%M%S')}.{output_format}"
+
+def tenant_name():
+    """The tenant the current thread works for, or None"""
+    thread_name = threading.current_thread().name
+    if not thread_name.startswith(THREAD_PREFIX):
+        return None
+    # Helper threads of a tenant (the async engine) are named <tenant thread>/<role>
+    return thread_name[len(THREAD_PREFIX):].split('/', 1)[0]
+
+class TenantOutput:
+    """A stdout wrapper that prefixes each line printed for a tenant with [name]"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def write(self, text):
+        name = tenant_name()
+        if name is None:
+            return self.stream.write(text)
+
+        with self.lock:
+            # Lines are only written once complete, so tenants never interleave mid-line
+            buffered = self.pending.pop(name, '') + text
+            *lines, rest = buffered.split('\n')
+            for line in lines:
+                self.stream.write(f"[{name}] {line}\n")
+            if rest:
+                self.pending[name] = rest
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, attribute):
+        return getattr(self.stream, attribute)
+
+def _export_tenant(tenant, make_exporter, output_format, concurrency, sink_options):
+    exporter = make_exporter(tenant['api_key'])
+    if tenant['base_url']:
+        exporter.base_url = tenant['base_url'].rstrip('/')
+    print(f"Exporting to {tenant['output']}...")
+    try:
+        rows = exporter.export_to_file(tenant['output'], output_format, concurrency=concurrency,
+                                       sink_options=sink_options)
+    finally:
+        exporter.close()
+    stats = exporter.rate_limiter.stats()
+    print(f"Export completed! {rows} onboarded customers exported "
+          f"({stats['calls']} API calls, {stats['throttled']} throttled, {stats['wait_time']:.1f}s waiting)")
+    return rows
+
+def export_tenants(tenants, make_exporter, output_format='csv', concurrency=None, sink_options=None,
+                   max_parallel=None):
+    """
+    Export every tenant concurrently. make_exporter(api_key) returns a
+    configured CompiLotExporter for one key. Returns a dict of tenant name to
+    (rows exported, error message or None).
+    """
+    started = datetime.now()
+    for tenant in tenants:
+        tenant['output'] = tenant['output'] or default_output(tenant['name'], output_format, started)
+    outputs = [tenant['output'] for tenant in tenants]
+    if len(set(outputs)) != len(outputs):
+        raise ValueError("Every tenant needs its own output file")
+
+    results = {}
+    previous_stdout = sys.stdout
+    sys.stdout = TenantOutput(previous_stdout)
+    try:
+        with ThreadPoolExecutor(max_workers=max_parallel or len(tenants)) as pool:
+            futures = {}
+            for tenant in tenants:
+                futures[tenant['name']] = pool.submit(
+                    _run_in_named_thread, tenant['name'], _export_tenant,
+                    tenant, make_exporter, output_format, concurrency, sink_options
+                )
+            for name, future in futures.items():
+                try:
+                    results[name] = (future.result(), None)
+                except Exception as e:
+                    results[name] = (0, str(e))
+    finally:
+        sys.stdout = previous_stdout
+    return results
+
+def _run_in_named_thread(name, function, *args):
+    # Pool threads are renamed for the duration of a tenant's export, so
+    # TenantOutput can tell whose output a line is
+    thread = threading.current_thread()
+    previous_name = thread.name
+    thread.name = f"{THREAD_PREFIX}{name}"
+    try:
+        return function(*args)
+    except Exception as e:
+        print(f"Export failed: {e}")
+        raise
+    finally:
+        thread.name = previous_name
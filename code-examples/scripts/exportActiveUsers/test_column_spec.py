@@ -0,0 +1,73 @@
+import pytest
+
+from column_spec import DEFAULT_SPEC, ColumnSpec
+from csvExport import CompiLotExporter
+from mock_server import generate_customers
+
+DETAILS = {
+    "id": "c1",
+    "riskScore": 42,
+    "customerClaims": [{"nationality": "FR"}, {"nationality": "DE"}],
+    "customerWallets": [{"wallet": "0xa"}, {"wallet": "0xb"}, {}],
+    "customerEmails": [{"email": "a@example.com"}, {"email": "b@example.com"}],
+}
+IPS = [
+    {"ipAddress": "10.0.0.1", "createdAt": "2024-01-01"},
+    {"ipAddress": "10.0.0.3", "createdAt": "2024-03-01"},
+    {"ipAddress": "10.0.0.2"},
+    {"ipAddress": "10.0.0.4", "createdAt": "2024-03-01"},
+]
+
+def extract(expression, details=DETAILS, ips=IPS):
+    return ColumnSpec({"value": expression}).extract(details, ips)["value"]
+
+def test_default_spec_matches_build_row():
+    customers, details, ips = generate_customers(50, onboarded_ratio=1.0, seed=4)
+    spec = ColumnSpec(DEFAULT_SPEC)
+    for customer in customers:
+        customer_id = customer["id"]
+        assert spec.extract(details[customer_id], ips[customer_id]) == \
+            CompiLotExporter.build_row(details[customer_id], ips[customer_id])
+
+@pytest.mark.parametrize('expression, value', [
+    ("id", "c1"),
+    ("customerClaims[0].nationality", "FR"),
+    ("customerClaims[-1].nationality", "DE"),
+    ("customerClaims[5].nationality", None),
+    ("missing.field", None),
+    ("customerWallets[*].wallet", ["0xa", "0xb", None]),
+    ("missing[*].wallet", []),
+    ("count(customerWallets)", 3),
+    ("count(missing)", 0),
+    ("first(customerEmails[*].email)", "a@example.com"),
+    ("last(customerEmails[*].email)", "b@example.com"),
+    ("join(customerEmails[*].email, '; ')", "a@example.com; b@example.com"),
+    ("join(customerWallets[*].wallet)", "0xa, 0xb"),
+    ("max(ips[*].createdAt)", "2024-03-01"),
+    ("min(ips[*].createdAt)", "2024-01-01"),
+    # The first of equal keys wins, and items without a key come last
+    ("max_by(ips, createdAt, ipAddress)", "10.0.0.3"),
+    ("min_by(ips, createdAt, ipAddress)", "10.0.0.1"),
+    ("ips[*].ipAddress", ["10.0.0.1", "10.0.0.3", "10.0.0.2", "10.0.0.4"]),
+])
+def test_expressions(expression, value):
+    assert extract(expression) == value
+
+def test_fetch_plan_fields():
+    spec = ColumnSpec({"id": "id", "score": "riskScore", "wallets": "count(customerWallets)"})
+    assert spec.columns == ["id", "score", "wallets"]
+    assert spec.detail_fields == ["id", "riskScore", "customerWallets"]
+    assert not spec.needs_ips
+    assert ColumnSpec({"ip": "max_by(ips, createdAt, ipAddress)"}).needs_ips
+
+@pytest.mark.parametrize('spec', [
+    {},
+    {"value": 3},
+    {"value": "customerClaims[0"},
+    {"value": "unknown(ips)"},
+    {"value": "max_by(ips, createdAt)"},
+    {"value": "id id"},
+])
+def test_invalid_specs(spec):
+    with pytest.raises(ValueError):
+        ColumnSpec(spec)
@@ -0,0 +1,54 @@
+import gc
+import os
+
+import pytest
+
+class Crash(Exception):
+    pass
+
+def crash_after(exporter, calls):
+    record_row = exporter.record_row
+    seen = []
+
+    def crashing(record):
+        seen.append(record)
+        if len(seen) > calls:
+            raise Crash()
+        return record_row(record)
+
+    exporter.record_row = crashing
+
+def export(make_exporter, path, concurrency=None, **options):
+    make_exporter().export_to_file(str(path), concurrency=concurrency, **options)
+    return path.read_bytes()
+
+def test_sync_and_async_exports_are_identical(make_exporter, tmp_path):
+    sync = export(make_exporter, tmp_path / "sync.csv")
+    concurrent = export(make_exporter, tmp_path / "async.csv", concurrency=8)
+
+    assert sync.count(b"\n") > 100
+    assert concurrent == sync
+
+@pytest.mark.parametrize('concurrency', [None, 8])
+def test_resumed_export_matches_an_uninterrupted_one(make_exporter, tmp_path, concurrency):
+    expected = export(make_exporter, tmp_path / "expected.csv")
+
+    path = tmp_path / "resumed.csv"
+    exporter = make_exporter()
+    # Crash mid-page, after some rows were written past the last checkpoint
+    crash_after(exporter, 47)
+    try:
+        exporter.export_to_file(str(path), concurrency=concurrency, commit_every=10)
+    except Crash:
+        pass
+    else:
+        pytest.fail("the export was not interrupted")
+    exporter.close()
+    # Like a dead process, release the crashed run's checkpoint and its
+    # uncommitted transaction
+    gc.collect()
+    assert os.path.exists(f"{path}.checkpoint.sqlite")
+    assert 0 < path.read_bytes().count(b"\n") < expected.count(b"\n")
+
+    assert export(make_exporter, path, concurrency, resume=True) == expected
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["expected.csv", "resumed.csv"]
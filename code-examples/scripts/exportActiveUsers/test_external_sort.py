@@ -0,0 +1,70 @@
+import csv
+import random
+
+import pytest
+
+import external_sort
+from external_sort import ExternalSorter, sort_export
+
+def make_rows(count, seed=0):
+    rng = random.Random(seed)
+    rows = []
+    for number in range(count):
+        score = rng.choice([None, ''] + [str(value) for value in range(20)])
+        rows.append({'customer_id': f"c{number:05d}", 'risk_score': score,
+                     'date_onboarded': f"2024-{rng.randint(1, 12):02d}-01T00:00:00Z"})
+    return rows
+
+def expected(rows, descending):
+    # Missing values last in either direction, ties in their original order
+    present = [row for row in rows if row['risk_score'] not in (None, '')]
+    missing = [row for row in rows if row['risk_score'] in (None, '')]
+    return sorted(present, key=lambda row: float(row['risk_score']), reverse=descending) + missing
+
+def sort_rows(rows, descending, tmp_path, memory_cap=None):
+    sorter = ExternalSorter('risk_score', descending, tmp_dir=str(tmp_path))
+    if memory_cap:
+        sorter.memory_cap = memory_cap
+    for row in rows:
+        sorter.add(row)
+    spilled = len(sorter.runs)
+    return list(sorter.sorted_rows()), spilled
+
+@pytest.mark.parametrize('descending', [False, True])
+def test_in_memory_sort_is_stable_with_missing_last(tmp_path, descending):
+    rows = make_rows(500)
+    result, spilled = sort_rows(rows, descending, tmp_path)
+    assert spilled == 0
+    assert result == expected(rows, descending)
+
+@pytest.mark.parametrize('descending', [False, True])
+def test_spilled_runs_merge_like_the_in_memory_sort(tmp_path, monkeypatch, descending):
+    # Enough runs for two merge passes
+    monkeypatch.setattr(external_sort, 'MERGE_FAN_IN', 3)
+    rows = make_rows(2000, seed=1)
+    result, spilled = sort_rows(rows, descending, tmp_path, memory_cap=8 * 1024)
+
+    assert spilled > 9
+    assert result == expected(rows, descending)
+    assert list(tmp_path.iterdir()) == []
+
+def test_sort_export_sorts_a_csv_in_place(tmp_path):
+    path = tmp_path / "export.csv"
+    rows = make_rows(300, seed=2)
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+    assert sort_export(str(path), 'date_onboarded', memory_mb=1) == 300
+    with open(path, newline='', encoding='utf-8') as f:
+        dates = [row['date_onboarded'] for row in csv.DictReader(f)]
+    assert dates == sorted(row['date_onboarded'] for row in rows)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["export.csv"]
+
+def test_sort_export_rejects_unknown_columns(tmp_path):
+    path = tmp_path / "export.csv"
+    path.write_text("customer_id,risk_score\nc1,3\n", encoding='utf-8')
+    with pytest.raises(ValueError):
+        sort_export(str(path), 'email')
+    assert path.read_text(encoding='utf-8') == "customer_id,risk_score\nc1,3\n"
@@ -0,0 +1,23 @@
+from id_set import IdSet
+
+def test_add_reports_new_ids():
+    ids = IdSet()
+    assert ids.add("a")
+    assert not ids.add("a")
+    assert ids.add(1)
+    assert "a" in ids
+    assert "1" in ids
+    assert "b" not in ids
+    assert len(ids) == 2
+
+def test_grows_past_its_capacity():
+    ids = IdSet(capacity=4)
+    initial = ids.nbytes
+    for number in range(10000):
+        assert ids.add(f"customer-{number}")
+
+    assert len(ids) == 10000
+    assert ids.nbytes > initial
+    assert all(f"customer-{number}" in ids for number in range(10000))
+    assert "customer-10000" not in ids
+    assert not ids.add("customer-42")
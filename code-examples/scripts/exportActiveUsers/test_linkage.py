@@ -0,0 +1,97 @@
+import pytest
+
+from linkage import IPV4, IPV6, LinkageIndex, normalize_wallet, pack_ip
+
+EVM = "0xAbCdEf0123456789aBcDeF0123456789AbCdEf01"
+
+def build(max_shared=50):
+    index = LinkageIndex(max_shared)
+    # c1 and c2 share an IP, c2 and c3 a wallet (in two spellings); c4 is alone
+    index.add("c3", wallets=[EVM.lower()])
+    index.add("c1", ips=["203.0.113.7", "not an ip"])
+    index.add("c2", wallets=[EVM], ips=["::ffff:203.0.113.7"])
+    index.add("c4", wallets=["bc1qxyz"], ips=["2001:db8::1"])
+    # A carrier NAT address shared by more than max_shared customers
+    for number in range(5, 5 + max_shared + 1):
+        index.add(f"c{number}", ips=["198.51.100.1"])
+    index.add("c4", ips=["198.51.100.1"])
+    return index
+
+def names(index, customers):
+    return sorted(index.customer_ids[customer] for customer in customers)
+
+def test_identifiers_are_normalized():
+    assert pack_ip("203.0.113.7") == (IPV4, 0xCB007107)
+    assert pack_ip("::ffff:203.0.113.7") == (IPV4, 0xCB007107)
+    assert pack_ip("2001:db8::1")[0] == IPV6
+    assert pack_ip("fe80::1%eth0") == pack_ip("fe80::1")
+    assert pack_ip("example.com") is None
+    assert normalize_wallet(f" {EVM} ") == EVM.lower()
+    assert normalize_wallet("bc1qXYZ") == "bc1qXYZ"
+    assert normalize_wallet("  ") is None
+
+@pytest.mark.parametrize('saved', [False, True])
+def test_clusters_follow_shared_identifiers(tmp_path, saved):
+    index = build(max_shared=3)
+    index.finish()
+    if saved:
+        index.save(str(tmp_path / "customers.linkage"))
+        index = LinkageIndex.load(str(tmp_path / "customers.linkage"))
+
+    assert index.invalid_ips == (0 if saved else 1)
+    c1, c2, c3, c4 = (index.find_customer(name) for name in ("c1", "c2", "c3", "c4"))
+    assert index.cluster[c1] == index.cluster[c2] == index.cluster[c3]
+    assert names(index, index.cluster_members(c3)) == ["c1", "c2", "c3"]
+    assert index.cluster_sizes[index.cluster[c1]] == 3
+    # The shared NAT address is too common to link c4 with anyone
+    assert names(index, index.cluster_members(c4)) == ["c4"]
+    assert len(index.holders(index.find_ip("198.51.100.1"))) == 5
+    assert names(index, index.neighbours(c2)) == ["c1", "c3"]
+    assert index.clusters() == [(3, index.cluster[c1])]
+
+    assert names(index, index.holders(index.find_ip("203.0.113.7"))) == ["c1", "c2"]
+    assert names(index, index.holders(index.find_wallet(EVM.upper().replace("0X", "0x")))) == ["c2", "c3"]
+    assert names(index, index.holders(index.find_ip("2001:db8::1"))) == ["c4"]
+    assert index.identifier_label(index.find_wallet("bc1qxyz")) == ('wallet', 'bc1qxyz')
+    assert index.identifier_label(index.find_ip("::ffff:203.0.113.7")) == ('ip', '203.0.113.7')
+
+    assert index.find_customer("c99") is None
+    assert index.find_ip("192.0.2.1") is None
+    assert index.find_ip("2001:db8::2") is None
+    assert index.find_wallet("0x00") is None
+    assert index.find_wallet("") is None
+    with pytest.raises(ValueError):
+        index.find_ip("nope")
+
+def test_lookups_on_a_larger_index():
+    index = LinkageIndex()
+    wallets = {}
+    for number in range(2000):
+        # Customers arrive out of ID order
+        name = f"customer-{number * 7919 % 2000}"
+        wallets[name] = f"w{number // 2}"
+        index.add(name, wallets=[wallets[name]], ips=[f"10.0.{number % 200}.{number % 7}"])
+    index.finish()
+
+    for number in range(0, 2000, 37):
+        customer = index.find_customer(f"customer-{number}")
+        assert index.customer_ids[customer] == f"customer-{number}"
+        wallet = index.find_wallet(wallets[f"customer-{number}"])
+        assert customer in list(index.holders(wallet))
+        assert set(index.cluster_members(customer)) == \
+            {member for member, root in enumerate(index.cluster) if root == index.cluster[customer]}
+
+def test_finished_index_rejects_new_customers():
+    index = build()
+    index.finish()
+    with pytest.raises(Exception):
+        index.add("c100", ips=["192.0.2.1"])
+
+def test_load_rejects_other_files(tmp_path):
+    path = tmp_path / "other.linkage"
+    path.write_bytes(b"COMPILOT-LINKAGE 1\n{}\n")
+    with pytest.raises(ValueError, match="older version"):
+        LinkageIndex.load(str(path))
+    path.write_bytes(b"hello\n")
+    with pytest.raises(ValueError, match="not a linkage index"):
+        LinkageIndex.load(str(path))
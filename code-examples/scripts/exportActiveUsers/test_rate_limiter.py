@@ -0,0 +1,122 @@
+from email.utils import formatdate
+
+import pytest
+
+import rate_limiter
+from rate_limiter import RateLimiter, SharedRateLimiter, burst_tiers, parse_policy, parse_reset, \
+    parse_retry_after
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limiter.time, 'monotonic', clock)
+    return clock
+
+def call_times(limiter, clock, calls):
+    # Make each call at the slot it reserved, as acquire() would
+    times = []
+    for _ in range(calls):
+        delay, _ = limiter.reserve()
+        clock.now += delay
+        times.append(clock.now)
+    return times
+
+def most_in_window(times, period):
+    start = most = 0
+    for end, time in enumerate(times):
+        while time - times[start] >= period - 1e-9:
+            start += 1
+        most = max(most, end - start + 1)
+    return most
+
+def test_parse_headers():
+    assert parse_retry_after("2") == 2.0
+    assert parse_retry_after(None) is None
+    assert 5 < parse_retry_after(formatdate(rate_limiter.time.time() + 10, usegmt=True)) <= 10
+    assert parse_policy("300;w=60, 15;w=1") == [(300, 60), (15, 1)]
+    assert parse_reset("30") == 30.0
+    assert 25 < parse_reset(str(int(rate_limiter.time.time()) + 30)) <= 30
+
+def test_burst_tiers():
+    assert burst_tiers([(15, 1), (300, 60)]) == [(15, 1, 11), (300, 60, 11)]
+    assert burst_tiers([(15, 1), (300, 60)], burst=15) == [(15, 1, 15), (300, 60, 15)]
+    assert burst_tiers([(15, 1), (300, 60)], burst=100) == [(15, 1, 15), (300, 60, 15)]
+    assert burst_tiers([(1000, 1)]) == [(1000, 1, 1)]
+    assert burst_tiers([(15, 1, 3), (300, 60)]) == [(15, 1, 3), (300, 60, 11)]
+
+def test_burst_then_spacing_within_every_window(clock):
+    limiter = RateLimiter()
+    start = clock.now
+    times = call_times(limiter, clock, 700)
+
+    assert times[10] == pytest.approx(start)
+    assert times[11] > start + 0.1
+    assert most_in_window(times, 1) <= 15
+    assert most_in_window(times, 60) <= 300
+
+def test_even_spacing_without_burst(clock):
+    limiter = RateLimiter(tiers=[(10, 1, 1)])
+    times = call_times(limiter, clock, 5)
+    assert [round(b - a, 6) for a, b in zip(times, times[1:])] == [0.1] * 4
+
+def test_throttling_halves_rate_and_voids_reservations(clock):
+    limiter = RateLimiter(tiers=[(10, 1, 1)])
+    _, generation = limiter.reserve()
+    limiter.update_from_response(429, {'Retry-After': '2'})
+
+    assert limiter.scale == 0.5
+    assert limiter.generation != generation
+    delay, _ = limiter.reserve()
+    assert delay == pytest.approx(2.0)
+
+    # A second 429 within the pause reports the same congestion
+    limiter.update_from_response(429, {'Retry-After': '2'})
+    assert limiter.scale == 0.5
+
+def test_recovery_follows_time_not_calls(clock):
+    limiter = RateLimiter(tiers=[(10, 1), (300, 60)])
+    limiter.update_from_response(429, {'Retry-After': '1'})
+    assert limiter.scale == 0.5
+
+    clock.now += 1.5
+    for _ in range(200):
+        limiter.update_from_response(200, {})
+    assert limiter.scale == pytest.approx(0.5 + 0.5 / 60)
+
+    clock.now += 15
+    limiter.update_from_response(200, {})
+    assert limiter.scale == pytest.approx(0.5 + 15.5 / 60)
+
+    clock.now += 60
+    limiter.update_from_response(200, {})
+    assert limiter.scale == 1.0
+
+def test_advertised_policy_replaces_tier(clock):
+    limiter = RateLimiter()
+    limiter.update_from_response(200, {'RateLimit-Policy': '5;w=1, 120;w=60, 1000;w=3600'})
+    assert [(tier.base_calls, tier.period, tier.burst) for tier in limiter.tiers] == \
+        [(5, 1, 5), (120, 60, 11), (1000, 3600, 1)]
+
+def test_remaining_quota_is_spread_until_reset(clock):
+    limiter = RateLimiter(tiers=[(1000, 1, 1)])
+    limiter.update_from_response(200, {'RateLimit-Remaining': '4', 'RateLimit-Reset': '8'})
+    times = call_times(limiter, clock, 4)
+    assert times[-1] - times[0] == pytest.approx(6.0)
+
+def test_shared_limiter_draws_from_one_budget(clock):
+    tiers = [(10, 1, 1)]
+    first = SharedRateLimiter(tiers=tiers)
+    second = SharedRateLimiter(tiers=tiers, shared=first.shared)
+
+    assert first.reserve()[0] == 0
+    assert second.reserve()[0] == pytest.approx(0.1)
+    second.update_from_response(429, {'Retry-After': '1'})
+    first.reserve()
+    assert first.scale == 0.5